@@ -0,0 +1,217 @@
+import collections
+import http.server
+import json
+import os
+import re
+import socket
+import sys
+import threading
+
+from pathlib import Path
+
+# Stand-ins for the tools linux-msvc calls, so only our own overhead is measured.
+# They do the least work that keeps the following steps happy, e.g. winetricks records its verbs like the real one.
+STUBS = {
+    "wine": "#!/bin/sh\nexit 0\n",
+    "wineserver": "#!/bin/sh\nexit 0\n",
+    "git": "#!/bin/sh\nexit 0\n",
+    "msiextract": "#!/bin/sh\nexit 0\n",
+    "winbindd": "#!/bin/sh\nexit 0\n",
+    "wine-msvc.sh": "#!/bin/sh\nexit 0\n",
+    "meson": "#!/bin/sh\nexit 0\n",
+    "cl": "#!/bin/sh\nexit 0\n",
+    "winetricks": """#!/bin/sh
+mkdir -p "$WINEPREFIX"
+for verb in "$@"; do
+    case "$verb" in
+        -*) ;;
+        *) echo "$verb" >> "$WINEPREFIX/winetricks.log" ;;
+    esac
+done
+""",
+}
+
+# a msvc-wine checkout whose vsdownload.py and install.sh only create the files linux-msvc looks at
+VSDOWNLOAD = """import argparse
+import os
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--accept-license", action="store_true")
+parser.add_argument("--print-selection", action="store_true")
+parser.add_argument("--dest")
+parser.add_argument("--cache")
+parser.add_argument("--manifest")
+parser.add_argument("--save-manifest", action="store_true")
+args, _ = parser.parse_known_args()
+
+if args.save_manifest:
+    with open("17.6.0.manifest", "w") as f:
+        f.write("{}")
+
+if args.print_selection:
+    print("Microsoft.VC.14.36.17.6.CRT.Headers.base (14.36.32532)")
+    print("Win11SDK_10.0.22621 (10.1.22621.755)")
+else:
+    for directory in ["VC/Tools/MSVC/14.36.32532/bin/Hostx64/x64", "Windows Kits/10/Include/10.0.22621.0/um"]:
+        os.makedirs(os.path.join(args.dest, directory), exist_ok=True)
+    with open(os.path.join(args.dest, "VC/Tools/MSVC/14.36.32532/bin/Hostx64/x64/cl.exe"), "wb") as f:
+        f.write(os.urandom(1024 * 1024))
+    if args.cache:
+        os.makedirs(os.path.join(args.cache, "payloads"), exist_ok=True)
+        with open(os.path.join(args.cache, "payloads", "cl.exe"), "wb") as f:
+            f.write(os.urandom(1024 * 1024))
+"""
+
+INSTALL_SH = """#!/bin/sh
+mkdir -p "$1/bin/x64"
+cat > "$1/bin/x64/msvcenv.sh" <<'EOF'
+BINDIR=$(dirname "$0")
+MSVCVER=14.36.32532
+SDKVER=10.0.22621.0
+export INCLUDE="$BINDIR/../../VC/Tools/MSVC/$MSVCVER/include"
+export LIB="$BINDIR/../../VC/Tools/MSVC/$MSVCVER/lib/x64"
+EOF
+"""
+
+# A cl that preprocesses and compiles like the real one, as far as linux-msvc can tell.
+# The compilations of one prefix take turns, like wine processes waiting for the wineserver of their prefix.
+COMPILING_CL = """#!/bin/bash
+output=; source=; preprocess=
+for arg in "$@"; do
+    case "$arg" in
+        /E) preprocess=1 ;;
+        /Fo*) output="${arg#/Fo}" ;;
+        /*|-*) ;;
+        *) source="$arg" ;;
+    esac
+done
+if [ -n "$preprocess" ]; then
+    basename "$source" >&2
+    cat "$source"
+    exit 0
+fi
+basename "$source"
+mkdir -p "$WINEPREFIX"
+flock "$WINEPREFIX/.wineserver.lock" sleep "${COMPILE_TIME:-0.2}"
+md5sum "$source" > "${output:-${source%.*}.obj}"
+"""
+
+
+def write_executable(path: Path, content: str):
+    path.write_text(content)
+    path.chmod(0o755)
+
+
+def create_stubs(bin_dir: Path):
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name, content in STUBS.items():
+        write_executable(bin_dir / name, content)
+
+    # vsdownload.py is started with the python on the PATH
+    python = bin_dir / "python"
+    if not python.exists():
+        python.symlink_to(sys.executable)
+
+
+def create_msvc_wine_repo(destination: Path):
+    repo = destination / "msvc-wine-repo"
+    repo.mkdir(parents=True, exist_ok=True)
+    (repo / "vsdownload.py").write_text(VSDOWNLOAD)
+    write_executable(repo / "install.sh", INSTALL_SH)
+
+
+# the vcpkg clone is skipped if the directory exists
+def create_vcpkg_repo(destination: Path):
+    (destination / "vcpkg" / "scripts").mkdir(parents=True, exist_ok=True)
+    (destination / "vcpkg" / "scripts" / "bootstrap.ps1").write_text("")
+
+
+def write_config(config_home: Path, destination: Path, **values):
+    config_dir = config_home / "msvc_linux"
+    config_dir.mkdir(parents=True, exist_ok=True)
+    config = {
+        "destination": str(destination),
+        "no_wine_prefix": False,
+        "create_config_file": True,
+        "use_cache": True,
+        "system_winetricks": True,
+    }
+    config.update(values)
+    with open(config_dir / "config.json", "w") as f:
+        json.dump(config, f)
+
+
+def remove_config(config_home: Path):
+    (config_home / "msvc_linux" / "config.json").unlink(missing_ok=True)
+
+
+# the environment the cli runs in: stubs first on the PATH and its own config directory
+def sandbox_env(sandbox: Path) -> dict:
+    env = dict(os.environ)
+    env["PATH"] = str(sandbox / "bin") + ":" + env["PATH"]
+    env["XDG_CONFIG_HOME"] = str(sandbox / "config")
+    return env
+
+
+# create a sandbox with stubs and an installed looking destination
+def prepare_sandbox(sandbox: Path, config=True) -> dict:
+    create_stubs(sandbox / "bin")
+    if config:
+        write_config(sandbox / "config", sandbox / "dest")
+
+    return sandbox_env(sandbox)
+
+
+class FileRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests[self.path] += 1
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+
+        start, end = 0, len(data) - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(end, int(match.group(2)))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{len(data)}"')
+        self.end_headers()
+        self.wfile.write(data[start:end + 1])
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# A local http server with range support that serves generated files from memory.
+class FileServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FileRequestHandler)
+        self.files = {}
+        self.requests = collections.Counter()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def add(self, path: str, size: int) -> str:
+        self.files[path] = os.urandom(size)
+        return self.url(path)
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
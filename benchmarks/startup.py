@@ -0,0 +1,87 @@
+#!/bin/python3
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from sandbox import prepare_sandbox
+
+# The commands that run most often.
+# meson calls wine and cl once per test and translation unit, so their startup time is paid thousands of times.
+COMMANDS = {
+    "version": ["--version"],
+    "env": ["env", "--shell", "bash"],
+    "wine": ["wine", "true.exe"],
+    "cl": ["cl", "/nologo", "/?"],
+}
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+# the interpreter with the modules every command imports, the part of the startup linux-msvc can't change
+BARE_INTERPRETER = [sys.executable, "-c", "import argparse, importlib, json, os, pathlib, shutil, subprocess"]
+
+
+def measure(command: list, env: dict, runs: int) -> list:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            command if command[:1] == [sys.executable] else [sys.executable, str(REPO_DIR / "linux-msvc.py")] + command,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the startup time of the linux-msvc cli.")
+    parser.add_argument("--runs", type=int, default=20, help="How often every command is run.")
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=0.075,
+        help="How many seconds the median startup of a command may take longer than the bare interpreter. "
+             "It is relative, since the interpreter alone takes anything from 20 to 80ms depending on the machine.",
+    )
+    parser.add_argument("--json", dest="json_file", default=None, help="Write the results to this file.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as sandbox:
+        env = prepare_sandbox(Path(sandbox))
+
+        # the first run creates the cached environment and dependency check
+        measure(["env"], env, 1)
+
+        interpreter = statistics.median(measure(BARE_INTERPRETER, env, args.runs))
+
+        results = {}
+        for name, command in COMMANDS.items():
+            timings = measure(command, env, args.runs)
+            results[name] = {
+                "median": statistics.median(timings),
+                "min": min(timings),
+                "max": max(timings),
+            }
+
+    print(f"interpreter median {interpreter * 1000:7.1f}ms, budget {(interpreter + args.budget) * 1000:.1f}ms")
+
+    over_budget = False
+    for name, result in results.items():
+        marker = ""
+        if result["median"] > interpreter + args.budget:
+            marker = "  over budget"
+            over_budget = True
+        print(f"{name:<8} median {result['median'] * 1000:7.1f}ms  min {result['min'] * 1000:7.1f}ms{marker}")
+
+    if args.json_file is not None:
+        with open(args.json_file, "w") as f:
+            json.dump(results, f, indent=4)
+
+    sys.exit(1 if over_budget else 0)
@@ -0,0 +1,499 @@
+#!/bin/python3
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+import sandbox
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+GROUPS = ["startup", "set_env", "orchestration", "cache", "mirror", "exe_wrapper", "distcl"]
+
+# the commands meson runs thousands of times, measured with their real work
+STARTUP_COMMANDS = {
+    "version": ["--version"],
+    "env": ["env", "--shell", "bash"],
+    "wine": ["wine", "true.exe"],
+    "cl": ["cl", "/nologo", "/?"],
+}
+
+sys.path.insert(0, str(REPO_DIR))
+
+
+def summarize(timings: list) -> dict:
+    return {
+        "median": statistics.median(timings),
+        "min": min(timings),
+        "max": max(timings),
+        "runs": len(timings),
+    }
+
+
+def cli(command: list, env: dict, check=False) -> float:
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, str(REPO_DIR / "linux-msvc.py")] + command,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    elapsed = time.perf_counter() - start
+
+    if check and result.returncode != 0:
+        raise RuntimeError(f"linux-msvc {' '.join(command)} failed:\n{result.stderr.decode()}")
+
+    return elapsed
+
+
+# The startup time of every subcommand.
+# --help imports the module of the command and builds its parser, which is the fixed cost of every call.
+def bench_startup(root: Path, runs: int) -> dict:
+    import importlib.util
+
+    spec = importlib.util.spec_from_file_location("linux_msvc_cli", REPO_DIR / "linux-msvc.py")
+    cli_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cli_module)
+
+    env = sandbox.prepare_sandbox(root)
+    # the first run creates the cached environment and dependency check
+    cli(["env"], env)
+
+    results = {}
+    for name, command in STARTUP_COMMANDS.items():
+        results[f"startup.{name}"] = summarize([cli(command, env) for _ in range(runs)])
+
+    for command in cli_module.COMMAND_MODULES:
+        results[f"startup.help.{command}"] = summarize([cli([command, "--help"], env) for _ in range(runs)])
+
+    return results
+
+
+# set_env without any snapshot, with the snapshot on disk and with the snapshot of this process
+def bench_set_env(root: Path, runs: int) -> dict:
+    env = sandbox.prepare_sandbox(root)
+    # an msvc installation, so msvcenv.sh is sourced like on a real install
+    subprocess.run(
+        ["sh", "-c", sandbox.INSTALL_SH, "install.sh", str(root / "dest" / "msvc")],
+        check=True,
+    )
+
+    original_env = dict(os.environ)
+    os.environ.update(env)
+
+    import operations.utils
+    config = operations.utils.LinuxMsvcConfig.load()
+
+    def timed(prepare) -> float:
+        prepare()
+        start = time.perf_counter()
+        operations.utils.set_env(config, {})
+        elapsed = time.perf_counter() - start
+
+        os.environ.clear()
+        os.environ.update(env)
+        return elapsed
+
+    def cold():
+        operations.utils._env_snapshot = None
+        operations.utils.env_snapshot_file().unlink(missing_ok=True)
+
+    def from_file():
+        operations.utils._env_snapshot = None
+
+    try:
+        return {
+            "set_env.cold": summarize([timed(cold) for _ in range(runs)]),
+            "set_env.from_file": summarize([timed(from_file) for _ in range(runs)]),
+            "set_env.in_process": summarize([timed(lambda: None) for _ in range(runs)]),
+        }
+    finally:
+        os.environ.clear()
+        os.environ.update(original_env)
+
+
+# a destination with everything that would otherwise be cloned or downloaded from the internet
+def prepare_seed(seed: Path, env: dict):
+    sandbox.create_msvc_wine_repo(seed)
+    sandbox.create_vcpkg_repo(seed)
+
+    original_env = dict(os.environ)
+    os.environ.update(env)
+    try:
+        import operations.cache
+        import operations.install
+        import operations.utils
+
+        config = operations.utils.LinuxMsvcConfig(destination=str(seed))
+        cache = operations.cache.DownloadCache(config)
+        for url in [operations.install.POWERSHELL_URL, operations.install.CHOCO_URL]:
+            tmp_file = cache.tmp_dir / "seed"
+            tmp_file.write_bytes(os.urandom(1024 * 1024))
+            cache.add(url, tmp_file)
+    finally:
+        os.environ.clear()
+        os.environ.update(original_env)
+
+
+# install, reset the prefix with and without template and remove, with stubs for wine and all downloads
+def bench_orchestration(root: Path, runs: int) -> dict:
+    env = sandbox.prepare_sandbox(root, config=False)
+    seed = root / "seed"
+    prepare_seed(seed, env)
+
+    destination = root / "dest"
+    timings = {"install": [], "reset_prefix": [], "reset_prefix_template": [], "remove": []}
+    for _ in range(runs):
+        shutil.rmtree(destination, ignore_errors=True)
+        shutil.copytree(seed, destination, symlinks=True)
+        sandbox.remove_config(root / "config")
+
+        timings["install"].append(cli(
+            ["install", "--destination", str(destination), "--use_system_winetricks"], env, check=True,
+        ))
+        timings["reset_prefix"].append(cli(["config", "reset", "wine_prefix"], env, check=True))
+
+        cli(["prefix", "snapshot"], env, check=True)
+        timings["reset_prefix_template"].append(cli(["config", "reset", "wine_prefix"], env, check=True))
+
+        timings["remove"].append(cli(["remove", "--delete_cache"], env, check=True))
+
+    return {f"orchestration.{name}": summarize(values) for name, values in timings.items()}
+
+
+# downloads through the cache from a local server, so only the cache and downloader overhead is measured
+def bench_cache(root: Path, runs: int) -> dict:
+    env = sandbox.prepare_sandbox(root)
+    server = sandbox.FileServer()
+
+    original_env = dict(os.environ)
+    os.environ.update(env)
+    try:
+        import operations.cache
+        import operations.utils
+
+        config = operations.utils.LinuxMsvcConfig.load()
+        cache = operations.cache.DownloadCache(config)
+
+        def get(url: str) -> float:
+            start = time.perf_counter()
+            cache.get(url)
+            return time.perf_counter() - start
+
+        misses = [get(server.add(f"/miss/{run}/file.bin", 32 * 1024 ** 2)) for run in range(runs)]
+
+        hit_url = server.add("/hit/file.bin", 32 * 1024 ** 2)
+        get(hit_url)
+        hits = [get(hit_url) for _ in range(runs)]
+    finally:
+        server.shutdown()
+        os.environ.clear()
+        os.environ.update(original_env)
+
+    return {
+        "cache.miss_32M": summarize(misses),
+        "cache.hit_32M": summarize(hits),
+    }
+
+
+# downloads through a 'cache serve' mirror in its own process, with a local server as upstream
+# every file may only be fetched from upstream once, even if many clients ask for it at the same time
+def bench_mirror(root: Path, runs: int) -> dict:
+    upstream = sandbox.FileServer()
+
+    server_env = sandbox.prepare_sandbox(root / "server", config=False)
+    sandbox.write_config(root / "server" / "config", root / "server" / "dest", mirror_upstream_hosts=["127.0.0.1"])
+    mirror_url = f"http://127.0.0.1:{sandbox.free_port()}"
+    mirror = subprocess.Popen(
+        [sys.executable, str(REPO_DIR / "linux-msvc.py"), "cache", "serve", "--host", "127.0.0.1",
+         "--port", mirror_url.rsplit(":", 1)[1]],
+        env=server_env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+    )
+
+    client_env = sandbox.prepare_sandbox(root / "client", config=False)
+    sandbox.write_config(root / "client" / "config", root / "client" / "dest", mirror_url=mirror_url)
+
+    original_env = dict(os.environ)
+    os.environ.update(client_env)
+    try:
+        import urllib.request
+        from concurrent.futures import ThreadPoolExecutor
+
+        import operations.cache
+        import operations.mirror
+        import operations.utils
+
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(mirror_url + "/health", timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        config = operations.utils.LinuxMsvcConfig.load()
+        cache = operations.cache.DownloadCache(config)
+
+        # the client cache is emptied after every download, so every download goes to the mirror
+        def get(url: str) -> float:
+            start = time.perf_counter()
+            cache.get(url)
+            elapsed = time.perf_counter() - start
+            cache.gc(0)
+            return elapsed
+
+        misses = [get(upstream.add(f"/miss/{run}/file.bin", 32 * 1024 ** 2)) for run in range(runs)]
+
+        hit_url = upstream.add("/hit/file.bin", 32 * 1024 ** 2)
+        get(hit_url)
+        hits = [get(hit_url) for _ in range(runs)]
+        requests_per_fetch = upstream.requests["/hit/file.bin"]
+
+        concurrent = []
+        for run in range(runs):
+            path = f"/concurrent/{run}/file.bin"
+            url = upstream.add(path, 32 * 1024 ** 2)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(8) as executor:
+                list(executor.map(lambda _: operations.mirror.lookup(mirror_url, url), range(8)))
+            concurrent.append(time.perf_counter() - start)
+
+            if upstream.requests[path] > requests_per_fetch:
+                raise RuntimeError(f"the mirror fetched {path} more than once")
+    finally:
+        mirror.terminate()
+        mirror.wait()
+        upstream.shutdown()
+        os.environ.clear()
+        os.environ.update(original_env)
+
+    return {
+        "mirror.miss_32M": summarize(misses),
+        "mirror.hit_32M": summarize(hits),
+        "mirror.concurrent_miss_8x32M": summarize(concurrent),
+    }
+
+
+# the cost meson pays for every test: the exe_wrapper started directly, as generated shim and through the daemon
+def bench_exe_wrapper(root: Path, runs: int) -> dict:
+    env = sandbox.prepare_sandbox(root)
+    cli(["env"], env)
+
+    def stub_wine() -> float:
+        start = time.perf_counter()
+        subprocess.run([str(root / "bin" / "wine"), "true.exe"], env=env)
+        return time.perf_counter() - start
+
+    results = {
+        "exe_wrapper.stub_wine": summarize([stub_wine() for _ in range(runs)]),
+        "exe_wrapper.direct": summarize([cli(["wine", "true.exe"], env) for _ in range(runs)]),
+    }
+
+    # the exe_wrapper of the generated cross file
+    cli(["meson", "--add_cross_file"], env, check=True)
+    shim = root / "dest" / "bin" / "linux-msvc-wine"
+
+    def shim_wine() -> float:
+        start = time.perf_counter()
+        subprocess.run([str(shim), "true.exe"], env=env)
+        return time.perf_counter() - start
+
+    results["exe_wrapper.shim"] = summarize([shim_wine() for _ in range(runs)])
+
+    cli(["daemon", "start", "--workers", "2"], env, check=True)
+    try:
+        results["exe_wrapper.daemon"] = summarize([cli(["wine", "true.exe"], env) for _ in range(runs)])
+    finally:
+        cli(["daemon", "stop"], env)
+
+    return results
+
+
+# A batch of compilations through 'linux-msvc cl', locally and spread over two local workers.
+# Locally they all wait for the same wineserver, the workers run each of them in a prefix of the pool.
+def bench_distcl(root: Path, runs: int) -> dict:
+    env = sandbox.prepare_sandbox(root)
+    sandbox.write_executable(root / "bin" / "cl", sandbox.COMPILING_CL)
+    sandbox.write_config(root / "config", root / "dest", msvc_version="14.36.32532", sdk_version="10.0.22621.0")
+    (root / "dest" / ".wineenv").mkdir(parents=True, exist_ok=True)
+    cli(["pool", "create", "--size", "4"], env, check=True)
+
+    workers = [f"127.0.0.1:{sandbox.free_port()}" for _ in range(2)]
+    processes = [
+        subprocess.Popen(
+            [sys.executable, str(REPO_DIR / "linux-msvc.py"), "distcl", "worker", "--host", "127.0.0.1",
+             "--port", worker.rsplit(":", 1)[1], "--jobs", "2"],
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+        )
+        for worker in workers
+    ]
+
+    sources = root / "src"
+    sources.mkdir()
+    batch_index = [0]
+
+    # every batch compiles new sources, so the object cache never has them
+    def batch(batch_env: dict, size: int = 8) -> float:
+        batch_index[0] += 1
+        names = []
+        for index in range(size):
+            name = f"batch{batch_index[0]}_{index}.cpp"
+            (sources / name).write_text(f"int f{index}() {{ return {batch_index[0]}; }}\n")
+            names.append(name)
+
+        start = time.perf_counter()
+        compilers = [
+            subprocess.Popen(
+                [sys.executable, str(REPO_DIR / "linux-msvc.py"), "cl", "/nologo", "/c", name],
+                cwd=sources,
+                env=batch_env,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            for name in names
+        ]
+        for compiler in compilers:
+            _, stderr = compiler.communicate()
+            if compiler.returncode != 0:
+                raise RuntimeError(f"linux-msvc cl failed:\n{stderr.decode()}")
+        elapsed = time.perf_counter() - start
+
+        for name in names:
+            if not (sources / name).with_suffix(".obj").exists():
+                raise RuntimeError(f"{name} was not compiled")
+
+        return elapsed
+
+    try:
+        import socket
+
+        for worker in workers:
+            for _ in range(100):
+                try:
+                    socket.create_connection(("127.0.0.1", int(worker.rsplit(":", 1)[1])), timeout=1).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+
+        distributed_env = dict(env, LINUX_MSVC_DISTCL_WORKERS=",".join(workers))
+        results = {
+            "distcl.local_8": summarize([batch(env) for _ in range(runs)]),
+            "distcl.workers_8": summarize([batch(distributed_env) for _ in range(runs)]),
+        }
+
+        with open(root / "dest" / "cache" / "objects" / "stats.json", "r") as f:
+            if json.load(f).get("remote", 0) != 8 * runs:
+                raise RuntimeError("not every compilation of the workers batches ran on a worker")
+
+        # a worker that is down must only cost the fallback to the other one or to a local compilation
+        unreachable = f"127.0.0.1:{sandbox.free_port()}"
+        fallback_env = dict(env, LINUX_MSVC_DISTCL_WORKERS=",".join([unreachable] + workers))
+        results["distcl.one_worker_down_8"] = summarize([batch(fallback_env) for _ in range(runs)])
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    return results
+
+
+BENCHMARKS = {
+    "startup": bench_startup,
+    "set_env": bench_set_env,
+    "orchestration": bench_orchestration,
+    "cache": bench_cache,
+    "mirror": bench_mirror,
+    "exe_wrapper": bench_exe_wrapper,
+    "distcl": bench_distcl,
+}
+
+
+# compare the medians against the baseline
+# a result only counts as regression if it is slower by more than the tolerance and by more than min_delta seconds,
+# so the noise of very short benchmarks doesn't fail the run
+def compare(results: dict, baseline: dict, tolerance: float, min_delta: float) -> list:
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        marker = ""
+        if reference is not None:
+            change = result["median"] / reference["median"] - 1 if reference["median"] else 0.0
+            marker = f"  {change * 100:+6.1f}%"
+            if change > tolerance and result["median"] - reference["median"] > min_delta:
+                marker += "  regression"
+                regressions.append(name)
+
+        print(f"{name:<36} median {result['median'] * 1000:9.1f}ms  min {result['min'] * 1000:9.1f}ms{marker}")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark linux-msvc with stubs for wine, msvc and the network.")
+    parser.add_argument("--runs", type=int, default=10, help="How often every benchmark is run.")
+    parser.add_argument("--only", nargs="+", choices=GROUPS, default=GROUPS, help="The benchmark groups to run.")
+    parser.add_argument("--json", dest="json_file", default=None, help="Write the results to this file.")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE), help="The results to compare against.")
+    parser.add_argument("--save_baseline", action="store_true", default=False,
+                        help="Store the results as new baseline instead of comparing.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="How much slower than the baseline a result may be, 0.2 means 20%%.")
+    parser.add_argument("--min_delta", type=float, default=0.005,
+                        help="Differences below this many seconds are never a regression.")
+    args = parser.parse_args()
+
+    results = {}
+    for group in args.only:
+        with tempfile.TemporaryDirectory(prefix=f"linux-msvc-bench-{group}-") as root:
+            results.update(BENCHMARKS[group](Path(root), args.runs))
+
+    report = {
+        "meta": {
+            "created": time.time(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "runs": args.runs,
+        },
+        "results": results,
+    }
+
+    if args.json_file is not None:
+        with open(args.json_file, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=4)
+        compare(results, {}, args.tolerance, args.min_delta)
+        print(f"saved the baseline to {args.baseline}")
+        sys.exit(0)
+
+    # without a baseline nothing could ever be a regression, so that is an error of its own
+    try:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+    except FileNotFoundError:
+        compare(results, {}, args.tolerance, args.min_delta)
+        print(f"There is no baseline at {args.baseline}, use --save_baseline to create one.")
+        sys.exit(1)
+
+    regressions = compare(results, baseline, args.tolerance, args.min_delta)
+    if regressions:
+        print(f"{len(regressions)} benchmarks are slower than the baseline: {', '.join(regressions)}")
+
+    sys.exit(1 if regressions else 0)
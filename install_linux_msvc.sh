@@ -96,11 +96,18 @@ if [ "$no_config_file" = "true" ]; then
         mkdir -p "$HOME/.local/bin"
     fi
 
+    # the wrapper runs the python of the pipenv venv directly instead of going through 'pipenv run',
+    # since meson calls it once per test and compiler invocation
+    venv_dir="$(pipenv --venv)"
+    if [ ! -x "$venv_dir/bin/python3" ]; then
+        echo "Could not find the pipenv virtual environment."
+        exit 1
+    fi
+
     SCRIPT_LOCATION="$HOME/.local/bin/linux-msvc"
-    echo "#!/bin/bash" > "$SCRIPT_LOCATION"
-    echo 'PARENT_COMMAND=$(ps -o comm= $PPID)' >> "$SCRIPT_LOCATION"
-    echo "export PIPENV_PIPFILE=\"$install_location/main-repo/Pipfile\"" >> "$SCRIPT_LOCATION"
-    echo "pipenv run python3 $install_location/main-repo/linux-msvc.py --base_shell \$PARENT_COMMAND \"\$@\"" >> "$SCRIPT_LOCATION"
+    echo "#!/bin/sh" > "$SCRIPT_LOCATION"
+    echo 'if [ -r "/proc/$PPID/comm" ]; then read -r PARENT_COMMAND < "/proc/$PPID/comm"; else PARENT_COMMAND=$(ps -o comm= $PPID); fi' >> "$SCRIPT_LOCATION"
+    echo "exec \"$venv_dir/bin/python3\" \"$install_location/main-repo/linux-msvc.py\" --base_shell \"\$PARENT_COMMAND\" \"\$@\"" >> "$SCRIPT_LOCATION"
 
     chmod +x "$HOME/.local/bin/linux-msvc"
     exit 0
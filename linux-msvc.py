@@ -5,15 +5,52 @@ import shutil
 import subprocess
 import sys
 
+import importlib
+
 import operations.utils
 
-import operations.install
-import operations.remove
-import operations.update
-import operations.setenv
-import operations.tools
-import operations.config
+# The modules defining the subcommands.
+# Only the module of the command that is used gets imported, to keep the startup fast.
+# This matters since meson calls 'linux-msvc wine' and 'linux-msvc cl' thousands of times.
+COMMAND_MODULES = {
+    "install": "operations.install",
+    "remove": "operations.remove",
+    "update": "operations.update",
+    "shell": "operations.setenv",
+    "env": "operations.setenv",
+    "meson": "operations.tools",
+    "wine": "operations.tools",
+    "link": "operations.tools",
+    "pwsh": "operations.tools",
+    "config": "operations.config",
+    "cache": "operations.cache",
+    "daemon": "operations.daemon",
+    "cl": "operations.objcache",
+    "prefix": "operations.prefix",
+    "dedupe": "operations.dedupe",
+    "pool": "operations.pool",
+    "vcpkg": "operations.vcpkg",
+    "distcl": "operations.distcl",
+}
+
+
+# find the module of the command in the arguments
+# if no command is given (e.g. for --help) all modules are returned
+def command_modules(argv) -> list:
+    skip_next = False
+    for arg in argv:
+        if skip_next:
+            skip_next = False
+        elif arg in ("--base_shell", "--profile"):
+            skip_next = True
+        elif arg == "--version":
+            return []
+        elif not arg.startswith("-"):
+            if arg in COMMAND_MODULES:
+                return [COMMAND_MODULES[arg]]
+            break
 
+    return list(dict.fromkeys(COMMAND_MODULES.values()))
 
 # make sure the os is not windows
 if os.name == "nt":
@@ -39,7 +76,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--version",
         action="version",
-        version="%(prog)s" + str(operations.utils.Consts.version()),
+        version="%(prog)s" + operations.utils.Consts.VERSION,
     )
     parser.add_argument(
         "--verbose",
@@ -57,18 +94,28 @@ if __name__ == "__main__":
              "wrapper script.",
     )
 
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        default=None,
+        metavar="FILE",
+        help="Write a trace of all steps, subprocesses and downloads to FILE. "
+             "Open it in https://ui.perfetto.dev or chrome://tracing. "
+             "Winetricks verbs are installed one at a time then, so each of them gets its own timing.",
+    )
+
     subparser_manager = parser.add_subparsers(help="operation to perform", dest="operation")
 
     # add the operation commands
-    operations.install.init_subparser(subparser_manager)
-    operations.remove.init_subparser(subparser_manager)
-    operations.update.init_subparser(subparser_manager)
-    operations.setenv.init_subparser(subparser_manager)
-    operations.tools.init_subparsers(subparser_manager)
-    operations.config.init_subparser(subparser_manager)
+    for module_name in command_modules(sys.argv[1:]):
+        importlib.import_module(module_name).init_subparser(subparser_manager)
 
     args = vars(parser.parse_args())
 
+    if args["profile"] is not None:
+        import operations.profile
+        operations.profile.enable(args["profile"], f"linux-msvc {args['operation']}")
+
     # print the arguments for debugging
     if args["verbose"]:
         print(args)
@@ -93,7 +140,10 @@ if __name__ == "__main__":
 
     match args["operation"]:
         case "install":
-            if has_config:
+            # an install that stopped after saving the config may still be continued
+            if has_config and operations.install.can_resume(current_config):
+                args["destination"] = current_config["destination"]
+            elif has_config:
                 print("A config file already exists.")
                 print("If you want to reinstall linux-msvc, please uninstall it first.")
                 print("To update use the update command.")
@@ -112,14 +162,80 @@ if __name__ == "__main__":
 
             operations.remove.remove(current_config, args)
 
+        case "update":
+            if not has_config:
+                if not args["destination"]:
+                    print("No config file exists and no destination was given.")
+                    print("Please specify a destination.")
+                    sys.exit(1)
+
+                current_config["destination"] = args["destination"]
+                current_config["no_wine_prefix"] = False
+                current_config["use_cache"] = True
+                current_config["create_config_file"] = False
+
+            operations.update.update(current_config, args)
+
         case "config":
             operations.config.configure(current_config, args)
+        case "cache":
+            if not has_config:
+                print("No config file exists, so there is no cache to manage.")
+                sys.exit(1)
+
+            operations.cache.cache_command(current_config, args)
+        case "daemon":
+            if not has_config:
+                print("No config file exists, please install linux-msvc first.")
+                sys.exit(1)
+
+            operations.daemon.daemon_command(current_config, args)
         case "meson":
             operations.tools.meson(current_config, args)
         case "wine":
             operations.tools.wine(current_config, args)
+        case "link":
+            operations.tools.link(current_config, args)
         case "pwsh":
             operations.tools.powershell(current_config, args)
+        case "env":
+            if not has_config:
+                print("No config file exists, please install linux-msvc first.")
+                sys.exit(1)
+
+            operations.setenv.print_env(current_config, args)
+        case "prefix":
+            if not has_config:
+                print("No config file exists, please install linux-msvc first.")
+                sys.exit(1)
+
+            operations.prefix.prefix_command(current_config, args)
+        case "dedupe":
+            if not has_config:
+                print("No config file exists, please install linux-msvc first.")
+                sys.exit(1)
+
+            operations.dedupe.dedupe(current_config, args)
+        case "pool":
+            if not has_config:
+                print("No config file exists, please install linux-msvc first.")
+                sys.exit(1)
+
+            operations.pool.pool_command(current_config, args)
+        case "vcpkg":
+            if not has_config:
+                print("No config file exists, please install linux-msvc first.")
+                sys.exit(1)
+
+            operations.vcpkg.vcpkg_command(current_config, args)
+        case "distcl":
+            if not has_config:
+                print("No config file exists, please install linux-msvc first.")
+                sys.exit(1)
+
+            operations.distcl.distcl_command(current_config, args)
+        case "cl":
+            operations.objcache.cl(current_config, args)
 
         case "shell":
             if args["type"] != "":
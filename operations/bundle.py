@@ -0,0 +1,322 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from typing import Dict, List
+
+import operations.cache
+import operations.install
+import operations.repos
+import operations.runner
+import operations.tools
+import operations.utils
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+BUNDLE_VERSION = 1
+BUNDLE_MANIFEST = "bundle.json"
+# the entries of the cache directory that belong to linux-msvc, everything else is the cache of vsdownload.py
+CACHE_ENTRIES = ["blobs", "locks", "tmp", "manifest.json", "objects", "git", "vcpkg"]
+# the vsdownload.py manifest of an installed bundle, so vsdownload.py doesn't have to fetch it
+VSDOWNLOAD_MANIFEST_NAME = "vsdownload.manifest"
+
+
+# the git repositories in the destination and where they come from
+def bundle_repos() -> Dict[str, str]:
+    return {
+        "msvc-wine-repo": operations.install.MSVC_WINE_URL,
+        "vcpkg": operations.install.VCPKG_URL,
+    }
+
+
+def _is_relative_path(relative: str) -> bool:
+    return relative != "" and not Path(relative).is_absolute() and ".." not in Path(relative).parts
+
+
+def checksum_file(bundle_file: Path) -> Path:
+    return bundle_file.with_name(bundle_file.name + ".sha256")
+
+
+def files_below(directory: Path) -> List[Path]:
+    if not directory.is_dir():
+        return []
+
+    return sorted(path for path in directory.rglob("*") if path.is_file())
+
+
+# Archives are written from a staging directory of symlinks and tar follows them, so nothing is copied twice.
+# Links source as relative into the staging directory and adds its checksum to files.
+def stage_file(staging: Path, relative: str, source: Path, files: Dict[str, str], sha256: str = None, verbose=False):
+    target = staging / relative
+    target.parent.mkdir(parents=True, exist_ok=True)
+    os.symlink(source.resolve(), target)
+    files[relative] = sha256 or operations.cache.hash_file(source)
+    if verbose:
+        print(f"adding {relative}")
+
+
+# Write the manifest and everything in the staging directory into archive and return the checksum of the archive.
+# The manifest comes first, so it can be read without unpacking everything.
+def write_archive(config: operations.utils.LinuxMsvcConfig, staging: Path, archive: Path, manifest_name: str,
+                  manifest: Dict, verbose=False) -> str:
+    with open(staging / manifest_name, "w") as f:
+        json.dump(manifest, f, indent=4)
+
+    members = [manifest_name] + sorted(entry.name for entry in staging.iterdir() if entry.name != manifest_name)
+
+    archive.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = archive.with_name(f".{archive.name}.{os.getpid()}.tmp")
+    try:
+        operations.runner.get_runner(config, verbose).run(
+            ["tar", "-h"] + operations.utils.tar_compression() + ["-cf", str(tmp_file), "-C", str(staging)] + members,
+            check=True,
+        )
+        checksum = operations.cache.hash_file(tmp_file)
+        os.replace(tmp_file, archive)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+    return checksum
+
+
+# Only regular files are taken from an archive. A symlink, or a file below a symlinked directory, could point anywhere
+# and moving it would place that link into the cache.
+def _is_unpacked_file(staging: Path, relative: str) -> bool:
+    path = staging / relative
+    return not path.is_symlink() and path.is_file() and path.resolve() == staging.resolve() / relative
+
+
+# the files of an unpacked archive that are missing, not regular files or don't match their checksum
+def corrupted_files(staging: Path, files: Dict[str, str]) -> List[str]:
+    return [
+        relative for relative, sha256 in files.items()
+        if not _is_unpacked_file(staging, relative) or operations.cache.hash_file(staging / relative) != sha256
+    ]
+
+
+# the files vsdownload.py keeps in the cache directory
+def vsdownload_cache_files(config: operations.utils.LinuxMsvcConfig) -> List[Path]:
+    cache_dir = config.destination() / "cache"
+    if not cache_dir.is_dir():
+        return []
+
+    files = []
+    for entry in sorted(cache_dir.iterdir()):
+        if entry.name in CACHE_ENTRIES:
+            continue
+        files += [entry] if entry.is_file() else files_below(entry)
+
+    return files
+
+
+# the manifest vsdownload.py selects the packages from
+# without it, vsdownload.py has to ask the visual studio servers, even if every package is cached
+def save_vsdownload_manifest(config: operations.utils.LinuxMsvcConfig, target: Path, verbose=False) -> bool:
+    current = config.msvc_components().get("manifest")
+    if current and Path(current).exists():
+        shutil.copyfile(current, target)
+        return True
+
+    # vsdownload.py saves it as <version>.manifest in the working directory
+    with tempfile.TemporaryDirectory() as directory:
+        result = operations.runner.get_runner(config, verbose).run(
+            operations.install.vsdownload_command(config) + ["--save-manifest", "--print-selection"],
+            cwd=directory,
+            capture=True,
+            prefix="vsdownload",
+        )
+        manifests = sorted(Path(directory).glob("*.manifest"))
+        if result["returncode"] != 0 or not manifests:
+            return False
+
+        shutil.move(manifests[0], target)
+        return True
+
+
+# Write the downloads, the vsdownload.py cache, the winetricks cache and the git repositories into one archive.
+# bundle.json lists the checksum of every file and the whole archive gets a sha256sum file next to it.
+def export_bundle(config: operations.utils.LinuxMsvcConfig, bundle_file: Path, verbose=False):
+    cache = operations.cache.DownloadCache(config)
+    staging = Path(tempfile.mkdtemp(dir=config.destination(), prefix=".bundle-"))
+
+    manifest = {
+        "version": BUNDLE_VERSION,
+        "created": time.time(),
+        "linux_msvc_version": str(operations.utils.Consts.VERSION),
+        "msvc_components": {k: v for k, v in config.msvc_components().items() if k != "manifest"},
+        "files": {},
+        "downloads": {},
+        "repos": {},
+        "vsdownload_manifest": None,
+    }
+
+    try:
+        for download_url, entry in cache.entries().items():
+            blob = cache.blob_path(entry)
+            relative = f"downloads/{entry['sha256']}/{entry['file_name']}"
+            if relative not in manifest["files"]:
+                if not blob.exists() or operations.cache.hash_file(blob) != entry["sha256"]:
+                    print(f"skipping the corrupted download {download_url}, run 'linux-msvc cache verify'")
+                    continue
+                stage_file(staging, relative, blob, manifest["files"], entry["sha256"], verbose)
+
+            manifest["downloads"][download_url] = {"file": relative, "file_name": entry["file_name"]}
+
+        cache_dir = config.destination() / "cache"
+        for path in vsdownload_cache_files(config):
+            stage_file(staging, f"vsdownload/{path.relative_to(cache_dir)}", path, manifest["files"], verbose=verbose)
+
+        winetricks_cache = operations.tools.winetricks_cache_dir()
+        for path in files_below(winetricks_cache):
+            stage_file(staging, f"winetricks/{path.relative_to(winetricks_cache)}", path, manifest["files"],
+                       verbose=verbose)
+
+        for name, url in bundle_repos().items():
+            repo_dir = config.destination() / name
+            if not (repo_dir / ".git").exists():
+                continue
+
+            relative = f"repos/{name}.bundle"
+            (staging / "repos").mkdir(exist_ok=True)
+            result = operations.repos.git(config, ["bundle", "create", str(staging / relative), "--all"],
+                                          cwd=repo_dir, check=False, capture=True, verbose=verbose)
+            if result["returncode"] != 0:
+                print(f"skipping {name}, a shallow or blobless clone can't be bundled")
+                (staging / relative).unlink(missing_ok=True)
+                continue
+            manifest["files"][relative] = operations.cache.hash_file(staging / relative)
+            manifest["repos"][name] = {"file": relative, "url": url}
+
+        if save_vsdownload_manifest(config, staging / VSDOWNLOAD_MANIFEST_NAME, verbose):
+            manifest["files"][VSDOWNLOAD_MANIFEST_NAME] = operations.cache.hash_file(staging / VSDOWNLOAD_MANIFEST_NAME)
+            manifest["vsdownload_manifest"] = VSDOWNLOAD_MANIFEST_NAME
+        else:
+            print("Could not save the vsdownload.py manifest, installs from the bundle have to download it.")
+
+        checksum = write_archive(config, staging, bundle_file, BUNDLE_MANIFEST, manifest, verbose)
+        with open(checksum_file(bundle_file), "w") as f:
+            f.write(f"{checksum}  {bundle_file.name}\n")
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    print(f"exported {len(manifest['files'])} files into {bundle_file} "
+          f"({operations.utils.format_size(bundle_file.stat().st_size)})")
+
+
+def _move(source: Path, target: Path):
+    target.parent.mkdir(parents=True, exist_ok=True)
+    shutil.move(source, target)
+
+
+# Check and unpack a bundle into the destination.
+# Files that already exist are kept, so importing into an existing installation only adds what is missing.
+# Returns the bundle manifest, with the path of the installed vsdownload.py manifest.
+def import_bundle(config: operations.utils.LinuxMsvcConfig, bundle_file: Path, verbose=False) -> Dict:
+    if not bundle_file.exists():
+        print(f"There is no bundle at {bundle_file}.")
+        sys.exit(1)
+
+    if checksum_file(bundle_file).exists():
+        expected = checksum_file(bundle_file).read_text().split()[0]
+        if operations.cache.hash_file(bundle_file) != expected:
+            print(f"{bundle_file} doesn't match the checksum in {checksum_file(bundle_file)}.")
+            sys.exit(1)
+
+    cache = operations.cache.DownloadCache(config)
+    staging = Path(tempfile.mkdtemp(dir=config.destination(), prefix=".bundle-"))
+    try:
+        # tar detects the compression itself, the bundle may come from a machine without zstd
+        result = operations.runner.get_runner(config, verbose).run(["tar", "-xf", str(bundle_file), "-C", str(staging)])
+        if result["returncode"] != 0:
+            print(f"Could not unpack {bundle_file}, nothing was imported.")
+            sys.exit(1)
+
+        try:
+            with open(staging / BUNDLE_MANIFEST, "r") as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            manifest = {}
+        if manifest.get("version") != BUNDLE_VERSION:
+            print(f"{bundle_file} is not a linux-msvc bundle or was written by an incompatible version.")
+            sys.exit(1)
+
+        # everything bundle.json names must stay below the directories it is unpacked into
+        invalid = [relative for relative in manifest["files"] if not _is_relative_path(relative)]
+        invalid += [
+            download["file_name"] for download in manifest["downloads"].values()
+            if download["file"] not in manifest["files"] or Path(download["file_name"]).name != download["file_name"]
+            or download["file_name"] in ("", ".", "..")
+        ]
+        invalid += [
+            name for name, repo in manifest["repos"].items()
+            if name not in bundle_repos() or repo["file"] not in manifest["files"]
+        ]
+        if manifest["vsdownload_manifest"] is not None and manifest["vsdownload_manifest"] not in manifest["files"]:
+            invalid.append(manifest["vsdownload_manifest"])
+        if invalid:
+            for relative in invalid:
+                print(f"invalid path {relative}")
+            print(f"{bundle_file} is damaged, nothing was imported.")
+            sys.exit(1)
+
+        corrupted = corrupted_files(staging, manifest["files"])
+        if corrupted:
+            for relative in corrupted:
+                print(f"corrupted {relative}")
+            print(f"{bundle_file} is damaged, nothing was imported.")
+            sys.exit(1)
+
+        # a file can be the content of several urls, later urls get a copy of the blob the first one created
+        imported = {}
+        for download_url, download in manifest["downloads"].items():
+            entry = cache.entries().get(download_url)
+            if entry is not None and entry["sha256"] == manifest["files"][download["file"]]:
+                continue
+
+            tmp_file = cache.tmp_dir / f"import-{os.getpid()}"
+            if download["file"] in imported:
+                shutil.copyfile(imported[download["file"]], tmp_file)
+            else:
+                os.replace(staging / download["file"], tmp_file)
+            imported[download["file"]] = cache.add(download_url, tmp_file, download["file_name"])
+
+        cache_dir = config.destination() / "cache"
+        winetricks_cache = operations.tools.winetricks_cache_dir()
+        for relative in manifest["files"]:
+            if relative.startswith("vsdownload/"):
+                target = cache_dir / relative.removeprefix("vsdownload/")
+            elif relative.startswith("winetricks/"):
+                target = winetricks_cache / relative.removeprefix("winetricks/")
+            else:
+                continue
+
+            if not target.exists():
+                _move(staging / relative, target)
+
+        for name, repo in manifest["repos"].items():
+            repo_dir = config.destination() / name
+            if repo_dir.exists():
+                if verbose:
+                    print(f"keeping the existing {repo_dir}")
+                continue
+
+            operations.repos.git(config, ["clone", str(staging / repo["file"]), str(repo_dir)], verbose=verbose)
+            operations.repos.git(config, ["remote", "set-url", "origin", repo["url"]], cwd=repo_dir, verbose=verbose)
+
+        if manifest["vsdownload_manifest"] is not None:
+            target = config.destination() / VSDOWNLOAD_MANIFEST_NAME
+            os.replace(staging / manifest["vsdownload_manifest"], target)
+            manifest["vsdownload_manifest"] = str(target)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    print(f"imported {len(manifest['files'])} files from {bundle_file}")
+    return manifest
@@ -0,0 +1,330 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict
+
+import operations.bundle
+import operations.download
+import operations.mirror
+import operations.objcache
+import operations.utils
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+DEFAULT_MAX_SIZE = 20 * 1024 ** 3
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def init_subparser(subparser):
+    cache_parser = subparser.add_parser("cache", help="Manage the download cache")
+
+    cache_operation_subparser = cache_parser.add_subparsers(help="cache operation to perform", dest="cache_operation")
+    cache_operation_subparser.add_parser("ls", help="List all cached downloads")
+
+    verify_parser = cache_operation_subparser.add_parser("verify", help="Check the checksums of all cached downloads")
+    verify_parser.add_argument(
+        "--keep_corrupted",
+        action="store_true",
+        default=False,
+        help="Only report corrupted entries instead of removing them.",
+    )
+
+    gc_parser = cache_operation_subparser.add_parser("gc", help="Remove the least recently used downloads")
+    gc_parser.add_argument(
+        "--max_size",
+        default=None,
+        help="The maximum size of the cache, e.g. 500M or 10G. Defaults to the cache_max_size config value.",
+    )
+
+    export_parser = cache_operation_subparser.add_parser(
+        "export",
+        help="Write all downloads, the msvc package cache and the git repositories into one bundle",
+    )
+    export_parser.add_argument("bundle_file", help="The bundle to write, e.g. linux-msvc.tar.zst")
+
+    import_parser = cache_operation_subparser.add_parser("import", help="Add the content of a bundle to the cache")
+    import_parser.add_argument("bundle_file", help="The bundle written by 'cache export'")
+
+    serve_parser = cache_operation_subparser.add_parser(
+        "serve",
+        help="Share this cache as read-through mirror, clients use it through the mirror_url config value. "
+             "It only downloads from the hosts in the mirror_upstream_hosts config value, by default the hosts "
+             "of msvc, github and chocolatey.",
+    )
+    serve_parser.add_argument("--host", default="0.0.0.0", help="The address to listen on.")
+    serve_parser.add_argument("--port", type=int, default=operations.mirror.DEFAULT_PORT, help="The port to listen on.")
+
+    objects_parser = cache_operation_subparser.add_parser("objects", help="Show the statistics of the cl object cache")
+    objects_parser.add_argument(
+        "--zero_stats",
+        action="store_true",
+        default=False,
+        help="Reset the hit and miss counters.",
+    )
+    objects_parser.add_argument(
+        "--clear",
+        action="store_true",
+        default=False,
+        help="Remove all cached object files.",
+    )
+
+
+def hash_file(path: Path) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+# A content addressed cache for downloaded files.
+# Every file is stored as blobs/<sha256>/<file name> and manifest.json maps the download url to the blob.
+# Downloads are written to a temporary file first and only renamed into place once they are complete,
+# so an interrupted download never ends up in the cache.
+# Every url has its own lock file, which makes it safe to share a cache between many processes.
+class DownloadCache:
+    def __init__(self, config: operations.utils.LinuxMsvcConfig):
+        self.config = config
+        self.cache_dir = config.destination() / "cache"
+        self.blob_dir = self.cache_dir / "blobs"
+        self.lock_dir = self.cache_dir / "locks"
+        self.tmp_dir = self.cache_dir / "tmp"
+        self.manifest_file = self.cache_dir / "manifest.json"
+        self.max_size = operations.utils.parse_size(config.get("cache_max_size", DEFAULT_MAX_SIZE))
+
+        for directory in [self.blob_dir, self.lock_dir, self.tmp_dir]:
+            directory.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def _lock(self, name: str, blocking=True):
+        lock_file = self.lock_dir / (hashlib.sha256(name.encode()).hexdigest() + ".lock")
+        with open(lock_file, "a") as f:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(f, flags)
+            except BlockingIOError:
+                yield False
+                return
+
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_manifest(self) -> Dict:
+        try:
+            with open(self.manifest_file, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_manifest(self, manifest: Dict):
+        fd, tmp_name = tempfile.mkstemp(dir=self.tmp_dir, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp_name, self.manifest_file)
+
+    # read, modify and write the manifest while holding the manifest lock
+    def _update_manifest(self, update):
+        with self._lock("manifest.json"):
+            manifest = self._read_manifest()
+            update(manifest)
+            self._write_manifest(manifest)
+
+    def entries(self) -> Dict:
+        return self._read_manifest()
+
+    def blob_path(self, entry: Dict) -> Path:
+        return self.blob_dir / entry["sha256"] / entry["file_name"]
+
+    def _is_valid(self, entry: Dict) -> bool:
+        blob = self.blob_path(entry)
+        return blob.exists() and blob.stat().st_size == entry["size"]
+
+    # returns the full path of a cached file
+    # if it doesn't exist, download it
+    def get(self, download_url: str, file_name: str = None, verbose=False) -> Path:
+        if file_name is None:
+            file_name = os.path.basename(download_url)
+
+        with self._lock(download_url):
+            entry = self._read_manifest().get(download_url)
+            if entry is not None and entry["file_name"] == file_name and self._is_valid(entry):
+                def touch(manifest):
+                    if download_url in manifest:
+                        manifest[download_url]["last_used"] = time.time()
+
+                self._update_manifest(touch)
+                return self.blob_path(entry)
+
+            if verbose:
+                print(f"Downloading {file_name}...")
+
+            blob = self._download(download_url, file_name, verbose)
+
+        self.gc(self.max_size, verbose=verbose)
+        return blob
+
+    def _download(self, download_url: str, file_name: str, verbose=False) -> Path:
+        # the temporary name only depends on the url, so an interrupted download can be resumed
+        tmp_name = self.tmp_dir / (hashlib.sha256(download_url.encode()).hexdigest() + ".download")
+        try:
+            if not operations.mirror.fetch(self.config, download_url, tmp_name, file_name, verbose):
+                operations.download.get_downloader(self.config, verbose).download(download_url, tmp_name, file_name)
+            return self.add(download_url, tmp_name, file_name)
+        finally:
+            tmp_name.unlink(missing_ok=True)
+
+    # move a complete file into the cache and record it as the content of download_url
+    # the file must be on the same filesystem as the cache
+    def add(self, download_url: str, source_file: Path, file_name: str = None) -> Path:
+        if file_name is None:
+            file_name = os.path.basename(download_url)
+
+        entry = {
+            "sha256": hash_file(source_file),
+            "size": os.path.getsize(source_file),
+            "file_name": file_name,
+            "fetched": time.time(),
+            "last_used": time.time(),
+        }
+
+        blob = self.blob_path(entry)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(source_file, blob)
+
+        def add(manifest):
+            old_entry = manifest.get(download_url)
+            manifest[download_url] = entry
+
+            # remove the old blob of this url, unless it is still referenced
+            if old_entry is not None and self.blob_path(old_entry) != blob:
+                still_used = any(self.blob_path(other) == self.blob_path(old_entry) for other in manifest.values())
+                if not still_used:
+                    self.blob_path(old_entry).unlink(missing_ok=True)
+
+        self._update_manifest(add)
+        return blob
+
+    # removes an entry from the manifest and deletes its blob if no other url refers to it
+    def _drop(self, download_url: str):
+        def drop(manifest):
+            entry = manifest.pop(download_url, None)
+            if entry is None:
+                return
+
+            if not any(self.blob_path(other) == self.blob_path(entry) for other in manifest.values()):
+                self.blob_path(entry).unlink(missing_ok=True)
+
+            if not any(other["sha256"] == entry["sha256"] for other in manifest.values()):
+                shutil.rmtree(self.blob_dir / entry["sha256"], ignore_errors=True)
+
+        self._update_manifest(drop)
+
+    def total_size(self) -> int:
+        blobs = {entry["sha256"]: entry["size"] for entry in self.entries().values()}
+        return sum(blobs.values())
+
+    # hash every blob and remove the entries that don't match their checksum
+    # returns the urls of all corrupted entries
+    def verify(self, remove_corrupted=True, verbose=False) -> list:
+        corrupted = []
+        for download_url, entry in self.entries().items():
+            with self._lock(download_url):
+                blob = self.blob_path(entry)
+                if blob.exists() and hash_file(blob) == entry["sha256"]:
+                    if verbose:
+                        print(f"ok        {entry['file_name']}")
+                    continue
+
+                print(f"corrupted {entry['file_name']} ({download_url})")
+                corrupted.append(download_url)
+                if remove_corrupted:
+                    self._drop(download_url)
+
+        return corrupted
+
+    # evict the least recently used entries until the cache is at most max_size bytes big
+    # entries that are currently locked by another process are skipped
+    def gc(self, max_size: int, verbose=False) -> int:
+        freed = 0
+        entries = sorted(self.entries().items(), key=lambda item: item[1].get("last_used", 0))
+
+        total = self.total_size()
+        for download_url, entry in entries:
+            if total <= max_size:
+                break
+
+            with self._lock(download_url, blocking=False) as locked:
+                if not locked:
+                    continue
+
+                if verbose:
+                    print(f"evicting {entry['file_name']} ({operations.utils.format_size(entry['size'])})")
+
+                self._drop(download_url)
+
+            new_total = self.total_size()
+            freed += total - new_total
+            total = new_total
+
+        # clean up temporary files of crashed downloads
+        for tmp_file in self.tmp_dir.iterdir():
+            if time.time() - tmp_file.stat().st_mtime > 24 * 60 * 60:
+                tmp_file.unlink(missing_ok=True)
+
+        return freed
+
+
+def cache_command(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    cache = DownloadCache(config)
+
+    match args["cache_operation"]:
+        case "ls":
+            for download_url, entry in cache.entries().items():
+                last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.get("last_used", 0)))
+                print(f"{entry['sha256'][:12]}  {operations.utils.format_size(entry['size']):>8}  {last_used}  {download_url}")
+            print(f"total: {operations.utils.format_size(cache.total_size())} of {operations.utils.format_size(cache.max_size)}")
+
+        case "verify":
+            corrupted = cache.verify(remove_corrupted=not args["keep_corrupted"], verbose=args["verbose"])
+            if corrupted:
+                print(f"{len(corrupted)} corrupted entries found.")
+                sys.exit(1)
+            print("All cached files are valid.")
+
+        case "gc":
+            max_size = cache.max_size if args["max_size"] is None else operations.utils.parse_size(args["max_size"])
+            freed = cache.gc(max_size, verbose=args["verbose"])
+            print(f"freed {operations.utils.format_size(freed)}, the cache now uses {operations.utils.format_size(cache.total_size())}.")
+
+        case "export":
+            operations.bundle.export_bundle(config, Path(args["bundle_file"]).expanduser(), verbose=args["verbose"])
+
+        case "import":
+            operations.bundle.import_bundle(config, Path(args["bundle_file"]).expanduser(), verbose=args["verbose"])
+
+        case "serve":
+            operations.mirror.serve(config, args)
+
+        case "objects":
+            object_cache = operations.objcache.ObjectCache(config)
+            if args["clear"]:
+                object_cache.clear()
+            if args["zero_stats"]:
+                object_cache.zero_stats()
+
+            operations.objcache.print_stats(config)
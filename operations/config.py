@@ -1,11 +1,10 @@
-import os
 import sys
-from pathlib import Path
 from typing import Dict
 
 import operations.utils
 import operations.remove
 import operations.install
+import operations.prefix
 
 # don't allow running the file as script
 if __name__ == "__main__":
@@ -24,11 +23,19 @@ def init_subparser(subparser):
         choices=["all", "wine_prefix", "msvc"],
     )
 
+    components_parser = conf_operation_subparser.add_parser(
+        "components",
+        help="Show or change which msvc architectures, versions and packages are installed",
+    )
+    operations.install.add_component_arguments(components_parser, defaults=False)
+
 
 def configure(config: operations.utils.LinuxMsvcConfig, args: Dict):
     match args["conf_operation"]:
         case "reset":
             reset(config, args)
+        case "components":
+            components(config, args)
 
 
 def reset(config: operations.utils.LinuxMsvcConfig, args: Dict):
@@ -42,17 +49,36 @@ def reset(config: operations.utils.LinuxMsvcConfig, args: Dict):
             reset_msvc(config, verbose=args["verbose"])
 
 
+# change the msvc selection, it is installed by the next update
+def components(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    if config.get("destination") is None:
+        print("No config file exists, please install linux-msvc first.")
+        sys.exit(1)
+
+    selection = operations.install.component_selection(args, config.msvc_components())
+    if selection != config.msvc_components():
+        config["msvc_components"] = selection
+        config.save()
+        print("Run 'linux-msvc update' to install the new selection.")
+
+    for key, value in selection.items():
+        print(f"{key}: {value}")
+
+
 def reset_prefix(config: operations.utils.LinuxMsvcConfig, verbose=False):
-    if not config["no_wine_prefix"]:
-        prefix_location = Path(config["destination"]).expanduser() / ".wineenv"
-    else:
-        if os.environ["WINEPREFIX"]:
-            prefix_location = Path(os.environ["WINEPREFIX"])
-        else:
-            prefix_location = Path("~/.wine").expanduser()
+    # restoring a template takes seconds, setting up a new prefix takes more than half an hour
+    if operations.prefix.has_template(config):
+        operations.prefix.restore(config, verbose=verbose)
+        return
+
+    prefix_location = operations.prefix.prefix_location(config)
 
     try:
-        operations.remove.RemoveDirectory(prefix_location, verbose=verbose, directory_name="wine prefix").remove()
+        operations.remove.RemoveDirectory(
+            prefix_location,
+            verbose=verbose,
+            directory_name="wine prefix",
+        ).remove(background=True)
     except FileNotFoundError:
         pass
 
@@ -64,14 +90,21 @@ def reset_prefix(config: operations.utils.LinuxMsvcConfig, verbose=False):
 
 def reset_msvc(config: operations.utils.LinuxMsvcConfig, verbose=False):
     msvc_dir = config.destination() / "msvc"
-    msvc_wine_dir = config.destination() / "msvc-wine-repo"
 
+    # the msvc-wine checkout is kept, setup_msvc moves it to the pinned commit if there is one
     try:
-        operations.remove.RemoveDirectory(msvc_dir, verbose=verbose, directory_name="msvc_install").remove()
-        operations.remove.RemoveDirectory(msvc_wine_dir, verbose=verbose, directory_name="msvc_wine_repo").remove()
+        operations.remove.RemoveDirectory(
+            msvc_dir,
+            verbose=verbose,
+            directory_name="msvc_install",
+        ).remove(background=True)
     except FileNotFoundError:
         pass
 
     operations.install.setup_msvc(config, verbose=verbose)
 
+    config.update(operations.utils.detect_toolchain_versions(config))
+    if config.get("create_config_file", True):
+        config.save()
+
 
@@ -0,0 +1,157 @@
+import hashlib
+import os
+import shutil
+import sys
+
+from pathlib import Path
+from typing import Dict, List
+
+import operations.setenv
+import operations.utils
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+CROSS_FILE_NAME = "wine_msvc"
+POOL_CROSS_FILE_NAME = "wine_msvc_pool"
+EXE_WRAPPER_NAME = "linux-msvc-wine"
+STAMP_PREFIX = "# linux-msvc stamp: "
+# the meson cpu family and cpu of the msvc target architectures
+HOST_MACHINES = {
+    "x64": ("x86_64", "x86_64"),
+    "x86": ("x86", "i686"),
+    "arm": ("arm", "armv7"),
+    "arm64": ("aarch64", "aarch64"),
+}
+
+
+def cross_file_path(config: operations.utils.LinuxMsvcConfig, prefix_pool=False) -> Path:
+    return config.destination() / "cross_files" / (POOL_CROSS_FILE_NAME if prefix_pool else CROSS_FILE_NAME)
+
+
+def exe_wrapper_path(config: operations.utils.LinuxMsvcConfig) -> Path:
+    return config.destination() / "bin" / EXE_WRAPPER_NAME
+
+
+# the generated files only have to be written again if the environment or the location of linux-msvc changed
+def stamp(config: operations.utils.LinuxMsvcConfig) -> str:
+    state = "\0".join([
+        operations.utils.get_env_snapshot(config)["fingerprint"],
+        sys.executable,
+        str(REPO_DIR),
+    ])
+    return hashlib.sha256(state.encode()).hexdigest()
+
+
+def _read_stamp(path: Path) -> str:
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                if line.startswith(STAMP_PREFIX):
+                    return line[len(STAMP_PREFIX):].strip()
+    except FileNotFoundError:
+        pass
+
+    return None
+
+
+# the absolute path of a tool from the msvc installation, or just its name if it can't be found
+def _tool(snapshot: Dict, name: str) -> str:
+    path = shutil.which(name, path=":".join(snapshot["path"]))
+    return path if path is not None else name
+
+
+def _meson_string(value: str) -> str:
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def _meson_list(values: List[str]) -> str:
+    return "[" + ", ".join(_meson_string(value) for value in values) + "]"
+
+
+# A shell script that runs wine-msvc.sh with the environment snapshot.
+# meson starts the exe_wrapper once per test, so it must not start python.
+def exe_wrapper_script(config: operations.utils.LinuxMsvcConfig, current_stamp: str) -> str:
+    snapshot = operations.utils.get_env_snapshot(config)
+
+    lines = [
+        "#!/bin/sh",
+        STAMP_PREFIX + current_stamp,
+        f"export PATH={operations.setenv.quote(':'.join(snapshot['path']), 'bash')}\"${{PATH:+:$PATH}}\"",
+    ]
+    for key, value in snapshot["variables"].items():
+        lines.append(f"export {key}={operations.setenv.quote(value, 'bash')}")
+
+    # a job of 'linux-msvc pool exec' brings its own prefix
+    lines.append(f'export WINEPREFIX="${{{operations.utils.LEASED_PREFIX_ENV}:-$WINEPREFIX}}"')
+
+    lines.append('export WINEDEBUG="${WINEDEBUG--all}"')
+    lines.append(f"exec {operations.setenv.quote(_tool(snapshot, 'wine-msvc.sh'), 'bash')} \"$@\"")
+    return "\n".join(lines) + "\n"
+
+
+# the cross file with absolute paths, so meson neither needs the environment nor the linux-msvc wrapper script
+def cross_file_text(config: operations.utils.LinuxMsvcConfig, current_stamp: str, prefix_pool=False) -> str:
+    snapshot = operations.utils.get_env_snapshot(config)
+
+    # the compiler goes through the object cache, started without the wrapper script and pipenv
+    linux_msvc = [sys.executable, str(REPO_DIR / "linux-msvc.py")]
+    compiler = linux_msvc + ["cl"]
+
+    # the pool has to lease a prefix for every test, which needs python
+    if prefix_pool:
+        exe_wrapper = _meson_list(linux_msvc + ["pool", "run"])
+    else:
+        exe_wrapper = _meson_string(str(exe_wrapper_path(config)))
+
+    cpu_family, cpu = HOST_MACHINES[config.architectures()[0]]
+
+    return "\n".join([
+        STAMP_PREFIX + current_stamp,
+        "[binaries]",
+        f"c = {_meson_list(compiler)}",
+        f"c_ld = {_meson_string(_tool(snapshot, 'link'))}",
+        f"cpp = {_meson_list(compiler)}",
+        f"cpp_ld = {_meson_string(_tool(snapshot, 'link'))}",
+        f"strip = {_meson_string(_tool(snapshot, 'link'))}",
+        f"exe_wrapper = {exe_wrapper}",
+        "",
+        "[properties]",
+        "needs_exe_wrapper = true",
+        "",
+        "[host_machine]",
+        "system = 'windows'",
+        f"cpu_family = {_meson_string(cpu_family)}",
+        f"cpu = {_meson_string(cpu)}",
+        "endian = 'little'",
+    ]) + "\n"
+
+
+def _write(path: Path, content: str, mode: int):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.chmod(tmp_path, mode)
+    os.replace(tmp_path, path)
+
+
+# returns the cross file of this installation, it is generated if it is missing or outdated
+def get_cross_file(config: operations.utils.LinuxMsvcConfig, verbose=False, prefix_pool=False) -> Path:
+    current_stamp = stamp(config)
+    cross_file = cross_file_path(config, prefix_pool)
+    exe_wrapper = exe_wrapper_path(config)
+
+    if _read_stamp(cross_file) == current_stamp and _read_stamp(exe_wrapper) == current_stamp:
+        return cross_file
+
+    if verbose:
+        print(f"generating {cross_file} and {exe_wrapper}")
+
+    _write(exe_wrapper, exe_wrapper_script(config, current_stamp), 0o755)
+    _write(cross_file, cross_file_text(config, current_stamp, prefix_pool), 0o644)
+    return cross_file
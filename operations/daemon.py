@@ -0,0 +1,336 @@
+import collections
+import json
+import os
+import queue
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+from pathlib import Path
+from typing import Dict, List
+
+import operations.utils
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+# environment variables a client may override for a single request
+PASSTHROUGH_ENV = ["WINEDEBUG", "INCLUDE", "LIB", "LIBPATH", "CL", "_CL_", "LINK", "_LINK_"]
+LATENCY_SAMPLES = 1000
+
+
+def init_subparser(subparser):
+    daemon_parser = subparser.add_parser(
+        "daemon",
+        help="Keep the wineserver running and serve 'linux-msvc wine', 'cl' and 'link' calls from a queue. "
+             "Every call still starts its own wine process, the daemon saves the environment setup and the "
+             "wineserver startup of each call.",
+    )
+
+    daemon_operation_subparser = daemon_parser.add_subparsers(help="daemon operation to perform", dest="daemon_operation")
+    start_parser = daemon_operation_subparser.add_parser("start", help="Start the daemon")
+    daemon_operation_subparser.add_parser("stop", help="Stop the daemon")
+    daemon_operation_subparser.add_parser("status", help="Show the queue depth and request latencies")
+
+    start_parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="How many requests are executed at the same time. Defaults to the number of cpus.",
+    )
+
+    start_parser.add_argument(
+        "--foreground",
+        action="store_true",
+        default=False,
+        help="Don't detach from the terminal.",
+    )
+
+
+def socket_path(config: operations.utils.LinuxMsvcConfig) -> Path:
+    return config.destination() / "run" / "daemon.sock"
+
+
+# A request of a client, which is executed by one of the workers.
+# The client passes its stdin, stdout and stderr along, so the output goes straight to the client.
+class Job(Dict):
+    def __init__(self, argv: List[str], cwd: str, env: Dict, fds: List[int]):
+        super().__init__()
+        self["argv"] = argv
+        self["cwd"] = cwd
+        self["env"] = env
+        self["fds"] = fds
+        self["queued"] = time.monotonic()
+        self["returncode"] = None
+        self["done"] = threading.Event()
+
+
+class DaemonState:
+    def __init__(self, workers: int, verbose=False):
+        self.jobs = queue.Queue()
+        self.workers = max(1, workers)
+        self.verbose = verbose
+        self.busy = 0
+        self.served = 0
+        self.failed = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.queue_times = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def worker(self):
+        while True:
+            job = self.jobs.get()
+            started = time.monotonic()
+            with self.lock:
+                self.busy += 1
+
+            try:
+                env = dict(os.environ)
+                env.update(job["env"])
+                stdin, stdout, stderr = job["fds"]
+                job["returncode"] = subprocess.run(
+                    job["argv"],
+                    cwd=job["cwd"],
+                    env=env,
+                    stdin=stdin,
+                    stdout=stdout,
+                    stderr=stderr,
+                ).returncode
+            except OSError as e:
+                os.write(job["fds"][2], f"linux-msvc daemon: {e}\n".encode())
+                job["returncode"] = 127
+            finally:
+                finished = time.monotonic()
+                with self.lock:
+                    self.busy -= 1
+                    self.served += 1
+                    if job["returncode"] != 0:
+                        self.failed += 1
+                    self.queue_times.append(started - job["queued"])
+                    self.latencies.append(finished - job["queued"])
+
+                if self.verbose:
+                    print(f"{finished - job['queued']:.3f}s exit {job['returncode']}: {' '.join(job['argv'])}")
+
+                job["done"].set()
+
+    def status(self) -> Dict:
+        with self.lock:
+            latencies = sorted(self.latencies)
+            queue_times = sorted(self.queue_times)
+
+            def percentile(values, p):
+                if not values:
+                    return None
+                return values[min(len(values) - 1, int(len(values) * p))]
+
+            return {
+                "pid": os.getpid(),
+                "uptime": time.time() - self.started,
+                "workers": self.workers,
+                "busy": self.busy,
+                "queue_depth": self.jobs.qsize(),
+                "served": self.served,
+                "failed": self.failed,
+                "latency_p50": percentile(latencies, 0.5),
+                "latency_p95": percentile(latencies, 0.95),
+                "queue_time_p50": percentile(queue_times, 0.5),
+                "queue_time_p95": percentile(queue_times, 0.95),
+            }
+
+
+class DaemonRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        state: DaemonState = self.server.state
+
+        message, fds, _, _ = socket.recv_fds(self.request, 1024 * 1024, 3)
+        request = json.loads(message.decode())
+
+        try:
+            match request["command"]:
+                case "run":
+                    job = Job(request["argv"], request["cwd"], request["env"], fds)
+                    state.jobs.put(job)
+                    # from here on the client must not run the command itself, whatever happens
+                    self._reply({"accepted": True})
+                    job["done"].wait()
+                    self._reply({"returncode": job["returncode"]})
+                case "status":
+                    self._reply(state.status())
+                case "stop":
+                    self._reply({"stopping": True})
+                    threading.Thread(target=self.server.shutdown).start()
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def _reply(self, reply: Dict):
+        self.request.sendall(json.dumps(reply).encode() + b"\n")
+
+
+class DaemonServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+# run the daemon in the current process until it is stopped
+def serve(config: operations.utils.LinuxMsvcConfig, workers: int, verbose=False):
+    # not imported at the top, the clients of the daemon are on the path of every wine and cl call
+    import operations.runner
+
+    path = socket_path(config)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    if is_running(config):
+        print("The daemon is already running.")
+        sys.exit(1)
+    path.unlink(missing_ok=True)
+
+    # everything expensive happens once here instead of once per call
+    operations.utils.set_env(config, {}, verbose)
+    runner = operations.runner.get_runner(config, verbose)
+    runner.run(["wineserver", "-p"], timeout=operations.runner.WINESERVER_TIMEOUT)
+    runner.run(["wine", "wineboot"], timeout=operations.runner.WINEBOOT_TIMEOUT)
+
+    state = DaemonState(workers, verbose)
+    for _ in range(state.workers):
+        threading.Thread(target=state.worker, daemon=True).start()
+
+    with DaemonServer(str(path), DaemonRequestHandler) as server:
+        server.state = state
+        os.chmod(path, 0o600)
+        print(f"linux-msvc daemon listening on {path} with {state.workers} workers")
+        try:
+            server.serve_forever()
+        finally:
+            path.unlink(missing_ok=True)
+
+
+def _connect(config: operations.utils.LinuxMsvcConfig) -> socket.socket:
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(str(socket_path(config)))
+    except OSError:
+        client.close()
+        raise
+
+    return client
+
+
+def _request(config: operations.utils.LinuxMsvcConfig, request: Dict, fds: List[int] = None) -> Dict:
+    with _connect(config) as client:
+        socket.send_fds(client, [json.dumps(request).encode()], fds or [])
+        with client.makefile("r") as reply:
+            line = reply.readline()
+
+    if not line:
+        raise ConnectionError("The daemon closed the connection without a reply.")
+
+    return json.loads(line)
+
+
+def is_running(config: operations.utils.LinuxMsvcConfig) -> bool:
+    try:
+        _connect(config).close()
+        return True
+    except OSError:
+        return False
+
+
+# run a command through the daemon
+# fds are the stdin, stdout and stderr of the command and default to the ones of this process
+# returns the exit code, or None if no daemon is running and the caller has to run the command itself
+# once the daemon accepted the command it is never run again, a lost connection then only fails the call
+def run(config: operations.utils.LinuxMsvcConfig, argv: List[str], fds: List[int] = None) -> int:
+    # the daemon runs everything in the prefix of the installation, not in the one leased by a pool job
+    if not socket_path(config).exists() or os.environ.get(operations.utils.LEASED_PREFIX_ENV):
+        return None
+
+    request = {
+        "command": "run",
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "env": {key: os.environ[key] for key in PASSTHROUGH_ENV if key in os.environ},
+    }
+
+    try:
+        client = _connect(config)
+    except OSError:
+        return None
+
+    with client, client.makefile("r") as reply:
+        try:
+            socket.send_fds(client, [json.dumps(request).encode()], fds or [0, 1, 2])
+            accepted = reply.readline()
+        except OSError:
+            return None
+        if not accepted:
+            return None
+
+        try:
+            line = reply.readline()
+        except OSError:
+            line = ""
+
+    if not line:
+        print(f"linux-msvc: lost the connection to the daemon while it ran {' '.join(argv)}", file=sys.stderr)
+        return 1
+
+    return json.loads(line)["returncode"]
+
+
+def daemon_command(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    match args["daemon_operation"]:
+        case "start":
+            if args["foreground"]:
+                serve(config, args["workers"], args["verbose"])
+                return
+
+            if is_running(config):
+                print("The daemon is already running.")
+                return
+
+            log_file = socket_path(config).parent / "daemon.log"
+            log_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(log_file, "a") as log:
+                subprocess.Popen(
+                    [sys.executable, os.path.abspath(sys.argv[0]), "daemon", "start", "--foreground",
+                     "--workers", str(args["workers"])],
+                    stdin=subprocess.DEVNULL,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                    start_new_session=True,
+                )
+
+            for _ in range(600):
+                if is_running(config):
+                    print(f"The daemon is running, the log is written to {log_file}")
+                    return
+                time.sleep(0.1)
+
+            print(f"The daemon did not start, check {log_file} for details.")
+            sys.exit(1)
+
+        case "stop":
+            if not is_running(config):
+                print("The daemon is not running.")
+                return
+
+            _request(config, {"command": "stop"})
+            print("The daemon was stopped.")
+
+        case "status":
+            if not is_running(config):
+                print("The daemon is not running.")
+                sys.exit(1)
+
+            for key, value in _request(config, {"command": "status"}).items():
+                if isinstance(value, float):
+                    value = f"{value:.3f}"
+                print(f"{key}: {value}")
@@ -0,0 +1,251 @@
+import errno
+import fcntl
+import json
+import os
+import shutil
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+import operations.cache
+import operations.remove
+import operations.utils
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+# ioctl request of linux to share the extents of one file with another (a reflink)
+FICLONE = 0x40049409
+DEFAULT_MIN_SIZE = 64 * 1024
+# directories that are never touched, they are either temporary or about to be deleted
+SKIPPED_DIRS = {operations.remove.TRASH_DIR_NAME, "tmp", "locks", "run"}
+
+
+def init_subparser(subparser):
+    dedupe_parser = subparser.add_parser(
+        "dedupe",
+        help="Replace identical files in the cache, msvc installation and prefixes with reflinks or hardlinks",
+    )
+
+    dedupe_parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=os.cpu_count(),
+        help="How many files are hashed at the same time.",
+    )
+
+    dedupe_parser.add_argument(
+        "--min_size",
+        default=str(DEFAULT_MIN_SIZE),
+        help="Ignore files smaller than this, e.g. 64K.",
+    )
+
+    dedupe_parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        default=False,
+        help="Only report how much space could be saved.",
+    )
+
+
+# The directories that are deduplicated, and whether hardlinks may be used in them.
+# A write into a hardlinked file changes every copy, so hardlinks are only used for the download blobs,
+# which are never written in place but replaced as a whole. vsdownload.py extracts into the rest of the cache
+# and msvc again, and wine changes files inside prefixes, so they only get reflinks, which are copy on write.
+# A nested root comes after the one it is in and wins for its files.
+def dedupe_roots(config: operations.utils.LinuxMsvcConfig) -> Dict[Path, bool]:
+    return {
+        config.destination() / "cache": False,
+        config.destination() / "cache" / "blobs": True,
+        config.destination() / "msvc": False,
+        config.destination() / "templates": False,
+        config.destination() / ".wineenv": False,
+    }
+
+
+# whether a file is still the one that was hashed
+def _unchanged(path: str, stat: os.stat_result) -> bool:
+    try:
+        current = os.lstat(path)
+    except FileNotFoundError:
+        return False
+
+    return HashIndex._key(current) == HashIndex._key(stat)
+
+
+class HashIndex:
+    def __init__(self, index_file: Path):
+        self.index_file = index_file
+        try:
+            with open(index_file, "r") as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+    @staticmethod
+    def _key(stat: os.stat_result) -> List[int]:
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    # returns the stored hash if the file didn't change since it was hashed
+    def lookup(self, path: str, stat: os.stat_result) -> str:
+        entry = self.entries.get(path)
+        if entry is not None and entry[:3] == self._key(stat):
+            return entry[3]
+
+        return None
+
+    def store(self, path: str, stat: os.stat_result, sha256: str):
+        self.entries[path] = self._key(stat) + [sha256]
+
+    def save(self, existing_paths: set):
+        self.entries = {path: entry for path, entry in self.entries.items() if path in existing_paths}
+
+        tmp_file = self.index_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_file, self.index_file)
+
+
+# collect all regular files of a root directory that are at least min_size big
+def scan(root: Path, min_size: int) -> Dict[str, os.stat_result]:
+    files = {}
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if name not in SKIPPED_DIRS]
+        for name in filenames:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.lstat(path)
+            except FileNotFoundError:
+                continue
+
+            if stat.st_size >= min_size and not os.path.islink(path):
+                files[path] = stat
+
+    return files
+
+
+def reflink(source: str, target: str) -> bool:
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EBADF):
+                return False
+            raise
+
+
+# replace target with a reflink or hardlink of source
+# the new file is created next to the target and renamed over it, so the target is never missing
+# returns the method that was used or None if neither is possible
+def link_file(source: str, target: str, allow_hardlink: bool) -> str:
+    tmp_target = target + ".dedupe-tmp"
+    try:
+        if reflink(source, tmp_target):
+            shutil.copystat(target, tmp_target)
+            os.replace(tmp_target, target)
+            return "reflink"
+    finally:
+        if os.path.exists(tmp_target):
+            os.unlink(tmp_target)
+
+    if not allow_hardlink:
+        return None
+
+    try:
+        os.link(source, tmp_target)
+    except OSError:
+        return None
+
+    os.replace(tmp_target, target)
+    return "hardlink"
+
+
+def dedupe(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    start = time.monotonic()
+    min_size = operations.utils.parse_size(args["min_size"])
+    verbose = args["verbose"]
+
+    files = {}
+    hardlink_allowed = {}
+    for root, allow_hardlink in dedupe_roots(config).items():
+        if not root.exists():
+            continue
+        for path, stat in scan(root, min_size).items():
+            files[path] = stat
+            hardlink_allowed[path] = allow_hardlink
+
+    # only files with the same size can be identical, all others don't need to be hashed
+    by_size = {}
+    for path, stat in files.items():
+        by_size.setdefault(stat.st_size, []).append(path)
+    candidates = [path for paths in by_size.values() if len(paths) > 1 for path in paths]
+
+    index_file = config.destination() / "cache" / "dedupe-index.json"
+    index_file.parent.mkdir(parents=True, exist_ok=True)
+    index = HashIndex(index_file)
+
+    to_hash = [path for path in candidates if index.lookup(path, files[path]) is None]
+    if verbose:
+        print(f"{len(files)} files, {len(candidates)} with a duplicate size, {len(to_hash)} need hashing")
+
+    with ThreadPoolExecutor(max_workers=max(1, args["jobs"])) as executor:
+        for path, sha256 in zip(to_hash, executor.map(operations.cache.hash_file, to_hash)):
+            index.store(path, files[path], sha256)
+
+    by_hash = {}
+    for path in candidates:
+        by_hash.setdefault(index.lookup(path, files[path]), []).append(path)
+
+    saved = 0
+    linked = {"reflink": 0, "hardlink": 0}
+    for sha256, paths in by_hash.items():
+        if len(paths) < 2:
+            continue
+
+        # prefer a file that may be hardlinked as source, so hardlinks can be used for the others
+        paths.sort(key=lambda p: (not hardlink_allowed[p], p))
+        source = paths[0]
+        source_stat = files[source]
+
+        for target in paths[1:]:
+            target_stat = files[target]
+            if (target_stat.st_dev, target_stat.st_ino) == (source_stat.st_dev, source_stat.st_ino):
+                continue
+
+            # a hardlink shares the permissions, so only files with the same mode are hardlinked
+            allow_hardlink = hardlink_allowed[source] and hardlink_allowed[target] and \
+                target_stat.st_mode == source_stat.st_mode and target_stat.st_dev == source_stat.st_dev
+
+            if args["dry_run"]:
+                saved += target_stat.st_size
+                continue
+
+            # the prefix and the cache are in use while this runs, a file that changed since it was hashed is skipped
+            if not _unchanged(source, source_stat) or not _unchanged(target, target_stat):
+                if verbose:
+                    print(f"skipping {target}, it or {source} changed since it was hashed")
+                continue
+
+            method = link_file(source, target, allow_hardlink)
+            if method is None:
+                continue
+
+            linked[method] += 1
+            saved += target_stat.st_size
+            index.store(target, os.lstat(target), sha256)
+            if verbose:
+                print(f"{method}: {target} -> {source}")
+
+    index.save(set(files))
+
+    verb = "could save" if args["dry_run"] else "saved"
+    print(f"{verb} {operations.utils.format_size(saved)} with {linked['reflink']} reflinks and "
+          f"{linked['hardlink']} hardlinks in {time.monotonic() - start:.1f}s")
@@ -0,0 +1,449 @@
+import json
+import os
+import random
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import operations.pool
+import operations.runner
+import operations.utils
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+PROTOCOL_VERSION = 1
+DEFAULT_PORT = 8766
+# the workers to use instead of the ones in the config, as comma separated host:port list
+WORKERS_ENV = "LINUX_MSVC_DISTCL_WORKERS"
+# how long a worker gets to answer a status request, a slow worker is skipped for this compilation
+STATUS_TIMEOUT = 1.0
+# a worker that could not be reached is not asked again for this long
+DOWN_INTERVAL = 30
+COMPRESSION_LEVEL = 1
+# the only flags a worker runs, they change how the preprocessed source is compiled
+# anything else could write files next to the object, read files of the worker or run another program, like /B1
+# cl flags are case sensitive, so are the prefixes
+ALLOWED_FLAGS = ("O", "GS", "Gs", "Gy", "Gw", "GR", "GF", "GL", "GT", "Gd", "Gr", "Gv", "Gz", "Gh", "GH", "guard:",
+                 "EH", "MD", "MT", "W", "w", "Z7", "Zc:", "Zp", "Zl", "Zo", "std:", "permissive", "arch:", "fp:",
+                 "utf-8", "source-charset:", "execution-charset:", "validate-charset", "J", "RTC", "sdl", "bigobj",
+                 "volatile:", "favor:", "Qspectre", "Qpar", "QIntel-jcc-erratum", "TC", "TP", "diagnostics:",
+                 "external:W", "external:anglebrackets", "constexpr:", "openmp", "hotpatch", "kernel")
+
+
+def init_subparser(subparser):
+    distcl_parser = subparser.add_parser(
+        "distcl",
+        help="Spread the compilations of 'linux-msvc cl' over workers on this and other hosts",
+    )
+
+    distcl_operation_subparser = distcl_parser.add_subparsers(help="distcl operation to perform", dest="distcl_operation")
+    worker_parser = distcl_operation_subparser.add_parser(
+        "worker",
+        help="Compile preprocessed sources sent by other hosts. Only run it in a trusted network.",
+    )
+    add_parser = distcl_operation_subparser.add_parser("add", help="Send compilations to these workers")
+    remove_parser = distcl_operation_subparser.add_parser("remove", help="Stop sending compilations to these workers")
+    distcl_operation_subparser.add_parser("status", help="Show the load of all workers")
+
+    worker_parser.add_argument("--host", default="0.0.0.0", help="The address to listen on.")
+    worker_parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="The port to listen on.")
+    worker_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="How many compilations run at the same time. Defaults to the size of the prefix pool, every "
+             "compilation runs in a prefix of its own. Without a pool, all of them share the wine prefix and "
+             "it defaults to the number of cpus.",
+    )
+
+    add_parser.add_argument("workers", nargs="+", metavar="HOST:PORT", help="The workers to add")
+    remove_parser.add_argument("workers", nargs="+", metavar="HOST:PORT", help="The workers to remove")
+
+
+# the compiler a worker must have to compile for this host, the path of cl doesn't matter
+def toolchain(config: operations.utils.LinuxMsvcConfig) -> Dict:
+    return {
+        "msvc_version": config.get("msvc_version"),
+        "sdk_version": config.get("sdk_version"),
+        "architecture": config.architectures()[0],
+    }
+
+
+def configured_workers(config: operations.utils.LinuxMsvcConfig) -> List[str]:
+    if os.environ.get(WORKERS_ENV) is not None:
+        return [worker.strip() for worker in os.environ[WORKERS_ENV].split(",") if worker.strip()]
+
+    return config.get("distcl_workers") or []
+
+
+def enabled(config: operations.utils.LinuxMsvcConfig) -> bool:
+    return len(configured_workers(config)) > 0
+
+
+def _address(worker: str) -> Tuple[str, int]:
+    host, _, port = worker.rpartition(":")
+    if not host:
+        return port, DEFAULT_PORT
+
+    return host.strip("[]"), int(port)
+
+
+# Every message is a json line, followed by the payloads whose sizes it lists in "sizes".
+def _send(connection: socket.socket, header: Dict, payloads: List[bytes] = None):
+    payloads = payloads or []
+    header = dict(header, sizes=[len(payload) for payload in payloads])
+    connection.sendall(json.dumps(header).encode() + b"\n" + b"".join(payloads))
+
+
+def _receive(stream) -> Tuple[Dict, List[bytes]]:
+    line = stream.readline()
+    if not line:
+        raise ConnectionError("The connection was closed without a message.")
+
+    header = json.loads(line)
+    payloads = []
+    for size in header.get("sizes", []):
+        payload = stream.read(size)
+        if len(payload) != size:
+            raise ConnectionError("The connection was closed in the middle of a message.")
+        payloads.append(payload)
+
+    return header, payloads
+
+
+class WorkerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        worker: Worker = self.server.worker
+        try:
+            request, payloads = _receive(self.rfile)
+        except (ConnectionError, ValueError):
+            return
+
+        if request.get("version") != PROTOCOL_VERSION:
+            _send(self.request, {"error": f"this worker speaks version {PROTOCOL_VERSION} of the protocol"})
+            return
+
+        match request.get("command"):
+            case "status":
+                _send(self.request, worker.status())
+            case "compile":
+                reply, reply_payloads = worker.compile(request, payloads)
+                _send(self.request, reply, reply_payloads)
+            case _:
+                _send(self.request, {"error": f"unknown command {request.get('command')}"})
+
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# Compiles preprocessed sources, each compilation in a prefix leased from the prefix pool.
+# A single wineserver serializes much of the work of all wine processes in its prefix,
+# so compilations only scale with the cores if every one of them has a prefix of its own.
+class Worker:
+    def __init__(self, config: operations.utils.LinuxMsvcConfig, jobs: int = None, verbose=False):
+        self.config = config
+        self.pool = operations.pool.PrefixPool(config)
+        self.use_pool = len(self.pool.slots()) > 0
+        if jobs is None:
+            jobs = len(self.pool.slots()) if self.use_pool else os.cpu_count() or 1
+
+        self.jobs = max(1, jobs)
+        self.verbose = verbose
+        self.toolchain = toolchain(config)
+        self.slots = threading.Semaphore(self.jobs)
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.queued = 0
+        self.served = 0
+        self.failed = 0
+
+    def status(self) -> Dict:
+        with self.lock:
+            return {
+                "toolchain": self.toolchain,
+                "jobs": self.jobs,
+                "busy": self.busy,
+                "queued": self.queued,
+                "served": self.served,
+                "failed": self.failed,
+                "load": os.getloadavg()[0] / (os.cpu_count() or 1),
+            }
+
+    # the environment of a compilation, with a prefix that nobody else uses while the lease is held
+    @contextmanager
+    def _prefix(self):
+        env = dict(os.environ)
+        if not self.use_pool:
+            yield env
+            return
+
+        with self.pool.lease() as (index, lock):
+            env["WINEPREFIX"] = str(self.pool.slot_dir(index))
+            yield env
+
+    @staticmethod
+    def _rejected(args: List[str]) -> str:
+        for arg in args:
+            if arg[:1] not in ("/", "-"):
+                return f"{arg} is not a flag"
+            if not arg[1:].startswith(ALLOWED_FLAGS):
+                return f"{arg} is not allowed"
+
+        return None
+
+    def compile(self, request: Dict, payloads: List[bytes]) -> Tuple[Dict, List[bytes]]:
+        if request.get("toolchain") != self.toolchain:
+            return {"error": f"this worker has the toolchain {self.toolchain}"}, []
+
+        source_name = Path(request.get("source_name", "")).name
+        rejected = self._rejected(request.get("args", []))
+        if not source_name or rejected is not None or len(payloads) != 1:
+            return {"error": rejected or "the request has no source"}, []
+
+        with self.lock:
+            self.queued += 1
+        with self.slots:
+            with self.lock:
+                self.queued -= 1
+                self.busy += 1
+            reply, reply_payloads = {"error": "the compilation failed"}, []
+            try:
+                reply, reply_payloads = self._compile(request["args"], source_name, zlib.decompress(payloads[0]))
+            finally:
+                with self.lock:
+                    self.busy -= 1
+                    self.served += 1
+                    if reply.get("returncode") != 0:
+                        self.failed += 1
+
+        return reply, reply_payloads
+
+    def _compile(self, args: List[str], source_name: str, source: bytes) -> Tuple[Dict, List[bytes]]:
+        started = time.monotonic()
+        with tempfile.TemporaryDirectory(prefix="distcl-") as directory:
+            # the source keeps its name, so cl prints the same name as it would on the client
+            (Path(directory) / source_name).write_bytes(source)
+            object_file = Path(directory) / "object.obj"
+
+            with self._prefix() as env:
+                try:
+                    result = subprocess.run(
+                        ["cl", "/nologo"] + args + ["/c", "/Foobject.obj", source_name],
+                        cwd=directory,
+                        env=env,
+                        stdin=subprocess.DEVNULL,
+                        capture_output=True,
+                        timeout=float(self.config.get("command_timeout", operations.runner.DEFAULT_TIMEOUT)),
+                    )
+                except (OSError, subprocess.TimeoutExpired) as e:
+                    return {"error": f"running cl failed: {e}"}, []
+
+            object_data = object_file.read_bytes() if result.returncode == 0 and object_file.exists() else b""
+
+        if self.verbose:
+            print(f"{time.monotonic() - started:.3f}s exit {result.returncode}: {source_name}")
+
+        reply = {"returncode": result.returncode, "has_object": len(object_data) > 0}
+        return reply, [result.stdout, result.stderr, zlib.compress(object_data, COMPRESSION_LEVEL)]
+
+
+def serve(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    # everything expensive happens once here instead of once per compilation
+    operations.utils.set_env(config, args)
+
+    worker = Worker(config, args["jobs"], args["verbose"])
+    if not worker.use_pool:
+        print("There is no prefix pool, all compilations share the wine prefix. "
+              "Create one with 'linux-msvc pool create' to run them in parallel.")
+        operations.runner.get_runner(config).run(["wineserver", "-p"], timeout=operations.runner.WINESERVER_TIMEOUT)
+
+    with WorkerServer((args["host"], args["port"]), WorkerRequestHandler) as server:
+        server.worker = worker
+        print(f"distcl worker listening on {args['host']}:{server.server_address[1]} with {worker.jobs} jobs")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def _request(worker: str, request: Dict, payloads: List[bytes] = None, timeout: float = None) -> Tuple[Dict, List[bytes]]:
+    with socket.create_connection(_address(worker), timeout=timeout) as connection:
+        _send(connection, dict(request, version=PROTOCOL_VERSION), payloads)
+        with connection.makefile("rb") as stream:
+            return _receive(stream)
+
+
+def _down_file(config: operations.utils.LinuxMsvcConfig) -> Path:
+    return config.destination() / "run" / "distcl-down.json"
+
+
+# Workers that could not be reached recently, with the time they are tried again.
+# Every compilation is a process of its own, without this every one of them would wait for the timeout.
+# Concurrent updates may lose an entry, which only costs another timeout.
+def _down_workers(config: operations.utils.LinuxMsvcConfig) -> Dict[str, float]:
+    try:
+        with open(_down_file(config), "r") as f:
+            down = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+    return {worker: until for worker, until in down.items() if until > time.time()}
+
+
+def _mark_down(config: operations.utils.LinuxMsvcConfig, worker: str):
+    down = _down_workers(config)
+    down[worker] = time.time() + DOWN_INTERVAL
+
+    down_file = _down_file(config)
+    down_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = down_file.with_name(f".{down_file.name}.{os.getpid()}.tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(down, f)
+    os.replace(tmp_file, down_file)
+
+
+# the status of every worker, asked in parallel; unreachable workers are None
+def worker_status(config: operations.utils.LinuxMsvcConfig, workers: List[str]) -> Dict[str, Dict]:
+    statuses = {worker: None for worker in workers}
+
+    def ask(worker: str):
+        try:
+            statuses[worker] = _request(worker, {"command": "status"}, timeout=STATUS_TIMEOUT)[0]
+        except (OSError, ValueError):
+            _mark_down(config, worker)
+
+    threads = [threading.Thread(target=ask, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return statuses
+
+
+# The workers that can compile for this host, the least loaded first.
+# The load is the share of the jobs of a worker that are taken, including the compilations waiting for one.
+# The load average of the host breaks ties, a random number the rest, so concurrent clients don't all pick
+# the same worker.
+def schedule(config: operations.utils.LinuxMsvcConfig) -> List[str]:
+    down = _down_workers(config)
+    workers = [worker for worker in configured_workers(config) if worker not in down]
+
+    candidates = []
+    for worker, status in worker_status(config, workers).items():
+        if status is None or status.get("toolchain") != toolchain(config):
+            continue
+
+        load = (status["busy"] + status["queued"] + 1) / status["jobs"]
+        candidates.append((load, status["load"], random.random(), worker))
+
+    return [candidate[-1] for candidate in sorted(candidates)]
+
+
+# put the output of the preprocessor after the line with the source name, where cl prints its own diagnostics
+# with /showIncludes, that output has the included files ninja reads the dependencies from
+def _merge_output(compile_stdout: bytes, preprocess_stderr: bytes, source_name: str) -> bytes:
+    lines = [line for line in preprocess_stderr.splitlines(keepends=True) if line.strip() != source_name.encode()]
+    first_line, _, rest = compile_stdout.partition(b"\n")
+    if not first_line and not rest:
+        return b"".join(lines)
+
+    return first_line + b"\n" + b"".join(lines) + rest
+
+
+# Compile a preprocessed source on the least loaded worker, another worker is tried if one fails.
+# Returns the exit code, stdout and stderr of cl with the object written to the output of the invocation,
+# or None if no worker could do it and the caller has to compile locally.
+def compile_remote(config: operations.utils.LinuxMsvcConfig, invocation: Dict, preprocessed: bytes,
+                   preprocess_stderr: bytes, verbose=False) -> Tuple[int, bytes, bytes]:
+    source_name = Path(invocation["sources"][0]).name
+    rejected = Worker._rejected(invocation["compile_flags"])
+    if rejected is not None:
+        if verbose:
+            print(f"linux-msvc cl: compiling {source_name} locally, {rejected} on a worker", file=sys.stderr)
+        return None
+
+    request = {
+        "command": "compile",
+        "toolchain": toolchain(config),
+        "args": invocation["compile_flags"],
+        "source_name": source_name,
+    }
+    source = zlib.compress(preprocessed, COMPRESSION_LEVEL)
+    timeout = float(config.get("command_timeout", operations.runner.DEFAULT_TIMEOUT))
+
+    for worker in schedule(config):
+        try:
+            reply, payloads = _request(worker, request, [source], timeout=timeout)
+        except (OSError, ValueError):
+            _mark_down(config, worker)
+            continue
+
+        if "error" in reply or len(payloads) != 3:
+            if verbose:
+                print(f"linux-msvc cl: {worker} could not compile {source_name}: {reply.get('error')}", file=sys.stderr)
+            continue
+
+        stdout, stderr, object_data = payloads
+        if reply["has_object"]:
+            tmp_output = invocation["output"] + ".tmp"
+            with open(tmp_output, "wb") as f:
+                f.write(zlib.decompress(object_data))
+            os.replace(tmp_output, invocation["output"])
+
+        if verbose:
+            print(f"linux-msvc cl: compiled {source_name} on {worker}", file=sys.stderr)
+
+        return reply["returncode"], _merge_output(stdout, preprocess_stderr, source_name), stderr
+
+    if verbose:
+        print(f"linux-msvc cl: no worker could compile {source_name}, compiling it locally", file=sys.stderr)
+    return None
+
+
+def print_status(config: operations.utils.LinuxMsvcConfig):
+    workers = configured_workers(config)
+    if not workers:
+        print("No workers are configured, add them with 'linux-msvc distcl add HOST:PORT'.")
+        return
+
+    for worker, status in worker_status(config, workers).items():
+        if status is None:
+            print(f"{worker:<24} unreachable")
+        elif status.get("toolchain") != toolchain(config):
+            print(f"{worker:<24} other toolchain {status.get('toolchain')}")
+        else:
+            print(f"{worker:<24} {status['busy']}/{status['jobs']} busy  {status['queued']} queued  "
+                  f"load {status['load']:.2f}  {status['served']} served  {status['failed']} failed")
+
+
+def distcl_command(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    match args["distcl_operation"]:
+        case "worker":
+            serve(config, args)
+        case "add":
+            workers = config.get("distcl_workers") or []
+            config["distcl_workers"] = workers + [worker for worker in args["workers"] if worker not in workers]
+            config.save()
+        case "remove":
+            config["distcl_workers"] = [
+                worker for worker in config.get("distcl_workers") or [] if worker not in args["workers"]
+            ]
+            config.save()
+        case "status":
+            print_status(config)
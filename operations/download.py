@@ -0,0 +1,318 @@
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+import operations.profile
+import operations.utils
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+DEFAULT_CONNECTIONS = 4
+DEFAULT_CHUNK_SIZE = 16 * 1024 ** 2
+READ_SIZE = 64 * 1024
+RETRIES = 3
+TIMEOUT = 30
+USER_AGENT = "linux-msvc/" + operations.utils.Consts.VERSION
+
+
+class DownloadError(Exception):
+    pass
+
+
+# A token bucket shared by all connections, so the configured rate is the total for the whole process.
+class RateLimiter:
+    def __init__(self, bytes_per_second: int = None):
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.allowance = 0.0
+        self.last = time.monotonic()
+
+    def consume(self, amount: int):
+        if not self.bytes_per_second:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                # the bucket holds at least one read, otherwise reads above the rate would wait forever
+                self.allowance = min(
+                    self.allowance + (now - self.last) * self.bytes_per_second,
+                    float(max(self.bytes_per_second, amount)),
+                )
+                self.last = now
+
+                if self.allowance >= amount:
+                    self.allowance -= amount
+                    return
+
+                wait_time = (amount - self.allowance) / self.bytes_per_second
+
+            time.sleep(wait_time)
+
+
+# prints the number of downloaded bytes and the throughput at most once per interval
+class Progress:
+    def __init__(self, name: str, total: int = None, already_done: int = 0, enabled=True, interval: float = 1.0):
+        self.name = name
+        self.total = total
+        self.done = already_done
+        self.resumed = already_done
+        self.enabled = enabled
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.last_print = self.start
+
+    def add(self, amount: int):
+        with self.lock:
+            self.done += amount
+            now = time.monotonic()
+            if self.enabled and now - self.last_print >= self.interval:
+                self.last_print = now
+                self._print(now)
+
+    def rate(self, now: float = None) -> float:
+        if now is None:
+            now = time.monotonic()
+
+        elapsed = max(now - self.start, 1e-6)
+        return (self.done - self.resumed) / elapsed
+
+    def _print(self, now: float):
+        message = f"{self.name}: {operations.utils.format_size(self.done)}"
+        if self.total:
+            message += f" of {operations.utils.format_size(self.total)} ({100 * self.done / self.total:.0f}%)"
+        message += f" at {operations.utils.format_size(int(self.rate(now)))}/s"
+        print(message, file=sys.stderr)
+
+    def finish(self):
+        if self.enabled:
+            self._print(time.monotonic())
+
+
+# A downloader that splits large files into HTTP range requests, which are fetched in parallel.
+# The data is written into <target>.part and the finished chunks are recorded in <target>.part.json,
+# so an interrupted download continues where it stopped the next time.
+# Servers without range support fall back to a single stream.
+class Downloader:
+    def __init__(
+            self,
+            connections: int = DEFAULT_CONNECTIONS,
+            max_bytes_per_second: int = None,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+            progress=True,
+    ):
+        self.connections = max(1, connections)
+        self.connection_slots = threading.BoundedSemaphore(self.connections)
+        self.rate_limiter = RateLimiter(max_bytes_per_second)
+        self.chunk_size = chunk_size
+        self.progress = progress
+
+    def _open(self, url: str, headers: Dict = None):
+        request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT, **(headers or {})})
+        return urllib.request.urlopen(request, timeout=TIMEOUT)
+
+    # ask the server for the size of the file and whether it supports range requests
+    def probe(self, url: str) -> Dict:
+        with self.connection_slots:
+            with self._open(url, {"Range": "bytes=0-0"}) as response:
+                info = {
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "size": None,
+                    "ranges": False,
+                }
+
+                content_range = response.headers.get("Content-Range")
+                if response.status == 206 and content_range and "/" in content_range:
+                    total = content_range.rsplit("/", 1)[1]
+                    if total != "*":
+                        info["size"] = int(total)
+                        info["ranges"] = True
+                elif response.headers.get("Content-Length") is not None:
+                    info["size"] = int(response.headers["Content-Length"])
+
+        return info
+
+    def download(self, url: str, target: Path, name: str = None) -> Path:
+        target = Path(target)
+        if name is None:
+            name = target.name
+
+        part_file = Path(str(target) + ".part")
+        state_file = Path(str(target) + ".part.json")
+
+        with operations.profile.span(f"download {name}", "download", url=url) as span:
+            info = self.probe(url)
+            state = self._load_state(state_file, info)
+
+            if info["ranges"] and info["size"]:
+                progress = self._download_ranges(url, part_file, state_file, state, name)
+            else:
+                progress = self._download_stream(url, part_file, info, name)
+
+            if info["size"] is not None and part_file.stat().st_size != info["size"]:
+                raise DownloadError(f"{url} is incomplete: got {part_file.stat().st_size} of {info['size']} bytes.")
+
+            span["bytes"] = progress.done - progress.resumed
+            span["bytes_per_second"] = progress.rate()
+
+        os.replace(part_file, target)
+        state_file.unlink(missing_ok=True)
+        return target
+
+    # resume from an existing state file if it belongs to the same version of the same file
+    def _load_state(self, state_file: Path, info: Dict) -> Dict:
+        fresh = {
+            "url": info["url"],
+            "size": info["size"],
+            "etag": info["etag"],
+            "last_modified": info["last_modified"],
+            "chunk_size": self.chunk_size,
+            "done": [],
+        }
+
+        try:
+            with open(state_file, "r") as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return fresh
+
+        for key in ["url", "size", "etag", "last_modified"]:
+            if state.get(key) != fresh[key]:
+                return fresh
+
+        return state
+
+    def _save_state(self, state_file: Path, state: Dict):
+        tmp_file = Path(str(state_file) + ".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_file, state_file)
+
+    def _chunks(self, state: Dict) -> List[List[int]]:
+        chunk_size = state["chunk_size"]
+        size = state["size"]
+        return [[start, min(start + chunk_size, size) - 1] for start in range(0, size, chunk_size)]
+
+    def _download_ranges(self, url: str, part_file: Path, state_file: Path, state: Dict, name: str) -> Progress:
+        chunks = self._chunks(state)
+        done = set(state["done"])
+
+        # without state file any existing part file is stale
+        if not done or not part_file.exists():
+            done.clear()
+            state["done"] = []
+            with open(part_file, "wb") as f:
+                f.truncate(state["size"])
+
+        already_done = sum(end - start + 1 for index, (start, end) in enumerate(chunks) if index in done)
+        progress = Progress(name, state["size"], already_done, self.progress)
+        state_lock = threading.Lock()
+
+        fd = os.open(part_file, os.O_WRONLY)
+        try:
+            def fetch_chunk(index: int):
+                start, end = chunks[index]
+                self._fetch_range(url, fd, start, end, progress)
+
+                with state_lock:
+                    state["done"].append(index)
+                    self._save_state(state_file, state)
+
+            todo = [index for index in range(len(chunks)) if index not in done]
+            with ThreadPoolExecutor(max_workers=self.connections) as executor:
+                for future in [executor.submit(fetch_chunk, index) for index in todo]:
+                    future.result()
+        finally:
+            os.close(fd)
+
+        progress.finish()
+        return progress
+
+    def _fetch_range(self, url: str, fd: int, start: int, end: int, progress: Progress):
+        error = None
+        for _ in range(RETRIES):
+            offset = start
+            try:
+                with self.connection_slots:
+                    with self._open(url, {"Range": f"bytes={start}-{end}"}) as response:
+                        if response.status != 206:
+                            raise DownloadError(f"{url} ignored the range request.")
+
+                        while offset <= end:
+                            data = response.read(min(READ_SIZE, end - offset + 1))
+                            if not data:
+                                break
+
+                            self.rate_limiter.consume(len(data))
+                            os.pwrite(fd, data, offset)
+                            offset += len(data)
+                            progress.add(len(data))
+
+                if offset > end:
+                    return
+
+                error = DownloadError(f"{url} closed the connection early at byte {offset}.")
+            except (urllib.error.URLError, OSError) as e:
+                error = e
+
+            # the partial data of this chunk is fetched again
+            progress.add(start - offset)
+
+        raise DownloadError(f"Downloading bytes {start}-{end} of {url} failed: {error}")
+
+    # a single connection, resuming from the end of the part file if the server allows it
+    def _download_stream(self, url: str, part_file: Path, info: Dict, name: str) -> Progress:
+        offset = part_file.stat().st_size if part_file.exists() and info["ranges"] else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        progress = Progress(name, info["size"], offset, self.progress)
+        with self.connection_slots:
+            with self._open(url, headers) as response:
+                mode = "ab" if offset and response.status == 206 else "wb"
+                with open(part_file, mode) as f:
+                    while data := response.read(READ_SIZE):
+                        self.rate_limiter.consume(len(data))
+                        f.write(data)
+                        progress.add(len(data))
+
+        progress.finish()
+        return progress
+
+
+_shared_downloader = None
+_shared_downloader_lock = threading.Lock()
+
+
+# returns the downloader of this process
+# all downloads share its connection and bandwidth limits, even if they run in parallel
+def get_downloader(config: operations.utils.LinuxMsvcConfig, verbose=False) -> Downloader:
+    global _shared_downloader
+
+    with _shared_downloader_lock:
+        if _shared_downloader is None:
+            max_rate = config.get("download_max_rate")
+            if max_rate is not None:
+                max_rate = operations.utils.parse_size(max_rate)
+
+            _shared_downloader = Downloader(
+                connections=int(config.get("download_connections", DEFAULT_CONNECTIONS)),
+                max_bytes_per_second=max_rate,
+                progress=verbose,
+            )
+
+        return _shared_downloader
@@ -1,11 +1,17 @@
 import sys
-import git
 
 import operations.utils
 import operations.tools
-import subprocess
-
-from typing import Dict
+import operations.bundle
+import operations.journal
+import operations.mirror
+import operations.prefix
+import operations.repos
+import operations.profile
+import operations.runner
+import operations.scheduler
+
+from typing import Dict, List
 from pathlib import Path
 
 # don't allow running the file as script
@@ -57,6 +63,124 @@ def init_subparser(subparser):
         help="Use the system winetricks instead of the downloaded one.",
     )
 
+    install_parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=4,
+        dest="jobs",
+        help="How many install steps may run at the same time. Steps changing the wine prefix always run one by one.",
+    )
+
+    add_component_arguments(install_parser)
+
+    install_parser.add_argument(
+        "--git_clone_mode",
+        choices=operations.repos.CLONE_MODES,
+        default=operations.repos.DEFAULT_CLONE_MODE,
+        dest="git_clone_mode",
+        help="How msvc-wine and vcpkg are cloned. blobless and shallow clones are much smaller, "
+             "full and blobless clones keep a mirror in the cache that later clones and fetches start from.",
+    )
+
+    install_parser.add_argument(
+        "--msvc_wine_commit",
+        default=None,
+        dest="msvc_wine_commit",
+        help="Pin msvc-wine to this commit instead of following its master branch.",
+    )
+
+    install_parser.add_argument(
+        "--vcpkg_commit",
+        default=None,
+        dest="vcpkg_commit",
+        help="Pin vcpkg to this commit instead of following its master branch.",
+    )
+
+    install_parser.add_argument(
+        "--mirror_url",
+        default=None,
+        dest="mirror_url",
+        help="A 'linux-msvc cache serve' mirror to download through, e.g. http://buildhost:8765.",
+    )
+
+    install_parser.add_argument(
+        "--from_bundle",
+        "--from-bundle",
+        default=None,
+        dest="from_bundle",
+        help="Install from a bundle written by 'cache export' instead of downloading everything.",
+    )
+
+    install_parser.add_argument(
+        "--snapshot_prefix",
+        action="store_true",
+        default=False,
+        dest="snapshot_prefix",
+        help="Save the finished wine prefix as template, so 'config reset wine_prefix' can restore it in seconds.",
+    )
+
+
+# the value of --msvc_version and --sdk_version for the newest version
+LATEST_VERSION = "latest"
+
+
+# The options selecting which parts of msvc are downloaded, they are shared with 'config components'.
+# Without defaults, only the given options change the current selection.
+def add_component_arguments(parser, defaults=True):
+    parser.add_argument(
+        "--architecture",
+        nargs="+",
+        choices=operations.utils.TARGET_ARCHITECTURES,
+        default=[operations.utils.DEFAULT_ARCHITECTURE] if defaults else None,
+        dest="architectures",
+        help="The target architectures to install. The environment is set up for the first one.",
+    )
+
+    parser.add_argument(
+        "--host_arch",
+        choices=operations.utils.HOST_ARCHITECTURES,
+        default=operations.utils.DEFAULT_ARCHITECTURE if defaults else None,
+        dest="host_arch",
+        help="The architecture of the compiler executables.",
+    )
+
+    parser.add_argument(
+        "--msvc_version",
+        default=LATEST_VERSION if defaults else None,
+        dest="msvc_version",
+        help="The msvc version to install, like 17.8, or latest.",
+    )
+
+    parser.add_argument(
+        "--sdk_version",
+        default=LATEST_VERSION if defaults else None,
+        dest="sdk_version",
+        help="The windows sdk version to install, like 10.0.22621, or latest.",
+    )
+
+    parser.add_argument(
+        "--ignore",
+        nargs="+",
+        default=[] if defaults else None,
+        dest="ignored_components",
+        help="Packages vsdownload.py should leave out, like Microsoft.VC.14.38.17.8.ASAN.Headers.base.",
+    )
+
+
+# merge the component options into a selection, options that weren't given keep their current value
+def component_selection(args: Dict, current: Dict = None) -> Dict:
+    selection = dict(current or {})
+    for key in ["architectures", "host_arch", "msvc_version", "sdk_version", "ignored_components"]:
+        if args.get(key) is not None:
+            selection[key] = args[key]
+
+    for key in ["msvc_version", "sdk_version"]:
+        if selection.get(key) == LATEST_VERSION:
+            selection[key] = None
+
+    return selection
+
 
 def install(args: Dict) -> operations.utils.LinuxMsvcConfig:
     config = operations.utils.LinuxMsvcConfig()
@@ -65,6 +189,14 @@ def install(args: Dict) -> operations.utils.LinuxMsvcConfig:
     config["create_config_file"] = args["create_config_file"]
     config["use_cache"] = args["use_cache"]
     config["system_winetricks"] = args["system_winetricks"]
+    config["msvc_components"] = component_selection(args)
+    if args["mirror_url"] is not None:
+        config["mirror_url"] = args["mirror_url"]
+    config["git_clone_mode"] = args["git_clone_mode"]
+    config["git_commits"] = {
+        name: commit for name, commit in [("msvc-wine-repo", args["msvc_wine_commit"]), ("vcpkg", args["vcpkg_commit"])]
+        if commit is not None
+    }
 
     if args["verbose"]:
         print(config)
@@ -73,38 +205,203 @@ def install(args: Dict) -> operations.utils.LinuxMsvcConfig:
     if not config.destination().exists():
         config.destination().mkdir(parents=True)
 
+    journal = operations.journal.InstallJournal(config.destination())
+    try:
+        with journal.lock():
+            if journal.exists() and not journal.is_finished():
+                print("continuing the previous install, finished steps are skipped")
+
+            if args["from_bundle"] is not None:
+                install_bundle(config, Path(args["from_bundle"]).expanduser(), args["verbose"])
+
+            # set the environment once for all steps, the steps run in parallel and must not modify it themselves
+            # only the setup_* functions call set_env, they run one after another outside of the scheduler
+            operations.utils.set_env(config, {}, args["verbose"])
+
+            # all steps share the command runner and its limit of parallel commands
+            runner = operations.runner.get_runner(config, args["verbose"])
+
+            scheduler = install_steps(config, args["jobs"], args["verbose"], journal)
+            try:
+                scheduler.run()
+            finally:
+                scheduler.print_report()
+                if args["verbose"]:
+                    runner.print_report()
+
+            # the versions are part of the object cache key
+            config.update(operations.utils.detect_toolchain_versions(config))
+
+            if args["snapshot_prefix"]:
+                operations.prefix.snapshot(config, verbose=args["verbose"])
+
+            # the manifest of a bundle only holds for this install, updates must get the current one
+            config.msvc_components().pop("manifest", None)
+
+            # save the config file
+            if config["create_config_file"]:
+                if args["verbose"]:
+                    print("saving the configuration")
+                config.save()
+
+            journal.finish()
+    except operations.journal.JournalLocked as e:
+        print(e)
+        sys.exit(1)
+    except operations.scheduler.StepFailed as e:
+        print(e)
+        print("Run the same install command again to continue from the failed step.")
+        sys.exit(1)
+
+    print("finished installing.")
+    print("use 'linux-msvc shell' to start a shell with the environment set up.")
+    print("Or use the 'linux-msvc meson command to run meson with the environment set up.")
+
+    return config
+
+
+# unpack a bundle into the destination, so the install steps find everything in the cache
+def install_bundle(config: operations.utils.LinuxMsvcConfig, bundle_file: Path, verbose=False):
+    if not config["use_cache"]:
+        print("An install from a bundle needs the cache.")
+        sys.exit(1)
+
+    bundle = operations.bundle.import_bundle(config, bundle_file, verbose)
+    if bundle["vsdownload_manifest"] is not None:
+        config["msvc_components"]["manifest"] = bundle["vsdownload_manifest"]
+
+    selection = {key: value for key, value in config.msvc_components().items() if key != "manifest"}
+    if bundle["msvc_components"] and bundle["msvc_components"] != selection:
+        print("The bundle was exported for a different msvc selection, the missing packages will be downloaded.")
+
+
+# whether the install in the destination of the config was started but never finished
+def can_resume(config: operations.utils.LinuxMsvcConfig) -> bool:
+    journal = operations.journal.InstallJournal(config.destination())
+    return journal.exists() and not journal.is_finished()
+
+
+# Create the scheduler with all install steps.
+# Downloads and git clones run in parallel, everything that touches the wine prefix runs one after another.
+# With a journal, steps that already finished in an earlier run are skipped as long as their inputs are the same.
+def install_steps(
+        config: operations.utils.LinuxMsvcConfig,
+        jobs: int = 4,
+        verbose=False,
+        journal: operations.journal.InstallJournal = None,
+) -> operations.scheduler.Scheduler:
+    network = operations.scheduler.RESOURCE_NETWORK
+    prefix = operations.scheduler.RESOURCE_PREFIX
+
+    scheduler = operations.scheduler.Scheduler(max_workers=jobs, verbose=verbose, journal=journal)
+
+    def step(name, action, depends_on=None, resource=operations.scheduler.RESOURCE_LOCAL, inputs=None):
+        scheduler.add(operations.scheduler.Step(
+            name,
+            lambda: action(config, verbose),
+            depends_on=depends_on,
+            resource=resource,
+            inputs=inputs,
+        ))
+
     # download and install msvc
-    setup_msvc(config, args["verbose"])
+    step("clone_msvc_wine", clone_msvc_wine, resource=network,
+         inputs=operations.repos.clone_inputs(config, "msvc-wine-repo", MSVC_WINE_URL))
+    step("download_msvc", download_msvc, ["clone_msvc_wine"], resource=network,
+         inputs=[vsdownload_command(config), config["use_cache"]])
+    # install.sh may boot wine, so it is treated like every other prefix mutation
+    step("install_msvc", install_msvc, ["download_msvc"], resource=prefix)
 
     # create the wine prefix and install all winetricks
-    setup_wine(config, args["verbose"])
+    step("fetch_winetricks", operations.tools.get_winetricks, resource=network, inputs=config["system_winetricks"])
+    step("prepare_wine_prefix", prepare_wine_prefix, ["fetch_winetricks"], resource=prefix,
+         inputs=[WINETRICKS_PACKAGES, config["no_wine_prefix"]])
 
     # download and install the powershell
-    setup_powershell(config, args["verbose"])
+    step("fetch_powershell", fetch_powershell, resource=network, inputs=POWERSHELL_URL)
+    step("install_powershell", install_powershell, ["prepare_wine_prefix", "fetch_powershell"], resource=prefix)
 
     # setup vcpkg (broken atm because no vs install is found)
-    setup_vcpkg(config, args["verbose"])
+    step("clone_vcpkg", clone_vcpkg, resource=network, inputs=operations.repos.clone_inputs(config, "vcpkg", VCPKG_URL))
+    step("bootstrap_vcpkg", bootstrap_vcpkg, ["install_powershell", "install_msvc", "clone_vcpkg"], resource=prefix)
 
     # download and setup chocolatey
-    setup_choco(config, args["verbose"])
+    step("fetch_choco", fetch_choco, resource=network, inputs=CHOCO_URL)
+    step("install_choco", install_choco, ["install_powershell", "fetch_choco"], resource=prefix)
 
-    # save the config file
-    if config["create_config_file"]:
-        if args["verbose"]:
-            print("saving the configuration")
-        config.save()
+    return scheduler
 
-    print("finished installing.")
-    print("use 'linux-msvc shell' to start a shell with the environment set up.")
-    print("Or use the 'linux-msvc meson command to run meson with the environment set up.")
 
-    return config
+def setup_msvc(config: operations.utils.LinuxMsvcConfig, verbose=False):
+    with operations.profile.span("setup_msvc", "step"):
+        operations.utils.set_env(config, {}, verbose)
 
+        clone_msvc_wine(config, verbose)
+        download_msvc(config, verbose)
+        install_msvc(config, verbose)
+
+
+MSVC_WINE_URL = "https://github.com/mstorsjo/msvc-wine/"
+VCPKG_URL = "https://github.com/microsoft/vcpkg"
+
+
+def clone_msvc_wine(config: operations.utils.LinuxMsvcConfig, verbose=False):
+    operations.repos.clone_repo(config, "msvc-wine-repo", MSVC_WINE_URL, verbose)
+
+
+MSVC_SELECTION_FILE = ".linux-msvc-selection.txt"
+
+
+# the vsdownload.py command with all options that select what gets installed
+def vsdownload_command(config: operations.utils.LinuxMsvcConfig) -> List[str]:
+    command = [
+        "python",
+        str(config.destination() / "msvc-wine-repo" / "vsdownload.py"),
+        "--accept-license",
+    ]
+
+    components = config.msvc_components()
+    if components.get("architectures"):
+        command += ["--architecture"] + components["architectures"]
+    if components.get("host_arch"):
+        command += ["--host-arch", components["host_arch"]]
+    if components.get("msvc_version"):
+        command += ["--msvc-version", components["msvc_version"]]
+    if components.get("sdk_version"):
+        command += ["--sdk-version", components["sdk_version"]]
+    if components.get("ignored_components"):
+        command += ["--ignore"] + components["ignored_components"]
+    if components.get("manifest"):
+        command += ["--manifest", components["manifest"]]
+
+    return command
+
+
+# the packages vsdownload.py would install right now, one line per package and version
+def msvc_selection(config: operations.utils.LinuxMsvcConfig) -> List[str]:
+    result = operations.runner.get_runner(config).run(
+        vsdownload_command(config) + ["--print-selection"],
+        capture=True,
+        prefix="vsdownload",
+    )
+    if result["returncode"] != 0:
+        return None
+
+    return sorted(line.strip() for line in result["stdout"].splitlines() if line.strip())
+
+
+# the packages the msvc installation was created from
+def installed_msvc_selection(msvc_path: Path) -> List[str]:
+    try:
+        with open(msvc_path / MSVC_SELECTION_FILE, "r") as f:
+            return [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
 
-def setup_msvc(config: operations.utils.LinuxMsvcConfig, verbose=False):
-    operations.utils.set_env(config, {}, verbose)
 
-    msvc_path = Path(config.destination() / "msvc")
+def download_msvc(config: operations.utils.LinuxMsvcConfig, verbose=False, msvc_path: Path = None):
+    if msvc_path is None:
+        msvc_path = Path(config.destination() / "msvc")
     if not msvc_path.exists():
         msvc_path.mkdir(parents=True)
 
@@ -112,107 +409,147 @@ def setup_msvc(config: operations.utils.LinuxMsvcConfig, verbose=False):
     if not cache_path.exists():
         cache_path.mkdir(parents=True)
 
-    if not (config.destination() / "msvc-wine-repo").exists():
-        git.Repo.clone_from(
-            "https://github.com/mstorsjo/msvc-wine/",
-            config.destination() / "msvc-wine-repo",
-            verbose=verbose,
-        )
+    selection = msvc_selection(config)
 
     # download and setup msvc-wine
-    dlcomand = [
-        "python",
-        str(config.destination() / "msvc-wine-repo" / "vsdownload.py"),
+    dlcomand = vsdownload_command(config) + [
         "--dest",
         str(msvc_path),
-        "--accept-license"
     ]
     if config["use_cache"]:
         dlcomand.append("--cache")
         dlcomand.append(str(cache_path))
 
+    # the packages are fetched through the mirror, if there is one
+    dlcomand = operations.mirror.mirrored_python_command(config, dlcomand)
+
     if verbose:
         print("downloading msvc")
         print(dlcomand)
-    subprocess.run(dlcomand)
+    # a failed download has to fail the install step, otherwise it would be recorded as done
+    operations.runner.get_runner(config, verbose).run(dlcomand, check=True, prefix="vsdownload")
+
+    # remember what was installed, so update only does something if the selection changes
+    if selection is not None:
+        with open(msvc_path / MSVC_SELECTION_FILE, "w") as f:
+            f.write("\n".join(selection) + "\n")
 
-    subprocess.run([
+
+def install_msvc(config: operations.utils.LinuxMsvcConfig, verbose=False, msvc_path: Path = None):
+    if msvc_path is None:
+        msvc_path = config.destination() / "msvc"
+
+    operations.runner.get_runner(config, verbose).run([
         str(config.destination() / "msvc-wine-repo" / "install.sh"),
         str(msvc_path)
-    ])
+    ], check=True)
 
 
 def setup_wine(config: operations.utils.LinuxMsvcConfig, verbose=False):
-    operations.utils.set_env(config, {}, verbose)
+    with operations.profile.span("setup_wine", "step"):
+        operations.utils.set_env(config, {}, verbose)
+
+        operations.tools.get_winetricks(config, verbose)
+        prepare_wine_prefix(config, verbose)
+
+
+WINETRICKS_PACKAGES = [
+    ["settings", "win10"],
+    ["7zip"],
+    ["cmake"],
+    ["dotnet48"],
+    ["dotnet_verifier"],
+    ["settings", "win10"],
+    ["nuget"],
+]
+
+
+def prepare_wine_prefix(config: operations.utils.LinuxMsvcConfig, verbose=False):
+    runner = operations.runner.get_runner(config, verbose)
 
     if verbose:
         print("killing the wineserver")
-    subprocess.run(["wineserver", "-k"])
-
-    winetricks_packages = [
-        ["settings", "win10"],
-        ["7zip"],
-        ["cmake"],
-        ["dotnet48"],
-        ["dotnet_verifier"],
-        ["settings", "win10"],
-        ["nuget"],
+    runner.run(["wineserver", "-k"], timeout=operations.runner.WINESERVER_TIMEOUT)
 
-    ]
-    operations.tools.install_winetricks_packages(config, winetricks_packages, verbose)
+    operations.tools.install_winetricks_packages(config, WINETRICKS_PACKAGES, verbose)
 
     if verbose:
         print("killing the wineserver")
-    subprocess.run(["wineserver", "-k"])
+    runner.run(["wineserver", "-k"], timeout=operations.runner.WINESERVER_TIMEOUT)
 
     if verbose:
         print("making the wineserver persistent")
-    subprocess.run(["wineserver", "-p"])
+    runner.run(["wineserver", "-p"], timeout=operations.runner.WINESERVER_TIMEOUT)
 
     if verbose:
         print("booting the wine server again")
-    subprocess.run(["wine", "wineboot"])
+    runner.run(["wine", "wineboot"], timeout=operations.runner.WINEBOOT_TIMEOUT)
+
+
+POWERSHELL_URL = "https://github.com/PowerShell/PowerShell/releases/download/v7.3.4/PowerShell-7.3.4-win-x64.msi"
+CHOCO_URL = "https://community.chocolatey.org/install.ps1"
 
 
 def setup_powershell(config: operations.utils.LinuxMsvcConfig, verbose=False):
-    operations.utils.set_env(config, {}, verbose)
+    with operations.profile.span("setup_powershell", "step"):
+        operations.utils.set_env(config, {}, verbose)
+
+        fetch_powershell(config, verbose)
+        install_powershell(config, verbose)
+
 
-    powershell_url = "https://github.com/PowerShell/PowerShell/releases/download/v7.3.4/PowerShell-7.3.4-win-x64.msi"
-    powershell_installer = operations.utils.get_chached_file(config, powershell_url, verbose=verbose)
+def fetch_powershell(config: operations.utils.LinuxMsvcConfig, verbose=False) -> Path:
+    return operations.utils.get_chached_file(config, POWERSHELL_URL, verbose=verbose)
 
-    subprocess.run([
+
+def install_powershell(config: operations.utils.LinuxMsvcConfig, verbose=False):
+    powershell_installer = fetch_powershell(config, verbose)
+
+    operations.runner.get_runner(config, verbose).run([
         "wine",
         "msiexec.exe",
         "/quiet",
         "/i",
         str(powershell_installer)
-    ])
+    ], check=True)
 
 
 def setup_vcpkg(config: operations.utils.LinuxMsvcConfig, verbose=False):
-    operations.utils.set_env(config, {}, verbose)
+    with operations.profile.span("setup_vcpkg", "step"):
+        operations.utils.set_env(config, {}, verbose)
+
+        clone_vcpkg(config, verbose)
+        bootstrap_vcpkg(config, verbose)
 
-    if not (config.destination() / "vcpkg").exists():
-        git.Repo.clone_from(
-            "https://github.com/microsoft/vcpkg",
-            config.destination() / "vcpkg",
-            verbose=verbose,
-        )
 
+def clone_vcpkg(config: operations.utils.LinuxMsvcConfig, verbose=False):
+    operations.repos.clone_repo(config, "vcpkg", VCPKG_URL, verbose)
+
+
+def bootstrap_vcpkg(config: operations.utils.LinuxMsvcConfig, verbose=False):
     vcpkg_setup_args = [
         "-File",
-        str(config.destination() / "scripts" / "bootstrap.ps1"),
+        str(config.destination() / "vcpkg" / "scripts" / "bootstrap.ps1"),
         "-disableMetrics",
     ]
 
-    operations.tools.powershell(config, {"verbose": verbose, "args": vcpkg_setup_args})
+    operations.tools.run_powershell_script(config, vcpkg_setup_args, verbose)
 
 
 def setup_choco(config: operations.utils.LinuxMsvcConfig, verbose=False):
-    operations.utils.set_env(config, {}, verbose)
+    with operations.profile.span("setup_choco", "step"):
+        operations.utils.set_env(config, {}, verbose)
+
+        fetch_choco(config, verbose)
+        install_choco(config, verbose)
+
+
+def fetch_choco(config: operations.utils.LinuxMsvcConfig, verbose=False) -> Path:
+    return operations.utils.get_chached_file(config, CHOCO_URL, verbose=verbose)
+
 
-    download_url = "https://community.chocolatey.org/install.ps1"
-    download_path = operations.utils.get_chached_file(config, download_url, verbose=verbose)
+def install_choco(config: operations.utils.LinuxMsvcConfig, verbose=False):
+    download_path = fetch_choco(config, verbose)
 
     choco_setup_args = [
         "-ExecutionPolicy",
@@ -221,4 +558,4 @@ def setup_choco(config: operations.utils.LinuxMsvcConfig, verbose=False):
         str(download_path),
     ]
 
-    operations.tools.powershell(config, {"verbose": verbose, "args": choco_setup_args})
+    operations.tools.run_powershell_script(config, choco_setup_args, verbose)
@@ -0,0 +1,107 @@
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+JOURNAL_FILE_NAME = ".linux-msvc-install.json"
+JOURNAL_VERSION = 1
+
+
+class JournalLocked(Exception):
+    pass
+
+
+# Records which install steps finished, so an interrupted install continues where it stopped.
+# Every step is stored with the fingerprint of its inputs and a completion stamp. The fingerprint includes the
+# stamps of the steps it depends on, so a step that runs again also invalidates everything after it.
+class InstallJournal:
+    def __init__(self, destination: Path):
+        self.journal_file = destination / JOURNAL_FILE_NAME
+        self.lock_file = destination / (JOURNAL_FILE_NAME + ".lock")
+        self.state = self._load()
+
+    def _load(self) -> Dict:
+        try:
+            with open(self.journal_file, "r") as f:
+                state = json.load(f)
+            if state.get("version") == JOURNAL_VERSION:
+                return state
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+        return {"version": JOURNAL_VERSION, "finished": None, "steps": {}}
+
+    def save(self):
+        tmp_file = self.journal_file.with_name(f"{self.journal_file.name}.{os.getpid()}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(self.state, f, indent=4)
+        os.replace(tmp_file, self.journal_file)
+
+    # only one install may use a destination at a time
+    @contextmanager
+    def lock(self):
+        self.lock_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_file, "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise JournalLocked(f"Another install is running in {self.journal_file.parent}.")
+
+            try:
+                # another process may have written the journal since it was loaded
+                self.state = self._load()
+                yield self
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def exists(self) -> bool:
+        return self.journal_file.exists()
+
+    def is_finished(self) -> bool:
+        return self.state["finished"] is not None
+
+    def stamp(self, step_name: str) -> str:
+        entry = self.state["steps"].get(step_name)
+        return entry["stamp"] if entry is not None else None
+
+    def fingerprint(self, step_name: str, inputs, depends_on: List[str]) -> str:
+        state = {
+            "step": step_name,
+            "inputs": inputs,
+            "dependencies": {dep: self.stamp(dep) for dep in depends_on},
+        }
+        return hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+    def is_complete(self, step_name: str, fingerprint: str) -> bool:
+        entry = self.state["steps"].get(step_name)
+        return entry is not None and entry["fingerprint"] == fingerprint
+
+    def complete(self, step_name: str, fingerprint: str, duration: float):
+        completed = time.time()
+        self.state["steps"][step_name] = {
+            "fingerprint": fingerprint,
+            "completed": completed,
+            "duration": duration,
+            "stamp": hashlib.sha256(f"{step_name}\0{fingerprint}\0{completed}".encode()).hexdigest(),
+        }
+        self.state["finished"] = None
+        self.save()
+
+    def finish(self):
+        self.state["finished"] = time.time()
+        self.save()
+
+    def remove(self):
+        self.journal_file.unlink(missing_ok=True)
@@ -0,0 +1,254 @@
+import http.server
+import json
+import os
+import re
+import sys
+import threading
+import urllib.parse
+import urllib.request
+
+from pathlib import Path
+from typing import Dict, List
+
+import operations.cache
+import operations.download
+import operations.utils
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+DEFAULT_PORT = 8765
+# a miss is only answered once the mirror has the whole file, so clients wait that long for a lookup
+LOOKUP_TIMEOUT = 60 * 60
+HEALTH_TIMEOUT = 3
+READ_SIZE = 1024 * 1024
+# hosts that serve different content under the same url, like the visual studio channel manifest
+UNCACHED_HOSTS = ["aka.ms"]
+# the only hosts the mirror downloads from, so it can't be used as proxy into the network it runs in
+# the mirror_upstream_hosts config value replaces them, every host includes its subdomains
+DEFAULT_UPSTREAM_HOSTS = ["download.visualstudio.microsoft.com", "download.microsoft.com", "github.com",
+                          "githubusercontent.com", "community.chocolatey.org"]
+BLOB_PATH = re.compile(r"/blobs/([0-9a-f]{64})/([^/]+)")
+
+
+# GET /lookup?url=<url>   makes sure the mirror has the url and returns the sha256, size and name of its blob
+# GET /blobs/<sha256>/<name>   the content of a blob, with range support
+# GET /health   whether the mirror is up
+class MirrorRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, value: Dict):
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        blob_match = BLOB_PATH.fullmatch(path)
+
+        if path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif path == "/lookup":
+            self._lookup(urllib.parse.parse_qs(query).get("url", [None])[0])
+        elif blob_match:
+            self._send_blob(blob_match.group(1), urllib.parse.unquote(blob_match.group(2)))
+        else:
+            self.send_error(404)
+
+    def _lookup(self, download_url: str):
+        if download_url is None or urllib.parse.urlsplit(download_url).scheme not in ["http", "https"]:
+            self._send_json(400, {"error": "an http or https url is needed"})
+            return
+
+        host = urllib.parse.urlsplit(download_url).hostname or ""
+        if not any(host == allowed or host.endswith("." + allowed) for allowed in self.server.upstream_hosts):
+            self._send_json(403, {"error": f"{host} is not an upstream host of this mirror"})
+            return
+
+        # the cache locks every url, so concurrent lookups of the same url wait for a single download
+        file_name = os.path.basename(urllib.parse.urlsplit(download_url).path) or "download"
+        try:
+            self.server.cache.get(download_url, file_name, verbose=self.server.verbose)
+        except (OSError, operations.download.DownloadError) as e:
+            self._send_json(502, {"error": f"fetching {download_url} failed: {e}"})
+            return
+
+        entry = self.server.cache.entries().get(download_url)
+        if entry is None:
+            self._send_json(502, {"error": f"{download_url} was evicted right after it was fetched"})
+            return
+
+        self._send_json(200, {"sha256": entry["sha256"], "size": entry["size"], "file_name": entry["file_name"]})
+
+    def _send_blob(self, sha256: str, file_name: str):
+        blob = self.server.cache.blob_dir / sha256 / file_name
+        if "/" in file_name or not blob.is_file():
+            self.send_error(404)
+            return
+
+        size = blob.stat().st_size
+        start, end = 0, size - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match and int(match.group(1)) < size:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(end, int(match.group(2)))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        # blobs never change, their checksum is a perfect etag
+        self.send_header("ETag", f'"{sha256}"')
+        self.end_headers()
+
+        with open(blob, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+
+# A read-through mirror for a whole build farm, backed by the download cache of this host.
+class MirrorServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config: operations.utils.LinuxMsvcConfig, host: str, port: int, verbose=False):
+        super().__init__((host, port), MirrorRequestHandler)
+        # the mirror always fetches from upstream, even if this host is a client of another mirror
+        self.cache = operations.cache.DownloadCache(
+            operations.utils.LinuxMsvcConfig({k: v for k, v in config.items() if k != "mirror_url"})
+        )
+        self.upstream_hosts = config.get("mirror_upstream_hosts") or DEFAULT_UPSTREAM_HOSTS
+        self.verbose = verbose
+
+
+def serve(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    server = MirrorServer(config, args["host"], args["port"], args["verbose"])
+    print(f"serving {server.cache.cache_dir} on http://{args['host']}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def mirror_url(config: operations.utils.LinuxMsvcConfig) -> str:
+    url = config.get("mirror_url")
+    return url.rstrip("/") if url else None
+
+
+_available = {}
+_available_lock = threading.Lock()
+
+
+# whether the mirror answers, checked once per process so a mirror that is down only costs one timeout
+def mirror_available(url: str) -> bool:
+    with _available_lock:
+        if url not in _available:
+            try:
+                with urllib.request.urlopen(url + "/health", timeout=HEALTH_TIMEOUT) as response:
+                    _available[url] = response.status == 200
+            except (OSError, ValueError):
+                _available[url] = False
+
+            if not _available[url]:
+                print(f"The mirror {url} is not reachable, everything is downloaded from upstream.")
+
+        return _available[url]
+
+
+def is_cacheable(download_url: str) -> bool:
+    return urllib.parse.urlsplit(download_url).hostname not in UNCACHED_HOSTS
+
+
+def lookup(mirror: str, download_url: str) -> Dict:
+    lookup_url = f"{mirror}/lookup?url={urllib.parse.quote(download_url, safe='')}"
+    with urllib.request.urlopen(lookup_url, timeout=LOOKUP_TIMEOUT) as response:
+        return json.load(response)
+
+
+def blob_url(mirror: str, entry: Dict) -> str:
+    return f"{mirror}/blobs/{entry['sha256']}/{urllib.parse.quote(entry['file_name'])}"
+
+
+# download a file through the mirror
+# returns false if that is not possible, the file then has to come from upstream
+def fetch(config: operations.utils.LinuxMsvcConfig, download_url: str, target: Path, name: str = None,
+          verbose=False) -> bool:
+    mirror = mirror_url(config)
+    if mirror is None or not is_cacheable(download_url) or not mirror_available(mirror):
+        return False
+
+    try:
+        entry = lookup(mirror, download_url)
+        operations.download.get_downloader(config, verbose).download(blob_url(mirror, entry), target, name)
+    except (OSError, ValueError, operations.download.DownloadError) as e:
+        print(f"Downloading {download_url} from the mirror failed ({e}), downloading it from upstream.")
+        return False
+
+    if operations.cache.hash_file(target) != entry["sha256"]:
+        print(f"The mirror sent a corrupted {download_url}, downloading it from upstream.")
+        Path(target).unlink(missing_ok=True)
+        return False
+
+    return True
+
+
+# Runs a python script with urllib.request.urlopen going through the mirror, used for vsdownload.py.
+# The script sees its own path as sys.argv[0], like when it is started directly.
+URLOPEN_HOOK = """
+import json, os, runpy, sys, urllib.parse, urllib.request
+
+MIRROR = {mirror!r}
+UNCACHED_HOSTS = {uncached_hosts!r}
+TIMEOUT = {timeout!r}
+urlopen = urllib.request.urlopen
+
+
+def mirrored_urlopen(url, *args, **kwargs):
+    full_url = url.full_url if isinstance(url, urllib.request.Request) else url
+    if urllib.parse.urlsplit(full_url).hostname not in UNCACHED_HOSTS:
+        try:
+            with urlopen(MIRROR + "/lookup?url=" + urllib.parse.quote(full_url, safe=""), timeout=TIMEOUT) as response:
+                entry = json.load(response)
+            blob = MIRROR + "/blobs/" + entry["sha256"] + "/" + urllib.parse.quote(entry["file_name"])
+            return urlopen(blob, *args, **kwargs)
+        except (OSError, ValueError):
+            pass
+
+    return urlopen(url, *args, **kwargs)
+
+
+urllib.request.urlopen = mirrored_urlopen
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+# the command of a python script, with its downloads going through the mirror if one is configured and up
+def mirrored_python_command(config: operations.utils.LinuxMsvcConfig, command: List[str]) -> List[str]:
+    mirror = mirror_url(config)
+    if mirror is None or not mirror_available(mirror):
+        return command
+
+    hook = URLOPEN_HOOK.format(mirror=mirror, uncached_hosts=UNCACHED_HOSTS, timeout=LOOKUP_TIMEOUT)
+    return [command[0], "-c", hook] + command[1:]
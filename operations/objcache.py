@@ -0,0 +1,393 @@
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import operations.daemon
+import operations.utils
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+CACHE_FORMAT_VERSION = "1"
+DEFAULT_MAX_SIZE = 5 * 1024 ** 3
+CLEANUP_INTERVAL = 100
+SOURCE_EXTENSIONS = (".c", ".cc", ".cpp", ".cxx", ".c++")
+
+# flags whose only effect is visible in the preprocessed source, so they don't need to be part of the hash
+PREPROCESSOR_FLAGS = ("I", "D", "U", "FI", "X", "external:I")
+# flags that don't change the object file, only what cl prints
+# they are part of the hash, since the output is replayed on a hit, but they are left out of the preprocessor call
+IGNORED_FLAGS = ("nologo", "showIncludes")
+# flags that produce more than one object file or state that is shared between compiler invocations
+UNCACHEABLE_FLAGS = ("Zi", "ZI", "Yc", "Yu", "Fp", "FA", "Fa", "FR", "Fr", "doc", "Tc", "Tp",
+                     "sourceDependencies", "analyze", "MP")
+UNCACHEABLE_EXACT_FLAGS = ("E", "EP", "P")
+
+
+def init_subparser(subparser):
+    # cl flags start with / or -, so the cl parser must not treat them as options
+    cl_parser = subparser.add_parser(
+        "cl",
+        prefix_chars="+",
+        help="Run cl through the object cache. Use this as the c and cpp compiler in the cross file.",
+    )
+
+    cl_parser.add_argument(
+        "args",
+        nargs=argparse.REMAINDER,
+        help="Arguments to pass to cl",
+    )
+
+
+class Invocation(Dict):
+    def __init__(self, args: List[str]):
+        super().__init__()
+        self["args"] = args
+        self["sources"] = []
+        self["output"] = None
+        self["compile_only"] = False
+        self["uncacheable"] = None
+        self["show_includes"] = False
+        self["hash_flags"] = []
+        # the flags that still matter once the source is preprocessed, a distcl worker compiles with them
+        self["compile_flags"] = []
+        self["preprocess_args"] = []
+
+        self._parse()
+
+    @staticmethod
+    def _flag(arg: str) -> str:
+        # absolute unix paths also start with /, they are never flags
+        if arg[:1] in ("/", "-") and not os.path.exists(arg):
+            return arg[1:]
+
+        return None
+
+    def _parse(self):
+        output_arg = None
+        for arg in self["args"]:
+            if arg.startswith("@"):
+                self["uncacheable"] = "response file"
+                continue
+
+            flag = self._flag(arg)
+            if flag is None:
+                if arg.lower().endswith(SOURCE_EXTENSIONS):
+                    self["sources"].append(arg)
+                else:
+                    self["hash_flags"].append(arg)
+                self["preprocess_args"].append(arg)
+                continue
+
+            if flag == "c":
+                self["compile_only"] = True
+                continue
+
+            if flag.startswith("Fo"):
+                output_arg = flag[2:]
+                continue
+
+            if flag.startswith("Fd"):
+                continue
+
+            if flag == "showIncludes":
+                self["show_includes"] = True
+
+            if flag.startswith(UNCACHEABLE_FLAGS) or flag in UNCACHEABLE_EXACT_FLAGS:
+                self["uncacheable"] = f"/{flag}"
+
+            if not flag.startswith(IGNORED_FLAGS):
+                self["preprocess_args"].append(arg)
+
+            if flag.startswith(IGNORED_FLAGS):
+                self["hash_flags"].append("/" + flag)
+            elif not flag.startswith(PREPROCESSOR_FLAGS):
+                self["hash_flags"].append("/" + flag)
+                self["compile_flags"].append("/" + flag)
+
+        if self["uncacheable"] is None:
+            if not self["compile_only"]:
+                self["uncacheable"] = "not compiling with /c"
+            elif len(self["sources"]) != 1:
+                self["uncacheable"] = "not exactly one source file"
+
+        if self["sources"]:
+            object_name = Path(self["sources"][0]).with_suffix(".obj").name
+            if output_arg is None:
+                self["output"] = object_name
+            elif output_arg.endswith(("/", "\\")):
+                self["output"] = output_arg + object_name
+            else:
+                self["output"] = output_arg
+
+
+# A ccache like cache for object files.
+# The key is the hash of the preprocessed source, the flags that influence code generation and the toolchain version.
+# Every entry is a directory with the object file and the compiler output, which is replayed on a hit
+# so /showIncludes keeps working for ninja.
+class ObjectCache:
+    def __init__(self, config: operations.utils.LinuxMsvcConfig):
+        self.config = config
+        self.cache_dir = config.destination() / "cache" / "objects"
+        self.tmp_dir = self.cache_dir / "tmp"
+        self.stats_file = self.cache_dir / "stats.json"
+        self.max_size = operations.utils.parse_size(config.get("object_cache_max_size", DEFAULT_MAX_SIZE))
+
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def _locked_stats(self):
+        with open(self.cache_dir / "stats.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                stats = self.stats()
+                yield stats
+                with open(self.stats_file, "w") as f:
+                    json.dump(stats, f, indent=4)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def stats(self) -> Dict:
+        try:
+            with open(self.stats_file, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"hits": 0, "misses": 0, "uncacheable": 0, "errors": 0, "stores_since_cleanup": 0}
+
+    def count(self, key: str) -> Dict:
+        with self._locked_stats() as stats:
+            stats[key] = stats.get(key, 0) + 1
+            return dict(stats)
+
+    def zero_stats(self):
+        with self._locked_stats() as stats:
+            for key in stats:
+                stats[key] = 0
+
+    def entry_dir(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    # returns the entry directory if the key is cached
+    def lookup(self, key: str) -> Path:
+        entry = self.entry_dir(key)
+        if not (entry / "object.obj").exists():
+            return None
+
+        try:
+            os.utime(entry / "meta.json")
+        except FileNotFoundError:
+            return None
+
+        return entry
+
+    # store the result of a compilation, the entry only becomes visible once it is complete
+    def store(self, key: str, object_file: Path, stdout: bytes, stderr: bytes):
+        tmp_entry = Path(tempfile.mkdtemp(dir=self.tmp_dir))
+        shutil.copyfile(object_file, tmp_entry / "object.obj")
+        (tmp_entry / "stdout").write_bytes(stdout)
+        (tmp_entry / "stderr").write_bytes(stderr)
+        with open(tmp_entry / "meta.json", "w") as f:
+            json.dump({"created": time.time(), "size": object_file.stat().st_size}, f)
+
+        entry = self.entry_dir(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+        stats = self.count("stores_since_cleanup")
+        if stats["stores_since_cleanup"] >= CLEANUP_INTERVAL:
+            self.cleanup()
+
+    def entries(self) -> List[Path]:
+        return [entry for entry in self.cache_dir.glob("??/*") if (entry / "meta.json").exists()]
+
+    def size(self) -> int:
+        return sum(file.stat().st_size for entry in self.entries() for file in entry.iterdir())
+
+    # remove the least recently used entries until the cache is below 90% of its maximum size
+    def cleanup(self, max_size: int = None):
+        if max_size is None:
+            max_size = self.max_size
+
+        entries = []
+        total = 0
+        for entry in self.entries():
+            size = sum(file.stat().st_size for file in entry.iterdir())
+            entries.append(((entry / "meta.json").stat().st_mtime, size, entry))
+            total += size
+
+        for _, size, entry in sorted(entries):
+            if total <= max_size * 0.9:
+                break
+
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+        with self._locked_stats() as stats:
+            stats["stores_since_cleanup"] = 0
+
+    def clear(self):
+        for entry in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+# the compiler the objects come from, independent of the PATH of the caller
+# the PATH only has the msvc wrappers once set_env ran, which is skipped while the daemon is running
+# a reinstalled msvc gets new wrappers, so their size and mtime change the id as well
+def _toolchain_id(config: operations.utils.LinuxMsvcConfig) -> str:
+    wrapper = config.msvc_bin_dir() / "cl"
+    stat = wrapper.stat() if wrapper.exists() else None
+    return "|".join([
+        str(config.get("msvc_version")),
+        str(config.get("sdk_version")),
+        str(config.msvc_bin_dir()),
+        f"{stat.st_size}:{stat.st_mtime_ns}" if stat else "",
+    ])
+
+
+# run a command, through the daemon if it is running
+def _run(config: operations.utils.LinuxMsvcConfig, argv: List[str], stdout, stderr) -> int:
+    returncode = operations.daemon.run(config, argv, [0, stdout.fileno(), stderr.fileno()])
+    if returncode is None:
+        # the daemon was up when cl started, so the environment isn't set yet
+        operations.utils.set_env(config, {})
+        returncode = subprocess.run(argv, stdout=stdout, stderr=stderr).returncode
+
+    stdout.seek(0)
+    stderr.seek(0)
+    return returncode
+
+
+# returns the preprocessed source and what cl printed to stderr, or None if the preprocessor failed
+# with /showIncludes the included files are printed to stderr, the preprocessed source stays the same
+def _preprocess(config: operations.utils.LinuxMsvcConfig, invocation: Invocation, show_includes=False):
+    argv = ["cl"] + invocation["preprocess_args"] + (["/showIncludes"] if show_includes else []) + ["/E"]
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        if _run(config, argv, stdout, stderr) != 0:
+            return None
+
+        return stdout.read(), stderr.read()
+
+
+def _hash_preprocessed(config: operations.utils.LinuxMsvcConfig, invocation: Invocation, preprocessed: bytes) -> str:
+    sha = hashlib.sha256()
+    sha.update(f"{CACHE_FORMAT_VERSION}\0{_toolchain_id(config)}\0".encode())
+    sha.update("\0".join(invocation["hash_flags"]).encode())
+    sha.update(preprocessed)
+
+    return sha.hexdigest()
+
+
+# distcl brings the socket server, the prefix pool and the runner with it, so it is only imported with workers
+def _distcl_enabled(config: operations.utils.LinuxMsvcConfig) -> bool:
+    if os.environ.get("LINUX_MSVC_DISTCL_WORKERS") is None and not config.get("distcl_workers"):
+        return False
+
+    import operations.distcl
+    return operations.distcl.enabled(config)
+
+
+def _compile_remote(config: operations.utils.LinuxMsvcConfig, invocation: Dict, preprocessed: Tuple[bytes, bytes],
+                    verbose=False) -> Tuple[int, bytes, bytes]:
+    import operations.distcl
+    return operations.distcl.compile_remote(config, invocation, *preprocessed, verbose=verbose)
+
+
+def cl(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    if not operations.daemon.is_running(config):
+        operations.utils.set_env(config, args)
+
+    cache = ObjectCache(config)
+    invocation = Invocation(args["args"])
+
+    # with distcl, the source is only preprocessed once, for the key and for the worker
+    distributed = _distcl_enabled(config)
+
+    key = None
+    preprocessed = None
+    if invocation["uncacheable"] is not None:
+        if args["verbose"]:
+            print(f"linux-msvc cl: not cacheable, {invocation['uncacheable']}", file=sys.stderr)
+        cache.count("uncacheable")
+    else:
+        preprocessed = _preprocess(config, invocation, show_includes=distributed and invocation["show_includes"])
+        if preprocessed is None:
+            cache.count("errors")
+        else:
+            key = _hash_preprocessed(config, invocation, preprocessed[0])
+
+    if key is not None:
+        entry = cache.lookup(key)
+        if entry is not None:
+            tmp_output = invocation["output"] + ".tmp"
+            shutil.copyfile(entry / "object.obj", tmp_output)
+            os.replace(tmp_output, invocation["output"])
+
+            sys.stdout.buffer.write((entry / "stdout").read_bytes())
+            sys.stderr.buffer.write((entry / "stderr").read_bytes())
+            cache.count("hits")
+            sys.exit(0)
+
+        cache.count("misses")
+
+    if key is None:
+        returncode = operations.daemon.run(config, ["cl"] + args["args"])
+        if returncode is None:
+            operations.utils.set_env(config, args)
+            returncode = subprocess.run(["cl"] + args["args"]).returncode
+        sys.exit(returncode)
+
+    result = None
+    if distributed:
+        result = _compile_remote(config, invocation, preprocessed, verbose=args["verbose"])
+        cache.count("remote" if result is not None else "remote_fallbacks")
+
+    if result is not None:
+        returncode, stdout_data, stderr_data = result
+    else:
+        with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+            returncode = _run(config, ["cl"] + args["args"], stdout, stderr)
+            stdout_data = stdout.read()
+            stderr_data = stderr.read()
+
+    sys.stdout.buffer.write(stdout_data)
+    sys.stderr.buffer.write(stderr_data)
+
+    if returncode == 0 and os.path.exists(invocation["output"]):
+        cache.store(key, Path(invocation["output"]), stdout_data, stderr_data)
+
+    sys.exit(returncode)
+
+
+def print_stats(config: operations.utils.LinuxMsvcConfig):
+    cache = ObjectCache(config)
+    stats = cache.stats()
+
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = 100 * stats["hits"] / lookups if lookups else 0
+    print(f"hits:        {stats['hits']}")
+    print(f"misses:      {stats['misses']}")
+    print(f"hit rate:    {hit_rate:.1f}%")
+    print(f"uncacheable: {stats['uncacheable']}")
+    print(f"errors:      {stats['errors']}")
+    if _distcl_enabled(config):
+        print(f"remote:      {stats.get('remote', 0)}")
+        print(f"fallbacks:   {stats.get('remote_fallbacks', 0)}")
+    print(f"size:        {operations.utils.format_size(cache.size())} of {operations.utils.format_size(cache.max_size)}")
@@ -0,0 +1,466 @@
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List
+
+import operations.prefix
+import operations.remove
+import operations.runner
+import operations.utils
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+# every prefix runs its own wineserver and a test program next to it
+MEMORY_PER_PREFIX = 1024 ** 3
+WAIT_SAMPLES = 1000
+POLL_INTERVAL = 0.005
+MAX_POLL_INTERVAL = 0.05
+
+# exists while a job holds a prefix, a prefix that still has it when it is leased again was left by a crashed job
+DIRTY_MARKER = ".linux-msvc-leased"
+# crashed: only prefixes of crashed jobs are cloned again, always: every job gets a fresh prefix
+RECYCLE_POLICIES = ["crashed", "always"]
+DEFAULT_RECYCLE_POLICY = "crashed"
+
+
+def init_subparser(subparser):
+    pool_parser = subparser.add_parser(
+        "pool",
+        help="Run tests and build jobs in parallel on a pool of cloned wine prefixes, each with its own wineserver",
+    )
+
+    pool_operation_subparser = pool_parser.add_subparsers(help="pool operation to perform", dest="pool_operation")
+    create_parser = pool_operation_subparser.add_parser(
+        "create",
+        help="Clone the wine prefix into the pool and start the wineservers",
+    )
+    run_parser = pool_operation_subparser.add_parser(
+        "run",
+        prefix_chars="+",
+        help="Run a windows program on the next free prefix. Use this as exe_wrapper.",
+    )
+    exec_parser = pool_operation_subparser.add_parser(
+        "exec",
+        help="Lease a prefix for a whole build job and run a command with the environment set up for it, "
+             "e.g. 'linux-msvc pool exec -- meson test'",
+    )
+    pool_operation_subparser.add_parser("status", help="Show the leases and the queue statistics")
+    pool_operation_subparser.add_parser("destroy", help="Stop the wineservers and delete the pool")
+
+    create_parser.add_argument(
+        "--size",
+        type=int,
+        default=None,
+        help="The number of prefixes. Defaults to the prefix_pool_size config value or the number of cpus, "
+             "limited by the available memory.",
+    )
+
+    exec_parser.add_argument(
+        "--recycle",
+        default=None,
+        choices=RECYCLE_POLICIES,
+        help="When a prefix is cloned again. Defaults to the prefix_pool_recycle config value or crashed.",
+    )
+
+    exec_parser.add_argument(
+        "command",
+        nargs=argparse.REMAINDER,
+        help="The command to run",
+    )
+
+    run_parser.add_argument(
+        "args",
+        nargs=argparse.REMAINDER,
+        help="Arguments to pass to wine",
+    )
+
+
+# one prefix per cpu, but never more than the memory can hold
+def default_size() -> int:
+    size = os.cpu_count() or 1
+
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    size = min(size, available // MEMORY_PER_PREFIX)
+                    break
+    except (FileNotFoundError, ValueError):
+        pass
+
+    return max(1, size)
+
+
+# A fixed number of wine prefixes that are handed out one at a time.
+# Every slot has a lock file, a lease is an exclusive flock on it. The kernel drops the lock when the
+# process holding it exits, so a crashed test never blocks a slot.
+class PrefixPool:
+    def __init__(self, config: operations.utils.LinuxMsvcConfig):
+        self.config = config
+        self.pool_dir = config.destination() / "pool"
+        self.stats_file = self.pool_dir / "stats.json"
+
+    def slot_dir(self, index: int) -> Path:
+        return self.pool_dir / f"prefix-{index}"
+
+    def lock_file(self, index: int) -> Path:
+        return self.pool_dir / f"prefix-{index}.lock"
+
+    def slots(self) -> List[int]:
+        indices = []
+        for path in self.pool_dir.glob("prefix-*.lock"):
+            index = path.stem[len("prefix-"):]
+            if index.isdigit() and self.slot_dir(int(index)).is_dir():
+                indices.append(int(index))
+
+        return sorted(indices)
+
+    @contextmanager
+    def _locked_stats(self):
+        with open(self.pool_dir / "stats.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                stats = self.stats()
+                yield stats
+                tmp_file = self.stats_file.with_suffix(".tmp")
+                with open(tmp_file, "w") as f:
+                    json.dump(stats, f)
+                os.replace(tmp_file, self.stats_file)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def stats(self) -> Dict:
+        try:
+            with open(self.stats_file, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"leases": 0, "waited": 0, "queue_depth": 0, "wait_times": [], "slot_leases": {}}
+
+    def _try_lock(self, index: int):
+        lock = open(self.lock_file(index), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+
+        return lock
+
+    # lease a free slot, waiting until one becomes free
+    # returns the slot index and the open lock file, the lease ends when the lock file is closed
+    def acquire(self):
+        slots = self.slots()
+        if not slots:
+            raise FileNotFoundError("The prefix pool is empty, create it with 'linux-msvc pool create'.")
+
+        # start at a different slot in every process, so the first attempt usually succeeds
+        offset = os.getpid() % len(slots)
+        order = slots[offset:] + slots[:offset]
+
+        start = time.monotonic()
+        queued = False
+        interval = POLL_INTERVAL
+        try:
+            while True:
+                for index in order:
+                    lock = self._try_lock(index)
+                    if lock is not None:
+                        break
+                else:
+                    if not queued:
+                        queued = True
+                        with self._locked_stats() as stats:
+                            stats["queue_depth"] += 1
+
+                    time.sleep(interval)
+                    interval = min(interval * 2, MAX_POLL_INTERVAL)
+                    continue
+
+                break
+        except BaseException:
+            if queued:
+                with self._locked_stats() as stats:
+                    stats["queue_depth"] = max(0, stats["queue_depth"] - 1)
+            raise
+
+        wait_time = time.monotonic() - start
+        with self._locked_stats() as stats:
+            stats["leases"] += 1
+            stats["slot_leases"][str(index)] = stats["slot_leases"].get(str(index), 0) + 1
+            if queued:
+                stats["waited"] += 1
+                stats["queue_depth"] = max(0, stats["queue_depth"] - 1)
+            stats["wait_times"] = (stats["wait_times"] + [wait_time])[-WAIT_SAMPLES:]
+
+        # the holder is only informational, the lock itself is what counts
+        lock.truncate(0)
+        lock.write(f"{os.getpid()}\n")
+        lock.flush()
+        return index, lock
+
+    @contextmanager
+    def lease(self):
+        index, lock = self.acquire()
+        try:
+            yield index, lock
+        finally:
+            lock.close()
+
+    # the pid of the process holding a slot, or None if it is free
+    def holder(self, index: int) -> int:
+        lock = self._try_lock(index)
+        if lock is not None:
+            lock.close()
+            return None
+
+        try:
+            return int(self.lock_file(index).read_text().strip())
+        except ValueError:
+            return -1
+
+    def wineserver(self, index: int, *args: str):
+        env = dict(os.environ)
+        env["WINEPREFIX"] = str(self.slot_dir(index))
+        operations.runner.get_runner(self.config).run(
+            ["wineserver"] + list(args),
+            timeout=operations.runner.WINESERVER_TIMEOUT,
+            env=env,
+            prefix=f"wineserver {index}",
+        )
+
+    # the copy of the wine prefix the slots are cloned from when there is no prefix template
+    def pristine_dir(self) -> Path:
+        return self.pool_dir / "pristine"
+
+    # Without a template, the wine prefix is copied once when the pool is created.
+    # Its wineserver must not run while it is copied, and stopping it would break every other user of the
+    # prefix, like the daemon, so recycling a slot later copies the pristine prefix instead.
+    def _prepare_clone(self, verbose=False):
+        source = operations.prefix.prefix_location(self.config)
+        if operations.prefix.has_template(self.config) or self.pristine_dir().exists():
+            return
+
+        if not source.exists():
+            print(f"There is no wine prefix at {source} to clone.")
+            sys.exit(1)
+
+        if verbose:
+            print(f"copying the wine prefix into {self.pristine_dir()}")
+
+        # the registry is only complete on disk once the wineserver exited
+        runner = operations.runner.get_runner(self.config)
+        runner.run(["wineserver", "-k"], timeout=operations.runner.WINESERVER_TIMEOUT)
+        runner.run(["wineserver", "-w"], timeout=operations.runner.WINESERVER_TIMEOUT)
+
+        tmp_target = self.pristine_dir().with_name(".pristine.tmp")
+        shutil.rmtree(tmp_target, ignore_errors=True)
+        operations.prefix.copy_tree(self.config, source, tmp_target, verbose)
+        os.replace(tmp_target, self.pristine_dir())
+
+    # clone the prefix template, or the pristine copy of the wine prefix if there is no template, into a slot
+    def _clone(self, index: int, verbose=False):
+        if verbose:
+            print(f"cloning the wine prefix into {self.slot_dir(index)}")
+
+        if operations.prefix.has_template(self.config):
+            operations.prefix.restore(self.config, target=self.slot_dir(index), verbose=verbose)
+            return
+
+        if not self.pristine_dir().exists():
+            print("The prefix pool has no copy of the wine prefix, create it again with 'linux-msvc pool create'.")
+            sys.exit(1)
+
+        tmp_target = self.slot_dir(index).with_name(f".prefix-{index}.tmp")
+        shutil.rmtree(tmp_target, ignore_errors=True)
+        operations.prefix.copy_tree(self.config, self.pristine_dir(), tmp_target, verbose)
+        os.replace(tmp_target, self.slot_dir(index))
+
+    # clone the prefix into every missing slot and start a persistent wineserver for each
+    def create(self, size: int, verbose=False):
+        self.pool_dir.mkdir(parents=True, exist_ok=True)
+        operations.utils.set_env(self.config, {}, verbose)
+
+        missing = [index for index in range(size) if not self.slot_dir(index).exists()]
+        self._prepare_clone(verbose)
+
+        for index in range(size):
+            if index in missing:
+                self._clone(index, verbose)
+
+            self.lock_file(index).touch()
+            self.wineserver(index, "-p")
+
+        print(f"the prefix pool has {len(self.slots())} prefixes")
+
+    # replace a leased slot with a fresh clone, the caller must hold the lease
+    def recycle(self, index: int, verbose=False):
+        self.wineserver(index, "-k")
+        try:
+            operations.remove.RemoveDirectory(
+                self.slot_dir(index),
+                verbose=verbose,
+                directory_name=f"prefix-{index}",
+            ).remove(background=True)
+        except FileNotFoundError:
+            pass
+
+        self._clone(index, verbose)
+        self.wineserver(index, "-p")
+
+        with self._locked_stats() as stats:
+            stats["recycled"] = stats.get("recycled", 0) + 1
+
+    def destroy(self, verbose=False):
+        if not self.pool_dir.exists():
+            return
+
+        operations.utils.set_env(self.config, {}, verbose)
+        for index in self.slots():
+            self.wineserver(index, "-k")
+
+        operations.remove.RemoveDirectory(
+            self.pool_dir,
+            verbose=verbose,
+            directory_name="prefix pool",
+        ).remove(background=True)
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# the exe_wrapper mode: run the program on a leased prefix
+def run(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    operations.utils.set_env(config, args)
+    wine_command = ["wine-msvc.sh"] + args["args"]
+
+    # inside 'pool exec' the job already has a prefix of its own
+    if os.environ.get(operations.utils.LEASED_PREFIX_ENV):
+        sys.exit(subprocess.run(wine_command).returncode)
+
+    pool = PrefixPool(config)
+    try:
+        index, lock = pool.acquire()
+    except FileNotFoundError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    os.environ["WINEPREFIX"] = str(pool.slot_dir(index))
+
+    # the child inherits the lock, so the slot stays leased even if this process gets killed first
+    with lock:
+        returncode = subprocess.run(wine_command, pass_fds=[lock.fileno()]).returncode
+
+    sys.exit(returncode)
+
+
+# the build job mode: lease a prefix for the whole command
+# all linux-msvc calls inside the job use the leased prefix instead of the one of the installation
+def run_job(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    command = args["command"]
+    if command[:1] == ["--"]:
+        command = command[1:]
+    if not command:
+        print("No command was given.")
+        sys.exit(1)
+
+    operations.utils.set_env(config, args)
+    if os.environ.get(operations.utils.LEASED_PREFIX_ENV):
+        print("This job already has a prefix, running the command in it.")
+        sys.exit(subprocess.run(command).returncode)
+
+    recycle_policy = args["recycle"] or config.get("prefix_pool_recycle", DEFAULT_RECYCLE_POLICY)
+
+    pool = PrefixPool(config)
+    try:
+        index, lock = pool.acquire()
+    except FileNotFoundError as e:
+        print(e)
+        sys.exit(1)
+
+    slot = pool.slot_dir(index)
+    marker = slot / DIRTY_MARKER
+    with lock:
+        if marker.exists():
+            if args["verbose"]:
+                print(f"prefix-{index} was used by an earlier job, cloning it again")
+            pool.recycle(index, args["verbose"])
+
+        marker.write_text(f"{os.getpid()}\n")
+
+        os.environ["WINEPREFIX"] = str(slot)
+        os.environ[operations.utils.LEASED_PREFIX_ENV] = str(slot)
+        if args["verbose"]:
+            print(f"leased prefix-{index} for {' '.join(command)}")
+
+        # the job inherits the lock, so the prefix stays leased as long as the job runs
+        try:
+            returncode = subprocess.run(command, pass_fds=[lock.fileno()]).returncode
+        except KeyboardInterrupt:
+            returncode = 130
+
+        # with the marker left in place, the next job gets a fresh clone
+        if recycle_policy != "always":
+            marker.unlink(missing_ok=True)
+
+    sys.exit(returncode)
+
+
+def print_status(config: operations.utils.LinuxMsvcConfig):
+    pool = PrefixPool(config)
+    slots = pool.slots()
+    if not slots:
+        print("There is no prefix pool.")
+        return
+
+    stats = pool.stats()
+    for index in slots:
+        holder = pool.holder(index)
+        state = "free" if holder is None else f"leased by {holder}"
+        print(f"prefix-{index:<4} {state:<20} {stats['slot_leases'].get(str(index), 0)} leases")
+
+    wait_times = stats["wait_times"]
+    p50 = percentile(wait_times, 0.5)
+    p95 = percentile(wait_times, 0.95)
+    print(f"leases:      {stats['leases']}")
+    print(f"waited:      {stats['waited']}")
+    print(f"queue depth: {stats['queue_depth']}")
+    if p50 is not None:
+        print(f"wait p50:    {p50 * 1000:.1f}ms")
+        print(f"wait p95:    {p95 * 1000:.1f}ms")
+    print(f"recycled:    {stats.get('recycled', 0)}")
+
+
+def pool_command(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    pool = PrefixPool(config)
+    match args["pool_operation"]:
+        case "create":
+            size = args["size"]
+            if size is None:
+                size = int(config.get("prefix_pool_size", default_size()))
+            pool.create(size, args["verbose"])
+        case "run":
+            run(config, args)
+        case "exec":
+            run_job(config, args)
+        case "status":
+            print_status(config)
+        case "destroy":
+            pool.destroy(args["verbose"])
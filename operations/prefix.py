@@ -0,0 +1,217 @@
+import json
+import os
+import shutil
+import sys
+import time
+
+from pathlib import Path
+from typing import Dict
+
+import operations.remove
+import operations.runner
+import operations.utils
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+DEFAULT_TEMPLATE = "default"
+TEMPLATE_FORMATS = ["copy", "tar"]
+
+
+def init_subparser(subparser):
+    prefix_parser = subparser.add_parser("prefix", help="Save and restore fully set up wine prefixes")
+
+    prefix_operation_subparser = prefix_parser.add_subparsers(help="prefix operation to perform", dest="prefix_operation")
+    snapshot_parser = prefix_operation_subparser.add_parser("snapshot", help="Save the current wine prefix as template")
+    restore_parser = prefix_operation_subparser.add_parser("restore", help="Replace the wine prefix with a template")
+    prefix_operation_subparser.add_parser("ls", help="List all templates")
+    rm_parser = prefix_operation_subparser.add_parser("rm", help="Delete a template")
+
+    for operation_parser in [snapshot_parser, restore_parser, rm_parser]:
+        operation_parser.add_argument(
+            "--name",
+            default=DEFAULT_TEMPLATE,
+            help="The name of the template. 'config reset wine_prefix' uses the template called default.",
+        )
+
+    snapshot_parser.add_argument(
+        "--format",
+        default="copy",
+        choices=TEMPLATE_FORMATS,
+        help="copy keeps the template as directory, which is restored with reflinks if the filesystem supports it. "
+             "tar stores a compressed archive, which uses less disk but is slower to restore.",
+    )
+
+
+def prefix_location(config: operations.utils.LinuxMsvcConfig) -> Path:
+    if not config["no_wine_prefix"]:
+        return config.destination() / ".wineenv"
+
+    if os.environ.get("WINEPREFIX"):
+        return Path(os.environ["WINEPREFIX"])
+
+    return Path("~/.wine").expanduser()
+
+
+def templates_dir(config: operations.utils.LinuxMsvcConfig) -> Path:
+    return config.destination() / "templates"
+
+
+def template_info(config: operations.utils.LinuxMsvcConfig, name: str) -> Dict:
+    try:
+        with open(templates_dir(config) / f"{name}.json", "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def has_template(config: operations.utils.LinuxMsvcConfig, name: str = DEFAULT_TEMPLATE) -> bool:
+    return template_info(config, name) is not None
+
+
+# copy a directory tree, using reflinks where the filesystem supports them
+def copy_tree(config: operations.utils.LinuxMsvcConfig, source: Path, target: Path, verbose=False):
+    if shutil.which("cp") is not None:
+        result = operations.runner.get_runner(config, verbose).run(["cp", "-a", "--reflink=auto", source, target])
+        if result["returncode"] == 0:
+            return
+
+        shutil.rmtree(target, ignore_errors=True)
+
+    shutil.copytree(source, target, symlinks=True)
+
+
+def snapshot(config: operations.utils.LinuxMsvcConfig, name: str = DEFAULT_TEMPLATE, template_format="copy",
+             verbose=False):
+    prefix = prefix_location(config)
+    if not prefix.exists():
+        print(f"There is no wine prefix at {prefix}.")
+        sys.exit(1)
+
+    operations.utils.set_env(config, {}, verbose)
+
+    # the wineserver writes the registry to disk when it exits
+    if verbose:
+        print("stopping the wineserver")
+    runner = operations.runner.get_runner(config, verbose)
+    runner.run(["wineserver", "-k"], timeout=operations.runner.WINESERVER_TIMEOUT)
+    runner.run(["wineserver", "-w"], timeout=operations.runner.WINESERVER_TIMEOUT)
+
+    directory = templates_dir(config)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    start = time.monotonic()
+    tmp_target = directory / f".{name}.tmp"
+    shutil.rmtree(tmp_target, ignore_errors=True)
+    if template_format == "copy":
+        copy_tree(config, prefix, tmp_target, verbose)
+    else:
+        runner.run(
+            ["tar"] + operations.utils.tar_compression() + ["-cf", str(tmp_target), "-C", str(prefix), "."],
+            check=True,
+        )
+
+    remove_template(config, name)
+    os.replace(tmp_target, directory / name)
+
+    with open(directory / f"{name}.json", "w") as f:
+        json.dump({
+            "format": template_format,
+            "created": time.time(),
+            "source": str(prefix),
+            "toolchain": operations.utils.detect_toolchain_versions(config),
+        }, f, indent=4)
+
+    print(f"saved the wine prefix as template {name} in {time.monotonic() - start:.1f}s")
+
+
+def restore(config: operations.utils.LinuxMsvcConfig, name: str = DEFAULT_TEMPLATE, target: Path = None,
+            verbose=False):
+    info = template_info(config, name)
+    if info is None:
+        raise FileNotFoundError(f"There is no prefix template called {name}.")
+
+    if target is None:
+        target = prefix_location(config)
+
+    operations.utils.set_env(config, {}, verbose)
+    runner = operations.runner.get_runner(config, verbose)
+    runner.run(
+        ["wineserver", "-k"],
+        timeout=operations.runner.WINESERVER_TIMEOUT,
+        env={**os.environ, "WINEPREFIX": str(target)},
+    )
+
+    start = time.monotonic()
+
+    # the template is unpacked next to the prefix first, so a failure leaves the current prefix alone
+    template = templates_dir(config) / name
+    tmp_target = target.parent / f".{target.name}.restore"
+    shutil.rmtree(tmp_target, ignore_errors=True)
+    try:
+        if info["format"] == "copy":
+            copy_tree(config, template, tmp_target, verbose)
+        else:
+            tmp_target.mkdir(parents=True)
+            runner.run(
+                ["tar"] + operations.utils.tar_compression() + ["-xf", str(template), "-C", str(tmp_target)],
+                check=True,
+            )
+    except BaseException:
+        shutil.rmtree(tmp_target, ignore_errors=True)
+        raise
+
+    try:
+        operations.remove.RemoveDirectory(
+            target,
+            verbose=verbose,
+            directory_name="wine prefix",
+        ).remove(background=True)
+    except FileNotFoundError:
+        pass
+
+    os.replace(tmp_target, target)
+    print(f"restored the wine prefix from template {name} in {time.monotonic() - start:.1f}s")
+
+
+def remove_template(config: operations.utils.LinuxMsvcConfig, name: str):
+    template = templates_dir(config) / name
+    if template.is_dir():
+        shutil.rmtree(template)
+    elif template.exists():
+        template.unlink()
+
+    (templates_dir(config) / f"{name}.json").unlink(missing_ok=True)
+
+
+def list_templates(config: operations.utils.LinuxMsvcConfig):
+    directory = templates_dir(config)
+    if not directory.exists():
+        print("There are no prefix templates.")
+        return
+
+    for info_file in sorted(directory.glob("*.json")):
+        with open(info_file, "r") as f:
+            info = json.load(f)
+
+        created = time.strftime("%Y-%m-%d %H:%M", time.localtime(info["created"]))
+        print(f"{info_file.stem:<20}  {info['format']:<5}  {created}  {info['source']}")
+
+
+def prefix_command(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    match args["prefix_operation"]:
+        case "snapshot":
+            snapshot(config, args["name"], args["format"], args["verbose"])
+        case "restore":
+            try:
+                restore(config, args["name"], verbose=args["verbose"])
+            except FileNotFoundError as e:
+                print(e)
+                sys.exit(1)
+        case "ls":
+            list_templates(config)
+        case "rm":
+            remove_template(config, args["name"])
@@ -0,0 +1,158 @@
+import atexit
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+# Records spans in the chrome trace event format, which can be opened in https://ui.perfetto.dev or chrome://tracing.
+# Every span is a complete event ("ph": "X") on the thread that created it, so parallel install steps
+# show up as parallel tracks.
+class Tracer:
+    def __init__(self, trace_file: Path):
+        self.trace_file = trace_file
+        self.events = []
+        self.lock = threading.Lock()
+        self.thread_ids = {}
+        self.pid = os.getpid()
+
+    @staticmethod
+    def now() -> float:
+        return time.monotonic() * 1e6
+
+    # small thread ids with a name, so the tracks are readable
+    def _thread_id(self) -> int:
+        ident = threading.get_ident()
+        if ident not in self.thread_ids:
+            self.thread_ids[ident] = len(self.thread_ids) + 1
+            self.events.append({
+                "name": "thread_name",
+                "ph": "M",
+                "pid": self.pid,
+                "tid": self.thread_ids[ident],
+                "args": {"name": threading.current_thread().name},
+            })
+
+        return self.thread_ids[ident]
+
+    def add(self, name: str, category: str, start: float, end: float, args: Dict):
+        with self.lock:
+            self.events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start,
+                "dur": end - start,
+                "pid": self.pid,
+                "tid": self._thread_id(),
+                "args": args,
+            })
+
+    def save(self):
+        with self.lock:
+            events = list(self.events)
+
+        self.trace_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.trace_file, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+_tracer: Tracer = None
+
+
+# A Popen that records a span for every child process, with the exit code and the peak memory use.
+# os.wait4 returns the resource usage of exactly this child, even if other children run at the same time.
+class TracedPopen(subprocess.Popen):
+    def __init__(self, args, *popen_args, **kwargs):
+        self._trace_start = Tracer.now()
+        self._trace_rusage = None
+        self._traced = False
+        super().__init__(args, *popen_args, **kwargs)
+
+    def _try_wait(self, wait_flags):
+        try:
+            pid, status, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return self.pid, 0
+
+        if pid == self.pid:
+            self._trace_rusage = rusage
+        return pid, status
+
+    def _record(self):
+        if self._traced or self.returncode is None or _tracer is None:
+            return
+        self._traced = True
+
+        argv = [self.args] if isinstance(self.args, (str, bytes, os.PathLike)) else list(self.args)
+        argv = [os.fsdecode(arg) for arg in argv]
+
+        args = {"argv": argv, "exit_code": self.returncode}
+        if self._trace_rusage is not None:
+            # ru_maxrss is in kilobytes on linux
+            args["peak_rss_bytes"] = self._trace_rusage.ru_maxrss * 1024
+            args["user_time"] = self._trace_rusage.ru_utime
+            args["system_time"] = self._trace_rusage.ru_stime
+
+        _tracer.add(os.path.basename(argv[0]), "subprocess", self._trace_start, Tracer.now(), args)
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        self._record()
+        return returncode
+
+    def poll(self):
+        returncode = super().poll()
+        self._record()
+        return returncode
+
+
+# start recording, the trace is written when the process exits
+# everything until then is covered by a span with the given name
+def enable(trace_file: str, name: str = "linux-msvc"):
+    global _tracer
+
+    _tracer = Tracer(Path(trace_file).expanduser())
+    subprocess.Popen = TracedPopen
+
+    start = Tracer.now()
+    argv = list(sys.argv)
+
+    def finish():
+        _tracer.add(name, "operation", start, Tracer.now(), {"argv": argv})
+        _tracer.save()
+
+    atexit.register(finish)
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+# record a span around a block
+# the yielded dict becomes the args of the span, so the block can add its own values like transferred bytes
+@contextmanager
+def span(name: str, category: str, **args):
+    if _tracer is None:
+        yield args
+        return
+
+    start = Tracer.now()
+    try:
+        yield args
+    except BaseException as e:
+        args["error"] = repr(e)
+        raise
+    finally:
+        _tracer.add(name, category, start, Tracer.now(), args)
@@ -1,9 +1,13 @@
 import os
 import shutil
+import subprocess
 import sys
+import time
+import operations.journal
 import operations.utils
 
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
 from pathlib import Path
 
 # don't allow running the file as script
@@ -58,6 +62,24 @@ def init_subparser(subparser):
         help="Don't delete the vcpkg installation. This will keep the vcpkg installation.",
     )
 
+    remove_parser.add_argument(
+        "--background",
+        action="store_true",
+        default=False,
+        help="Return right away and delete the files in the background.",
+    )
+
+    remove_parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=8,
+        help="How many threads delete files at the same time.",
+    )
+
+
+TRASH_DIR_NAME = ".linux-msvc-trash"
+
 
 class RemoveDirectory(Dict):
     def __init__(
@@ -76,14 +98,151 @@ class RemoveDirectory(Dict):
         else:
             self["directory_name"] = directory_name
 
-    def remove(self):
+    # move the directory into the trash next to it
+    # this is a single rename, the actual deletion happens in empty_trash
+    # returns the trash directory or None if nothing was moved
+    def trash(self) -> Path:
         if not self["condition"]:
+            return None
+
+        if not self["path"].exists():
+            return None
+
+        if self["verbose"]:
+            print(f"Removing {self['directory_name']} directory: {self['path']}")
+
+        trash_dir = self["path"].parent / TRASH_DIR_NAME
+        trash_dir.mkdir(exist_ok=True)
+        os.rename(self["path"], trash_dir / f"{time.time_ns()}-{os.getpid()}-{self['path'].name}")
+        return trash_dir
+
+    def remove(self, background=False):
+        trash_dir = self.trash()
+        if trash_dir is None:
             return
 
-        if self["path"].exists():
-            if self["verbose"]:
-                print(f"Removing {self['directory_name']} directory: {self['path']}")
-            shutil.rmtree(self["path"])
+        if background:
+            empty_trash_in_background(trash_dir)
+        else:
+            empty_trash(trash_dir)
+
+
+def _unlink_all(directory: str, names: List[str]) -> List[int]:
+    files = 0
+    freed = 0
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            stat = os.lstat(path)
+            os.unlink(path)
+        except FileNotFoundError:
+            continue
+
+        files += 1
+        freed += stat.st_blocks * 512
+
+    return [files, freed]
+
+
+# delete a directory tree, the files of different directories are deleted in parallel
+# returns the number of deleted files and the freed bytes
+def delete_tree(path: Path, jobs: int = 8) -> List[int]:
+    directories = []
+    files = 0
+    freed = 0
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for root, dirnames, filenames in os.walk(path):
+            directories.append(root)
+
+            # symlinks to directories (like the dosdevices of a wine prefix) are removed, never followed
+            links = [name for name in dirnames if os.path.islink(os.path.join(root, name))]
+            futures.append(executor.submit(_unlink_all, root, filenames + links))
+
+        for future in futures:
+            deleted_files, deleted_bytes = future.result()
+            files += deleted_files
+            freed += deleted_bytes
+
+    # another process emptying the same trash may still be deleting files in a directory, or have removed it
+    # already; what it leaves behind is deleted by the next empty_trash
+    for directory in reversed(directories):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+    return [files, freed]
+
+
+# delete everything in the trash directory, including leftovers of earlier interrupted removals
+def empty_trash(trash_dir: Path, jobs: int = 8, verbose=True):
+    if not trash_dir.exists():
+        return
+
+    start = time.monotonic()
+    files = 0
+    freed = 0
+    try:
+        entries = list(trash_dir.iterdir())
+    except FileNotFoundError:
+        # emptied by another process in the meantime
+        entries = []
+
+    for entry in entries:
+        if entry.is_dir() and not entry.is_symlink():
+            deleted_files, deleted_bytes = delete_tree(entry, jobs)
+        else:
+            deleted_files, deleted_bytes = _unlink_all(str(trash_dir), [entry.name])
+
+        files += deleted_files
+        freed += deleted_bytes
+
+    try:
+        trash_dir.rmdir()
+    except OSError:
+        pass
+
+    if verbose:
+        print(f"deleted {files} files and freed {operations.utils.format_size(freed)} "
+              f"in {time.monotonic() - start:.1f}s")
+
+
+# empty the trash in a detached process, so the caller can return right away
+def empty_trash_in_background(trash_dir: Path, jobs: int = 8):
+    repo_dir = Path(__file__).resolve().parent.parent
+    subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import sys, pathlib, operations.remove as r; "
+            "r.empty_trash(pathlib.Path(sys.argv[1]), int(sys.argv[2]), verbose=False)",
+            str(trash_dir),
+            str(jobs),
+        ],
+        cwd=repo_dir,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+# the kept checkouts must not depend on the git mirrors in the cache
+# repos brings the command runner with it, so it is only imported when the cache is deleted
+def _dissociate_kept_checkouts(conf: operations.utils.LinuxMsvcConfig, uninstall_conf: Dict):
+    kept = [
+        conf.destination() / name
+        for name, keep in [("msvc-wine-repo", uninstall_conf["keep_msvc"]), ("vcpkg", uninstall_conf["keep_vcpkg"])]
+        if keep and (conf.destination() / name).exists()
+    ]
+    if not kept:
+        return
+
+    import operations.repos
+    for checkout in kept:
+        operations.repos.dissociate(conf, checkout, uninstall_conf["verbose"])
 
 
 def remove(conf: operations.utils.LinuxMsvcConfig, uninstall_conf: Dict):
@@ -124,13 +283,33 @@ def remove(conf: operations.utils.LinuxMsvcConfig, uninstall_conf: Dict):
             condition=uninstall_conf["delete_main_repo"],
             directory_name="main_repo",
         ),
-        RemoveDirectory(
-            operations.utils.Consts.config_file().parent,
-            verbose=uninstall_conf["verbose"],
-            condition=True,
-            directory_name="config folder",
-        ),
     ]
 
+    if uninstall_conf["delete_cache"]:
+        _dissociate_kept_checkouts(conf, uninstall_conf)
+
+    # moving everything into the trash first is fast, so the installation is gone right away
+    trash_dirs = {conf.destination() / TRASH_DIR_NAME}
     for directory in dirs_to_remove:
-        directory.remove()
+        trash_dir = directory.trash()
+        if trash_dir is not None:
+            trash_dirs.add(trash_dir)
+
+    # without the journal a new install starts from scratch instead of skipping the removed steps
+    operations.journal.InstallJournal(conf.destination()).remove()
+
+    # the config folder is small and outside the destination, so it is deleted directly
+    config_dir = operations.utils.Consts.config_file().parent
+    if config_dir.exists():
+        if uninstall_conf["verbose"]:
+            print(f"Removing config folder directory: {config_dir}")
+        shutil.rmtree(config_dir)
+
+    for trash_dir in trash_dirs:
+        if uninstall_conf["background"]:
+            empty_trash_in_background(trash_dir, uninstall_conf["jobs"])
+        else:
+            empty_trash(trash_dir, uninstall_conf["jobs"])
+
+    if uninstall_conf["background"]:
+        print("The files are deleted in the background.")
@@ -0,0 +1,185 @@
+import os
+import shutil
+import subprocess
+import sys
+
+from pathlib import Path
+from typing import Dict, List
+
+import operations.runner
+import operations.utils
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+# full: the whole history
+# blobless: the whole history, but file contents are only fetched when a commit is checked out
+# shallow: only the checked out commit, without a mirror in the cache
+CLONE_MODES = ["full", "blobless", "shallow"]
+DEFAULT_CLONE_MODE = "full"
+
+
+def clone_mode(config: operations.utils.LinuxMsvcConfig) -> str:
+    return config.get("git_clone_mode") or DEFAULT_CLONE_MODE
+
+
+# the commit a repository is pinned to, or None to follow its default branch
+def pinned_commit(config: operations.utils.LinuxMsvcConfig, name: str) -> str:
+    return (config.get("git_commits") or {}).get(name)
+
+
+def mirror_dir(config: operations.utils.LinuxMsvcConfig, name: str) -> Path:
+    return config.destination() / "cache" / "git" / f"{name}.git"
+
+
+def _filter_options(mode: str) -> List[str]:
+    return ["--filter=blob:none"] if mode == "blobless" else []
+
+
+# Every git command goes through the command runner, so a clone or fetch that hangs on the network times out.
+# Checks like cat-file pass check=False and look at the exit code themselves.
+def git(config: operations.utils.LinuxMsvcConfig, args: List[str], cwd: Path = None, check=True, capture=False,
+        verbose=False) -> operations.runner.CommandResult:
+    return operations.runner.get_runner(config, verbose).run(
+        ["git"] + args,
+        timeout=operations.runner.GIT_TIMEOUT,
+        check=check,
+        cwd=str(cwd) if cwd is not None else None,
+        capture=capture,
+    )
+
+
+# A bare mirror of the repository in the cache, it is used as --reference for the checkout.
+# Clones and fetches only have to transfer what the mirror doesn't have. In full mode, a removed checkout is
+# restored from it without downloading anything, a blobless mirror has no file contents, so they are downloaded
+# again. Shallow clones don't have a mirror, since git can't reference them.
+def update_mirror(config: operations.utils.LinuxMsvcConfig, name: str, url: str, verbose=False) -> Path:
+    mode = clone_mode(config)
+    mirror = mirror_dir(config, name)
+    if mode == "shallow":
+        return None
+
+    if (mirror / "HEAD").exists():
+        if verbose:
+            print(f"fetching {url} into {mirror}")
+        git(config, ["fetch", "--prune", "origin"], cwd=mirror, verbose=verbose)
+        return mirror
+
+    if verbose:
+        print(f"mirroring {url} into {mirror}")
+
+    # cloned next to its final location, so an interrupted clone never looks like a mirror
+    tmp_mirror = mirror.with_name(f".{mirror.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_mirror, ignore_errors=True)
+    mirror.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        git(config, ["clone", "--mirror"] + _filter_options(mode) + [url, str(tmp_mirror)], verbose=verbose)
+        os.replace(tmp_mirror, mirror)
+    finally:
+        shutil.rmtree(tmp_mirror, ignore_errors=True)
+
+    return mirror
+
+
+def _rev_parse(config: operations.utils.LinuxMsvcConfig, target: Path, revision: str) -> str:
+    return git(config, ["rev-parse", revision], cwd=target, capture=True)["stdout"].strip()
+
+
+def _has_commit(config: operations.utils.LinuxMsvcConfig, target: Path, commit: str) -> bool:
+    return git(config, ["cat-file", "-e", f"{commit}^{{commit}}"], cwd=target, check=False,
+               capture=True)["returncode"] == 0
+
+
+# fetch the pinned commit if it is missing and check it out, the working tree is not touched otherwise
+def checkout_commit(config: operations.utils.LinuxMsvcConfig, target: Path, commit: str, verbose=False):
+    if not _has_commit(config, target, commit):
+        depth = ["--depth=1"] if clone_mode(config) == "shallow" else []
+        git(config, ["fetch"] + depth + ["origin", commit], cwd=target, verbose=verbose)
+
+    if _rev_parse(config, target, "HEAD") != _rev_parse(config, target, f"{commit}^{{commit}}"):
+        if verbose:
+            print(f"checking out {commit} in {target}")
+        git(config, ["checkout", "--detach", commit], cwd=target, verbose=verbose)
+
+
+# Make sure the repository is checked out in the destination.
+# An existing checkout is kept, it only moves if the config pins it to another commit.
+def clone_repo(config: operations.utils.LinuxMsvcConfig, name: str, url: str, verbose=False):
+    target = config.destination() / name
+    commit = pinned_commit(config, name)
+
+    if not target.exists():
+        mode = clone_mode(config)
+        mirror = update_mirror(config, name, url, verbose)
+
+        options = _filter_options(mode)
+        if mode == "shallow":
+            options += ["--depth=1"]
+        if mirror is not None:
+            options += ["--reference", str(mirror)]
+        if commit is not None:
+            options += ["--no-checkout"]
+
+        if verbose:
+            print(f"cloning {url} into {target}")
+
+        try:
+            git(config, ["clone"] + options + [url, str(target)], verbose=verbose)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            shutil.rmtree(target, ignore_errors=True)
+            raise
+
+    if commit is not None:
+        if not (target / ".git").exists():
+            print(f"{target} is not a git repository, it can't be moved to {commit}.")
+            return
+        checkout_commit(config, target, commit, verbose)
+
+
+# fetch the newest version and fast forward to it, or move to the pinned commit
+def update_repo(config: operations.utils.LinuxMsvcConfig, name: str, url: str, verbose=False):
+    target = config.destination() / name
+    if not target.exists():
+        clone_repo(config, name, url, verbose)
+        return
+
+    old_commit = _rev_parse(config, target, "HEAD")
+
+    update_mirror(config, name, url, verbose)
+    commit = pinned_commit(config, name)
+    detached = git(config, ["symbolic-ref", "-q", "HEAD"], cwd=target, check=False, capture=True)["returncode"] != 0
+    if commit is not None:
+        checkout_commit(config, target, commit, verbose)
+    elif detached:
+        # the pin was removed, back to the default branch of the remote
+        git(config, ["fetch", "origin"], cwd=target, verbose=verbose)
+        git(config, ["checkout", "--detach", "origin/HEAD"], cwd=target, verbose=verbose)
+    else:
+        git(config, ["pull", "--ff-only"], cwd=target, verbose=verbose)
+
+    new_commit = _rev_parse(config, target, "HEAD")
+    if old_commit == new_commit:
+        print(f"{name} is up to date")
+    else:
+        print(f"updated {name} from {old_commit[:10]} to {new_commit[:10]}")
+
+
+# A checkout cloned with --reference reads the objects it shares with the mirror from there.
+# They are copied into the checkout before the mirror is deleted, so a kept checkout still works without it.
+def dissociate(config: operations.utils.LinuxMsvcConfig, path: Path, verbose=False):
+    alternates = path / ".git" / "objects" / "info" / "alternates"
+    if not alternates.exists():
+        return
+
+    if verbose:
+        print(f"copying the objects of the mirror into {path}")
+    git(config, ["repack", "-a", "-d", "-q"], cwd=path, verbose=verbose)
+    alternates.unlink()
+
+
+# the inputs of an install step that clones the repository, the step runs again if they change
+def clone_inputs(config: operations.utils.LinuxMsvcConfig, name: str, url: str) -> Dict:
+    return {"url": url, "mode": clone_mode(config), "commit": pinned_commit(config, name)}
@@ -0,0 +1,269 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from pathlib import Path
+from typing import Dict, List
+
+import operations.utils
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+DEFAULT_TIMEOUT = 2 * 60 * 60
+# wineserver -k/-p/-w only talk to the wineserver, they hang if it is stuck
+WINESERVER_TIMEOUT = 60
+WINEBOOT_TIMEOUT = 10 * 60
+# clones and fetches of vcpkg transfer a lot, but a git command that took this long is stuck on the network
+GIT_TIMEOUT = 30 * 60
+# how long a process gets to exit after SIGTERM before it is killed
+KILL_GRACE_PERIOD = 5.0
+# how long the output is still read after the process exited
+# children that inherited the pipes (like a wineserver started by wine) may keep them open forever
+DRAIN_TIMEOUT = 2.0
+
+
+# The result of a command, the output is only kept if it was captured.
+class CommandResult(Dict):
+    def __init__(self, argv: List[str]):
+        super().__init__()
+        self["argv"] = argv
+        self["returncode"] = None
+        self["duration"] = None
+        self["timed_out"] = False
+        self["stdout"] = ""
+        self["stderr"] = ""
+
+
+# all pids below a process, read from /proc
+# processes like wine detach into their own session, so killing the process group is not always enough
+def descendants(pid: int) -> List[int]:
+    result = []
+    todo = [pid]
+    while todo:
+        current = todo.pop()
+        for task in Path(f"/proc/{current}/task").glob("*"):
+            try:
+                children = (task / "children").read_text().split()
+            except OSError:
+                continue
+
+            for child in children:
+                if int(child) not in result:
+                    result.append(int(child))
+                    todo.append(int(child))
+
+    return result
+
+
+def kill_tree(pid: int, sig: int = signal.SIGKILL):
+    pids = descendants(pid)
+
+    try:
+        os.killpg(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+    for child in [pid] + pids:
+        try:
+            os.kill(child, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+# Runs external commands on an asyncio event loop in a background thread.
+# Any thread can start commands; their output is streamed line by line with the name of the command in front,
+# every command has a timeout after which it is killed with all its children, and the number of commands
+# running at the same time is limited.
+class CommandRunner:
+    def __init__(self, max_commands: int = None, default_timeout: float = DEFAULT_TIMEOUT, verbose=False):
+        self.max_commands = max(1, max_commands or os.cpu_count() or 1)
+        self.default_timeout = default_timeout
+        self.verbose = verbose
+        self.results: List[CommandResult] = []
+        self.lock = threading.Lock()
+        self.running = set()
+        self.output_lock = threading.Lock()
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="command-runner", daemon=True)
+        self.thread.start()
+        self.slots = asyncio.run_coroutine_threadsafe(self._create_semaphore(), self.loop).result()
+
+    async def _create_semaphore(self) -> asyncio.Semaphore:
+        return asyncio.Semaphore(self.max_commands)
+
+    def _write(self, stream, prefix: str, line: bytes):
+        text = line.decode(errors="replace").rstrip("\r\n")
+        with self.output_lock:
+            stream.write(f"[{prefix}] {text}\n" if prefix else text + "\n")
+            stream.flush()
+
+    async def _pump(self, pipe, stream, prefix: str, captured: List[bytes]):
+        reader = asyncio.StreamReader(limit=1024 * 1024)
+        transport, _ = await self.loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # a line longer than the limit, e.g. a progress bar without newlines
+                    line = await reader.read(1024 * 1024)
+
+                if not line:
+                    break
+
+                if captured is not None:
+                    captured.append(line)
+                else:
+                    self._write(stream, prefix, line)
+        finally:
+            transport.close()
+
+    async def _run(self, argv: List[str], timeout: float, env: Dict, cwd: str, prefix: str,
+                   capture: bool) -> CommandResult:
+        result = CommandResult(argv)
+        stdout = [] if capture else None
+        stderr = [] if capture else None
+
+        async with self.slots:
+            start = time.monotonic()
+            # a session of its own, so the whole tree can be killed on a timeout
+            process = subprocess.Popen(
+                argv,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=env,
+                cwd=cwd,
+                start_new_session=True,
+            )
+            with self.lock:
+                self.running.add(process.pid)
+
+            try:
+                pumps = asyncio.gather(
+                    self._pump(process.stdout, sys.stdout, prefix, stdout),
+                    self._pump(process.stderr, sys.stderr, prefix, stderr),
+                )
+                # Popen.wait reaps the process, which keeps the resource usage for --profile
+                exited = self.loop.run_in_executor(None, process.wait)
+                try:
+                    await asyncio.wait_for(asyncio.shield(exited), timeout)
+                except asyncio.TimeoutError:
+                    result["timed_out"] = True
+                    self._write(sys.stderr, prefix, f"timed out after {timeout:.0f}s, killing it".encode())
+                    kill_tree(process.pid, signal.SIGTERM)
+                    try:
+                        await asyncio.wait_for(asyncio.shield(exited), KILL_GRACE_PERIOD)
+                    except asyncio.TimeoutError:
+                        kill_tree(process.pid, signal.SIGKILL)
+                        await exited
+
+                try:
+                    await asyncio.wait_for(pumps, DRAIN_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                with self.lock:
+                    self.running.discard(process.pid)
+
+            result["returncode"] = process.returncode
+            result["duration"] = time.monotonic() - start
+
+        if capture:
+            result["stdout"] = b"".join(stdout).decode(errors="replace")
+            result["stderr"] = b"".join(stderr).decode(errors="replace")
+
+        return result
+
+    # run a command and wait for it
+    # check raises subprocess.CalledProcessError for a non-zero exit code, a timeout raises subprocess.TimeoutExpired
+    def run(
+            self,
+            argv: List[str],
+            timeout: float = None,
+            check=False,
+            env: Dict = None,
+            cwd: str = None,
+            prefix: str = None,
+            capture=False,
+    ) -> CommandResult:
+        argv = [str(arg) for arg in argv]
+        if timeout is None:
+            timeout = self.default_timeout
+        if prefix is None:
+            prefix = os.path.basename(argv[0])
+        if env is None:
+            env = dict(os.environ)
+
+        if self.verbose:
+            self._write(sys.stdout, prefix, f"running {' '.join(argv)}".encode())
+
+        future = asyncio.run_coroutine_threadsafe(self._run(argv, timeout, env, cwd, prefix, capture), self.loop)
+        try:
+            result = future.result()
+        except KeyboardInterrupt:
+            self.kill_all()
+            raise
+
+        with self.lock:
+            self.results.append(result)
+
+        if self.verbose:
+            self._write(sys.stdout, prefix, f"exit code {result['returncode']} after {result['duration']:.1f}s".encode())
+
+        if result["timed_out"]:
+            raise subprocess.TimeoutExpired(argv, timeout, result["stdout"], result["stderr"])
+        if check and result["returncode"] != 0:
+            raise subprocess.CalledProcessError(result["returncode"], argv, result["stdout"], result["stderr"])
+
+        return result
+
+    def kill_all(self):
+        with self.lock:
+            pids = list(self.running)
+
+        for pid in pids:
+            kill_tree(pid)
+
+    # the slowest commands of this process
+    def print_report(self, count: int = 10):
+        with self.lock:
+            results = sorted(self.results, key=lambda r: r["duration"], reverse=True)[:count]
+
+        if not results:
+            return
+
+        print("slowest commands:")
+        for result in results:
+            status = "timeout" if result["timed_out"] else f"exit {result['returncode']}"
+            print(f"  {result['duration']:8.1f}s  {status:<8}  {' '.join(result['argv'])[:100]}")
+
+
+_shared_runner = None
+_shared_runner_lock = threading.Lock()
+
+
+# returns the command runner of this process
+# the concurrency limit is shared by all steps, even if they run in parallel
+def get_runner(config: operations.utils.LinuxMsvcConfig, verbose=False) -> CommandRunner:
+    global _shared_runner
+
+    with _shared_runner_lock:
+        if _shared_runner is None:
+            max_commands = config.get("max_parallel_commands")
+            _shared_runner = CommandRunner(
+                max_commands=int(max_commands) if max_commands is not None else None,
+                default_timeout=float(config.get("command_timeout", DEFAULT_TIMEOUT)),
+                verbose=verbose,
+            )
+
+        return _shared_runner
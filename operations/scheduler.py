@@ -0,0 +1,204 @@
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, List
+
+import operations.journal
+import operations.profile
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+# The resources a step can use.
+# network steps (downloads, git clones) may all run at the same time.
+# prefix steps mutate the wine prefix and are always run one after another,
+# since a prefix only has one wineserver and one registry.
+# local steps only use the local cpu and disk and run in parallel.
+RESOURCE_NETWORK = "network"
+RESOURCE_PREFIX = "prefix"
+RESOURCE_LOCAL = "local"
+
+RESOURCE_LIMITS = {
+    RESOURCE_PREFIX: 1,
+}
+
+
+class StepFailed(Exception):
+    def __init__(self, step_name: str, error: BaseException):
+        super().__init__(f"The step {step_name} failed: {error}")
+        self.step_name = step_name
+        self.error = error
+
+
+# A single unit of work in a scheduler run.
+# action is called without arguments, depends_on lists the names of the steps that have to be finished first.
+# inputs describe everything the result depends on, a journaled step only runs again if they change.
+class Step(Dict):
+    def __init__(
+            self,
+            name: str,
+            action: Callable[[], None],
+            depends_on: List[str] = None,
+            resource: str = RESOURCE_LOCAL,
+            inputs=None,
+    ):
+        super().__init__()
+        self["name"] = name
+        self["action"] = action
+        self["depends_on"] = depends_on if depends_on is not None else []
+        self["resource"] = resource
+        self["inputs"] = inputs
+        self["fingerprint"] = None
+        self["duration"] = None
+        self["already_done"] = False
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            with operations.profile.span(self["name"], "step", resource=self["resource"]):
+                self["action"]()
+        finally:
+            self["duration"] = time.monotonic() - start
+
+
+class Scheduler:
+    def __init__(self, max_workers: int = 4, verbose=False, journal: operations.journal.InstallJournal = None):
+        self.steps: Dict[str, Step] = {}
+        self.max_workers = max(1, max_workers)
+        self.verbose = verbose
+        self.journal = journal
+        self.wall_time = 0.0
+
+    def add(self, step: Step) -> Step:
+        if step["name"] in self.steps:
+            raise ValueError(f"The step {step['name']} was added twice.")
+
+        self.steps[step["name"]] = step
+        return step
+
+    # make sure all dependencies exist and that there are no cycles
+    def validate(self):
+        for step in self.steps.values():
+            for dep in step["depends_on"]:
+                if dep not in self.steps:
+                    raise ValueError(f"The step {step['name']} depends on the unknown step {dep}.")
+
+        visiting = set()
+        done = set()
+
+        def visit(name: str):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"The step {name} is part of a dependency cycle.")
+
+            visiting.add(name)
+            for dep in self.steps[name]["depends_on"]:
+                visit(dep)
+            visiting.remove(name)
+            done.add(name)
+
+        for step_name in self.steps:
+            visit(step_name)
+
+    # with a journal, a step whose inputs and dependencies didn't change since it last finished is not run again
+    def _already_done(self, step: Step) -> bool:
+        if self.journal is None:
+            return False
+
+        step["fingerprint"] = self.journal.fingerprint(step["name"], step["inputs"], step["depends_on"])
+        return self.journal.is_complete(step["name"], step["fingerprint"])
+
+    # run all steps, respecting the dependencies and resource limits
+    # if a step fails no new steps are started, the running ones are awaited and StepFailed is raised
+    def run(self):
+        self.validate()
+
+        pending = dict(self.steps)
+        finished = set()
+        running = {}
+        resource_usage = {}
+        failure = None
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                skipped = False
+                if failure is None:
+                    for name, step in list(pending.items()):
+                        if len(running) >= self.max_workers:
+                            break
+
+                        if not all(dep in finished for dep in step["depends_on"]):
+                            continue
+
+                        if self._already_done(step):
+                            if self.verbose:
+                                print(f"step {name} is already done")
+                            step["already_done"] = True
+                            finished.add(name)
+                            del pending[name]
+                            skipped = True
+                            continue
+
+                        resource = step["resource"]
+                        limit = RESOURCE_LIMITS.get(resource)
+                        if limit is not None and resource_usage.get(resource, 0) >= limit:
+                            continue
+
+                        if self.verbose:
+                            print(f"starting step {name}")
+
+                        resource_usage[resource] = resource_usage.get(resource, 0) + 1
+                        running[executor.submit(step.run)] = step
+                        del pending[name]
+
+                # the steps depending on skipped steps may be ready now
+                if skipped:
+                    continue
+
+                if not running:
+                    break
+
+                done_futures, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done_futures:
+                    step = running.pop(future)
+                    resource_usage[step["resource"]] -= 1
+
+                    error = future.exception()
+                    if error is not None:
+                        print(f"step {step['name']} failed after {step['duration']:.1f}s: {error}")
+                        if failure is None:
+                            failure = StepFailed(step["name"], error)
+                        continue
+
+                    finished.add(step["name"])
+                    if self.journal is not None:
+                        self.journal.complete(step["name"], step["fingerprint"], step["duration"])
+                    if self.verbose:
+                        print(f"finished step {step['name']} in {step['duration']:.1f}s")
+
+        self.wall_time = time.monotonic() - start
+
+        if failure is not None:
+            raise failure
+
+    def print_report(self):
+        print("step timings:")
+
+        name_width = max([len(name) for name in self.steps] + [len("total")])
+        for step in self.steps.values():
+            if step["already_done"]:
+                duration = "done before"
+            elif step["duration"] is None:
+                duration = "skipped"
+            else:
+                duration = f"{step['duration']:8.1f}s"
+
+            print(f"  {step['name']:<{name_width}}  {step['resource']:<8}  {duration}")
+
+        print(f"  {'total':<{name_width}}  {'':<8}  {self.wall_time:8.1f}s")
@@ -1,5 +1,10 @@
+import os
 import sys
 
+import operations.utils
+
+from typing import Dict
+
 # don't allow running the file as script
 if __name__ == "__main__":
     print("This file is not meant to be run as script.")
@@ -14,3 +19,64 @@ def init_subparser(subparser):
         default="",
         help="The type of shell to start. The default is the current shell.",
     )
+
+    env_parser = subparser.add_parser(
+        "env",
+        help="Print the environment as a script for eval, e.g. 'eval \"$(linux-msvc env)\"' or 'linux-msvc env | source'",
+    )
+
+    env_parser.add_argument(
+        "--shell",
+        default="",
+        choices=["", "bash", "zsh", "fish"],
+        help="The shell to generate the script for. The default is the calling shell.",
+    )
+
+    env_parser.add_argument(
+        "--refresh",
+        action="store_true",
+        default=False,
+        help="Compute the environment again instead of using the stored snapshot.",
+    )
+
+
+def quote(value: str, shell: str) -> str:
+    if shell == "fish":
+        return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+    return "'" + value.replace("'", "'\"'\"'") + "'"
+
+
+# generate a script that applies the environment snapshot to the calling shell
+def env_script(config: operations.utils.LinuxMsvcConfig, shell: str, refresh=False, verbose=False) -> str:
+    snapshot = operations.utils.get_env_snapshot(config, refresh)
+
+    variables = dict(snapshot["variables"])
+    if os.environ.get(operations.utils.LEASED_PREFIX_ENV):
+        variables["WINEPREFIX"] = os.environ[operations.utils.LEASED_PREFIX_ENV]
+    if not verbose:
+        variables["WINEDEBUG"] = "-all"
+
+    path = operations.utils.prepend_path(os.environ.get("PATH", ""), snapshot["path"])
+
+    lines = []
+    if shell == "fish":
+        lines.append("set -gx PATH " + " ".join(quote(entry, shell) for entry in path.split(":")))
+        for key, value in variables.items():
+            lines.append(f"set -gx {key} {quote(value, shell)}")
+    else:
+        lines.append(f"export PATH={quote(path, shell)}")
+        for key, value in variables.items():
+            lines.append(f"export {key}={quote(value, shell)}")
+
+    return "\n".join(lines) + "\n"
+
+
+def print_env(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    shell = args["shell"]
+    if shell == "":
+        shell = os.path.basename(args["base_shell"])
+    if shell not in ["bash", "zsh", "fish"]:
+        shell = "bash"
+
+    sys.stdout.write(env_script(config, shell, args["refresh"], args["verbose"]))
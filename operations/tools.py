@@ -1,8 +1,11 @@
+import os
 import subprocess
 import sys
 import argparse
 from pathlib import Path
 
+import operations.crossfile
+import operations.daemon
 import operations.utils
 
 from typing import Dict, List
@@ -13,9 +16,15 @@ if __name__ == "__main__":
     sys.exit(1)
 
 
-def init_subparsers(subparser):
+def init_subparser(subparser):
     meson_parser = subparser.add_parser("meson", help="A wrapper around meson to use it with msvc")
     wine_parser = subparser.add_parser("wine", help="Use msvc wine")
+    # link flags start with / or -, so the link parser must not treat them as options
+    link_parser = subparser.add_parser(
+        "link",
+        prefix_chars="+",
+        help="Run the msvc linker, through the daemon if it is running",
+    )
     powershell_parser = subparser.add_parser("pwsh", help="Use the powershell (pwsh.exe) inside wine")
 
     meson_parser.add_argument(
@@ -23,7 +32,17 @@ def init_subparsers(subparser):
         dest="add_cross_file",
         action="store_true",
         default=False,
-        help="Add the cross file to the meson command",
+        help="Add the cross file of this installation to the meson command. It uses absolute tool paths and "
+             "a shell script as exe_wrapper that runs wine without starting linux-msvc for every test.",
+    )
+
+    meson_parser.add_argument(
+        "--prefix_pool",
+        dest="prefix_pool",
+        action="store_true",
+        default=False,
+        help="Use 'linux-msvc pool run' as exe_wrapper in the generated cross file, so parallel tests run on "
+             "separate wine prefixes. Create the pool first with 'linux-msvc pool create'.",
     )
 
     meson_parser.add_argument(
@@ -38,6 +57,12 @@ def init_subparsers(subparser):
         help="Arguments to pass to wine",
     )
 
+    link_parser.add_argument(
+        "args",
+        nargs=argparse.REMAINDER,
+        help="Arguments to pass to link",
+    )
+
     powershell_parser.add_argument(
         "args",
         nargs=argparse.REMAINDER,
@@ -54,11 +79,10 @@ def meson(
     meson_command = ["meson"]
     meson_command += args["args"]
 
-    cross_file_dest = Path(config["destination"]) / "main-repo" / "cross_files" / "wine_msvc"
     if args["add_cross_file"]:
         meson_command += [
             "--cross-file",
-            str(cross_file_dest)
+            str(operations.crossfile.get_cross_file(config, args["verbose"], args["prefix_pool"]))
         ]
 
     subprocess.run(meson_command)
@@ -68,11 +92,34 @@ def wine(
     config: operations.utils.LinuxMsvcConfig,
     args: Dict
 ):
-    operations.utils.set_env(config, args)
-
     wine_command = ["wine-msvc.sh"]
     wine_command += args["args"]
-    subprocess.run(wine_command)
+
+    # a running daemon already has the environment and a warm wineserver
+    returncode = operations.daemon.run(config, wine_command)
+    if returncode is None:
+        operations.utils.set_env(config, args)
+        returncode = subprocess.run(wine_command).returncode
+
+    sys.exit(returncode)
+
+
+def link(
+    config: operations.utils.LinuxMsvcConfig,
+    args: Dict
+):
+    link_command = ["link"] + args["args"]
+
+    returncode = operations.daemon.run(config, link_command)
+    if returncode is None:
+        operations.utils.set_env(config, args)
+        returncode = subprocess.run(link_command).returncode
+
+    sys.exit(returncode)
+
+
+def powershell_command(pwsh_args: List[str]) -> List[str]:
+    return ["wine", "C:\\Program Files\\PowerShell\\7\\pwsh.exe"] + pwsh_args
 
 
 def powershell(
@@ -81,38 +128,143 @@ def powershell(
 ):
     operations.utils.set_env(config, args)
 
-    pwsh_command = ["wine"]
-    pwsh_command += ["C:\\Program Files\\PowerShell\\7\\pwsh.exe"]
-    pwsh_command += args["args"]
+    pwsh_command = powershell_command(args["args"])
     if "verbose" in args and args["verbose"]:
         print(pwsh_command)
 
     subprocess.run(pwsh_command)
 
 
+# run a powershell script during the install, without a terminal and with the timeout of the command runner
+# a failing script raises subprocess.CalledProcessError, so the step isn't recorded as done
+# the caller sets the environment, the install steps run in parallel and must not modify it
+def run_powershell_script(config: operations.utils.LinuxMsvcConfig, pwsh_args: List[str], verbose=False):
+    # the runner is only imported by the install steps, to keep wine and cl calls fast
+    import operations.runner
+
+    operations.runner.get_runner(config, verbose).run(powershell_command(pwsh_args), check=True, prefix="pwsh")
+
+
+# returns the winetricks executable to use
+# unless the system winetricks is used, the latest winetricks script is downloaded into the cache
+def get_winetricks(config: operations.utils.LinuxMsvcConfig, verbose=False) -> str:
+    if config["system_winetricks"]:
+        return 'winetricks'
+
+    winetricks_exe_url = "https://raw.githubusercontent.com/Winetricks/winetricks/master/src/winetricks"
+    winetricks_exe = operations.utils.get_chached_file(
+        config,
+        winetricks_exe_url,
+        file_name="winetricks",
+        verbose=verbose
+    )
+    os.chmod(winetricks_exe, os.stat(winetricks_exe).st_mode | 0o111)
+
+    return str(winetricks_exe)
+
+
+# verbs that change a setting instead of installing something, they are cheap and always applied
+WINETRICKS_SETTINGS = "settings"
+# verbs that are not reliable when they share a winetricks run with others
+WINETRICKS_UNBATCHED = ("dotnet",)
+
+
+# where winetricks keeps the installers of its verbs, so they are only downloaded once
+def winetricks_cache_dir() -> Path:
+    if os.environ.get("W_CACHE"):
+        return Path(os.environ["W_CACHE"])
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path("~/.cache").expanduser()
+    return Path(cache_home) / "winetricks"
+
+
+def wine_prefix() -> Path:
+    if os.environ.get("WINEPREFIX"):
+        return Path(os.environ["WINEPREFIX"])
+
+    return Path("~/.wine").expanduser()
+
+
+# the verbs winetricks has already installed into the prefix
+def installed_winetricks_verbs() -> List[str]:
+    log_file = wine_prefix() / "winetricks.log"
+    if not log_file.exists():
+        return []
+
+    with open(log_file, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# turn the package list into the winetricks runs that are actually needed
+# installed and duplicated verbs are dropped, settings are kept unless the same setting was just applied,
+# and everything that is safe to combine is grouped into a single run, unless every verb needs a timing of its own
+def plan_winetricks_runs(packages: List[List[str]], installed: List[str], batch=True) -> List[List[str]]:
+    verbs = []
+    for package in packages:
+        verb = package[-1]
+        if package[0] == WINETRICKS_SETTINGS:
+            if verbs and verbs[-1] == verb:
+                continue
+        elif verb in installed or verb in verbs:
+            continue
+
+        verbs.append(verb)
+
+    if not batch:
+        return [[verb] for verb in verbs]
+
+    runs = []
+    for verb in verbs:
+        if verb.startswith(WINETRICKS_UNBATCHED):
+            runs.append([verb])
+            runs.append([])
+        elif runs:
+            runs[-1].append(verb)
+        else:
+            runs.append([verb])
+
+    return [run for run in runs if run]
+
+
+# the caller sets the environment, like for run_powershell_script
 def install_winetricks_packages(
         config: operations.utils.LinuxMsvcConfig,
         packages: List[List[str]],
         verbose=False
 ):
+    import operations.profile
+    import operations.runner
 
-    winetricks_exe = 'winetricks'
-    if not config["system_winetricks"]:
-        winetricks_exe_url = "https://raw.githubusercontent.com/Winetricks/winetricks/master/src/winetricks"
-        winetricks_exe = operations.utils.get_chached_file(
-            config,
-            winetricks_exe_url,
-            file_name="winetricks",
-            verbose=verbose
-        )
-        subprocess.run(["chmod", "+x", str(winetricks_exe)])
+    winetricks_exe = get_winetricks(config, verbose)
 
-    operations.utils.set_env(config, {}, verbose)
+    # a batched run can only be timed as a whole, with --profile every verb runs and is timed on its own
+    installed = installed_winetricks_verbs()
+    runs = plan_winetricks_runs(packages, installed, batch=not operations.profile.enabled())
 
-    for package in packages:
-        print("installing wintricks package: ", package)
+    skipped = [package[-1] for package in packages if package[-1] in installed and package[0] != WINETRICKS_SETTINGS]
+    if skipped:
+        print("already installed winetricks packages: ", sorted(set(skipped)))
+
+    runner = operations.runner.get_runner(config, verbose)
+    timings = []
+    failed = None
+    for verbs in runs:
+        print("installing wintricks packages: ", verbs)
+
+        with operations.profile.span(f"winetricks {' '.join(verbs)}", "winetricks"):
+            result = runner.run([winetricks_exe, "-q"] + verbs)
+        returncode = result["returncode"]
+        timings.append((verbs, result["duration"]))
+
+        if returncode != 0:
+            print(f"winetricks exited with code {returncode} while installing {verbs}")
+            failed = failed or subprocess.CalledProcessError(returncode, [winetricks_exe, "-q"] + verbs)
 
-        args = [str(winetricks_exe), "-q"]
-        args.extend(package)
+    if timings:
+        print("winetricks run times:")
+    for verbs, duration in timings:
+        print(f"  {duration:8.1f}s  {' '.join(verbs)}")
 
-        subprocess.run(args)
+    # the remaining runs are still done, but the step fails so the next install retries the missing verbs
+    if failed:
+        raise failed
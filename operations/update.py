@@ -1,5 +1,14 @@
+import os
+import shutil
+import subprocess
 import sys
 
+import operations.install
+import operations.repos
+import operations.utils
+
+from typing import Dict
+
 # don't allow running the file as script
 if __name__ == "__main__":
     print("This file is not meant to be run as script.")
@@ -17,3 +26,102 @@ def init_subparser(subparser):
         help="Where to install linux-msvc",
     )
 
+
+    update_parser.add_argument(
+        "--check",
+        action="store_true",
+        default=False,
+        help="Only show which msvc packages changed, don't install anything.",
+    )
+
+    update_parser.add_argument(
+        "--force",
+        action="store_true",
+        default=False,
+        help="Reinstall msvc even if no package changed.",
+    )
+
+
+def update_msvc(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    verbose = args["verbose"]
+    msvc_path = config.destination() / "msvc"
+
+    selection = operations.install.msvc_selection(config)
+    if selection is None:
+        print("Could not get the current package selection from vsdownload.py.")
+        sys.exit(1)
+
+    installed = operations.install.installed_msvc_selection(msvc_path)
+    if installed is None:
+        print("The msvc installation has no package list, it has to be installed again.")
+        changed = True
+    else:
+        added = sorted(set(selection) - set(installed))
+        removed = sorted(set(installed) - set(selection))
+        changed = bool(added or removed)
+
+        for package in removed:
+            print(f"- {package}")
+        for package in added:
+            print(f"+ {package}")
+
+    if not changed and not args["force"]:
+        print("msvc is up to date")
+        return
+
+    if args["check"]:
+        return
+
+    # Install the new version next to the old one and swap them afterwards, so a failed update keeps the old one.
+    # All unchanged packages are taken from the cache, only the changed ones are downloaded.
+    new_path = config.destination() / "msvc.new"
+    old_path = config.destination() / "msvc.old"
+    for path in [new_path, old_path]:
+        if path.exists():
+            shutil.rmtree(path)
+
+    try:
+        operations.install.download_msvc(config, verbose, msvc_path=new_path)
+    except subprocess.CalledProcessError:
+        pass
+
+    if operations.install.installed_msvc_selection(new_path) is None:
+        shutil.rmtree(new_path, ignore_errors=True)
+        print("Downloading the new msvc version failed, the old version is kept.")
+        sys.exit(1)
+
+    try:
+        if msvc_path.exists():
+            os.rename(msvc_path, old_path)
+        os.rename(new_path, msvc_path)
+
+        # the wrappers are created in the final location, since they refer to the installation path
+        operations.install.install_msvc(config, verbose)
+    except (OSError, subprocess.CalledProcessError) as e:
+        if old_path.exists():
+            shutil.rmtree(msvc_path, ignore_errors=True)
+            os.rename(old_path, msvc_path)
+        shutil.rmtree(new_path, ignore_errors=True)
+        print(f"Installing the new msvc version failed ({e}), the old version is kept.")
+        sys.exit(1)
+
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def update(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    verbose = args["verbose"]
+    operations.utils.set_env(config, args)
+
+    # a check doesn't change anything, it uses the vsdownload.py that is checked out
+    if not args["check"]:
+        operations.repos.update_repo(config, "msvc-wine-repo", operations.install.MSVC_WINE_URL, verbose)
+    update_msvc(config, args)
+
+    if not args["check"]:
+        operations.repos.update_repo(config, "vcpkg", operations.install.VCPKG_URL, verbose)
+
+    config.update(operations.utils.detect_toolchain_versions(config))
+    if config.get("create_config_file", True):
+        config.save()
+
+    print("finished updating.")
@@ -1,20 +1,22 @@
+import hashlib
 import shutil
 import subprocess
 import sys
-from typing import Dict
+import time
+from typing import Dict, List
 from pathlib import Path
 
-import semver
 import os
 import json
 
-import wget
-
 
 class Consts:
+    VERSION = "0.1.0"
+
     @staticmethod
-    def version() -> semver.VersionInfo:
-        return semver.VersionInfo.parse("0.1.0")
+    def version() -> "semver.VersionInfo":
+        import semver
+        return semver.VersionInfo.parse(Consts.VERSION)
 
     @staticmethod
     def get_configs_dir() -> Path:
@@ -41,6 +43,12 @@ class Consts:
         return Consts.get_app_config_dir("msvc_linux") / "config.json"
 
 
+# the architectures msvc-wine can install
+TARGET_ARCHITECTURES = ["x64", "x86", "arm", "arm64"]
+HOST_ARCHITECTURES = ["x64", "x86", "arm64"]
+DEFAULT_ARCHITECTURE = "x64"
+
+
 class LinuxMsvcConfig(Dict):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -57,6 +65,20 @@ class LinuxMsvcConfig(Dict):
     def destination(self) -> Path:
         return Path(self.get("destination")).expanduser()
 
+    # what vsdownload.py installs, see operations.install.component_selection
+    # configs from before the selection existed have none, they got the defaults of vsdownload.py
+    def msvc_components(self) -> Dict:
+        return self.get("msvc_components") or {}
+
+    # the target architectures msvc was installed for, the environment is set up for the first one
+    # installs without a selection have all of them, but only x64 was ever used
+    def architectures(self) -> List[str]:
+        return self.msvc_components().get("architectures") or [DEFAULT_ARCHITECTURE]
+
+    # the directory with the compiler wrappers and msvcenv.sh of the main target architecture
+    def msvc_bin_dir(self) -> Path:
+        return self.destination() / "msvc" / "bin" / self.architectures()[0]
+
     def save(self):
         target_location = os.path.dirname(Consts.config_file())
         if not os.path.exists(target_location):
@@ -74,30 +96,80 @@ class LinuxMsvcConfig(Dict):
             return LinuxMsvcConfig(json.load(f))
 
 
+# parse sizes like 1024, 500K, 20M or 10G into bytes
+def parse_size(size: str) -> int:
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+    size = str(size).strip().upper().removesuffix("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+
+    return int(size)
+
+
+def format_size(size: int) -> str:
+    for unit in ["B", "K", "M", "G"]:
+        if size < 1024:
+            return f"{size:.1f}{unit}" if unit != "B" else f"{size}{unit}"
+        size /= 1024
+
+    return f"{size:.1f}T"
+
+
 # returns the full path of a cached file
 # if it doesn't exist, download it
 # if no filename is given, the filename will be the basename of the download url
 def get_chached_file(config: LinuxMsvcConfig, download_url: str, file_name: str = None, verbose=False) -> Path:
-    cache_dir = config.destination() / "cache"
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir, exist_ok=True)
+    import operations.cache
+    return operations.cache.DownloadCache(config).get(download_url, file_name, verbose)
+
+
+# read the msvc and windows sdk versions from the msvcenv.sh created by the msvc-wine install script
+def detect_toolchain_versions(config: LinuxMsvcConfig) -> Dict:
+    versions = {"msvc_version": None, "sdk_version": None}
+
+    msvcenv = config.msvc_bin_dir() / "msvcenv.sh"
+    if not msvcenv.exists():
+        return versions
+
+    with open(msvcenv, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("MSVCVER="):
+                versions["msvc_version"] = line.split("=", 1)[1].strip("\"'")
+            elif line.startswith("SDKVER="):
+                versions["sdk_version"] = line.split("=", 1)[1].strip("\"'")
+
+    return versions
+
 
-    if file_name is None:
-        file_name = os.path.basename(download_url)
+# the tar options for compressed archives, zstd is used if it is installed, otherwise gzip
+def tar_compression() -> List[str]:
+    if shutil.which("zstd") is not None:
+        return ["-I", "zstd -T0"]
 
-    cached_file = cache_dir / file_name
-    if not os.path.exists(cached_file):
-        if verbose:
-            print(f"Downloading {file_name}...")
-        wget.download(url=download_url, out=str(cached_file), bar=None)
+    return ["-z"]
 
-    return cached_file
+
+DEPENDENCY_CHECK_INTERVAL = 24 * 60 * 60
 
 
 # check if the required dependencies are installed
 # if not, print a message and return false
 # if yes, return true
+# a successful check is remembered for a day, as long as PATH doesn't change
 def check_dependencies() -> bool:
+    dependency_cache = Consts.config_file().parent / "dependencies.json"
+    path_hash = hashlib.sha256(os.environ.get("PATH", "").encode()).hexdigest()
+
+    try:
+        with open(dependency_cache, "r") as f:
+            cached = json.load(f)
+        if cached["path"] == path_hash and time.time() - cached["checked"] < DEPENDENCY_CHECK_INTERVAL:
+            return True
+    except (OSError, ValueError, KeyError):
+        pass
+
     dependencies = ["wine", "winetricks", "git", "msiextract", "winbindd"]
     for dep in dependencies:
         if shutil.which(dep) is None:
@@ -105,19 +177,123 @@ def check_dependencies() -> bool:
             print("wine, winetricks, git, msitools and winbind are required. Install them and try again.")
             return False
 
+    try:
+        dependency_cache.parent.mkdir(parents=True, exist_ok=True)
+        with open(dependency_cache, "w") as f:
+            json.dump({"path": path_hash, "checked": time.time()}, f)
+    except OSError:
+        pass
+
     return True
 
 
-def set_env(config: LinuxMsvcConfig, args: Dict, verbose=False):
+# variables that change whenever a shell starts and are never part of the environment snapshot
+VOLATILE_ENV = ["PATH", "PWD", "OLDPWD", "SHLVL", "_"]
+
+_env_snapshot = None
+
+# set by 'linux-msvc pool exec', the jobs inside use the leased prefix instead of the one in the snapshot
+LEASED_PREFIX_ENV = "LINUX_MSVC_LEASED_PREFIX"
+
+
+def env_snapshot_file() -> Path:
+    return Consts.config_file().parent / "environment.json"
+
 
-    dest = Path(config["destination"]).expanduser()
-    os.environ['PATH'] = str(dest / "msvc" / "bin" / "x64") + ':' + os.environ['PATH']
+# the snapshot has to be recomputed when the config or the msvc installation changes
+def env_fingerprint(config: LinuxMsvcConfig) -> str:
+    bin_dir = config.msvc_bin_dir()
 
+    state = {"config": dict(config), "version": Consts.VERSION}
+    for path in [config.destination() / "msvc", bin_dir, bin_dir / "msvcenv.sh"]:
+        if path.exists():
+            state[str(path)] = [path.stat().st_mtime_ns, path.stat().st_size]
+
+    return hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# source msvcenv.sh once and record everything it changes
+# it is sourced in a fixed minimal environment, a shell that already has the msvc environment, like
+# 'linux-msvc shell', would otherwise leave INCLUDE and LIB out of the snapshot since they don't change there
+def compute_env_snapshot(config: LinuxMsvcConfig) -> Dict:
+    dest = config.destination()
+    bin_dir = config.msvc_bin_dir()
+
+    variables = {"WINEARCH": "win64"}
     if not config["no_wine_prefix"]:
-        wine_prefix = Path(dest / ".wineenv")
-        os.environ["WINEPREFIX"] = str(wine_prefix)
+        variables["WINEPREFIX"] = str(dest / ".wineenv")
+
+    msvcenv = bin_dir / "msvcenv.sh"
+    if msvcenv.exists():
+        base_env = {key: os.environ[key] for key in ["PATH", "HOME"] if key in os.environ}
+        base_env.update(variables)
+
+        # msvcenv.sh finds the installation relative to $0, so it is passed as $0 to bash
+        result = subprocess.run(
+            ["bash", "-c", '. "$0" >/dev/null && env -0', str(msvcenv)],
+            env=base_env,
+            capture_output=True,
+        )
+        if result.returncode == 0:
+            for entry in result.stdout.decode().split("\0"):
+                key, sep, value = entry.partition("=")
+                if sep and key not in VOLATILE_ENV and base_env.get(key) != value:
+                    variables[key] = value
+
+    return {
+        "fingerprint": env_fingerprint(config),
+        "path": [str(bin_dir)],
+        "variables": variables,
+    }
+
+
+# returns the environment snapshot, it is only recomputed if the config or the msvc installation changed
+def get_env_snapshot(config: LinuxMsvcConfig, refresh=False) -> Dict:
+    global _env_snapshot
+
+    fingerprint = env_fingerprint(config)
+    if not refresh and _env_snapshot is not None and _env_snapshot["fingerprint"] == fingerprint:
+        return _env_snapshot
+
+    snapshot = None
+    if not refresh:
+        try:
+            with open(env_snapshot_file(), "r") as f:
+                snapshot = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    if snapshot is None or snapshot.get("fingerprint") != fingerprint:
+        snapshot = compute_env_snapshot(config)
+
+        snapshot_file = env_snapshot_file()
+        snapshot_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = snapshot_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(snapshot, f, indent=4)
+        os.replace(tmp_file, snapshot_file)
+
+    _env_snapshot = snapshot
+    return snapshot
+
+
+# prepend entries to a PATH like variable without adding duplicates
+def prepend_path(current: str, entries: List[str]) -> str:
+    result = []
+    for entry in entries + current.split(":"):
+        if entry and entry not in result:
+            result.append(entry)
+
+    return ":".join(result)
 
-    os.environ["WINEARCH"] = "win64"
+
+def set_env(config: LinuxMsvcConfig, args: Dict, verbose=False):
+    snapshot = get_env_snapshot(config)
+
+    os.environ["PATH"] = prepend_path(os.environ.get("PATH", ""), snapshot["path"])
+    os.environ.update(snapshot["variables"])
+    if os.environ.get(LEASED_PREFIX_ENV):
+        os.environ["WINEPREFIX"] = os.environ[LEASED_PREFIX_ENV]
 
     if not verbose:
         if "verbose" in args:
@@ -125,10 +301,3 @@ def set_env(config: LinuxMsvcConfig, args: Dict, verbose=False):
 
     if not verbose:
         os.environ["WINEDEBUG"] = "-all"
-
-    env_command = [
-        "env",
-        "msvcenv.sh",
-    ]
-
-    subprocess.run(env_command)
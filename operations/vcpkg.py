@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from pathlib import Path
+from typing import Dict
+
+import operations.bundle
+import operations.cache
+import operations.install
+import operations.runner
+import operations.utils
+
+# don't allow running the file as script
+if __name__ == "__main__":
+    print("This file is not meant to be run as script.")
+    sys.exit(1)
+
+
+# the binary caches of all toolchains, one directory per cache key
+CACHE_DIR_NAME = "vcpkg"
+EXPORT_VERSION = 1
+EXPORT_MANIFEST = "vcpkg-cache.json"
+
+
+def init_subparser(subparser):
+    vcpkg_parser = subparser.add_parser(
+        "vcpkg",
+        help="Run vcpkg with msvc, built packages are kept in a binary cache of the installed msvc version",
+    )
+
+    vcpkg_operation_subparser = vcpkg_parser.add_subparsers(help="vcpkg operation to perform", dest="vcpkg_operation")
+    run_parser = vcpkg_operation_subparser.add_parser(
+        "run",
+        help="Run vcpkg inside wine, e.g. 'linux-msvc vcpkg run install zlib'",
+    )
+    vcpkg_operation_subparser.add_parser("ls", help="List the binary caches and their sizes")
+    export_parser = vcpkg_operation_subparser.add_parser(
+        "export",
+        help="Write the cached binary packages into an archive, to import them on another host",
+    )
+    import_parser = vcpkg_operation_subparser.add_parser(
+        "import",
+        help="Add the binary packages of an archive written by 'vcpkg export' to the cache",
+    )
+
+    run_parser.add_argument(
+        "args",
+        nargs=argparse.REMAINDER,
+        help="Arguments to pass to vcpkg",
+    )
+
+    export_parser.add_argument("archive", help="The archive to write, e.g. vcpkg-cache.tar.zst")
+    export_parser.add_argument(
+        "--all",
+        dest="all_keys",
+        action="store_true",
+        default=False,
+        help="Export the caches of all toolchains, not only the one of the installed msvc version.",
+    )
+
+    import_parser.add_argument("archive", help="The archive written by 'vcpkg export'")
+
+
+def vcpkg_dir(config: operations.utils.LinuxMsvcConfig) -> Path:
+    return config.destination() / "vcpkg"
+
+
+def cache_root(config: operations.utils.LinuxMsvcConfig) -> Path:
+    return config.destination() / "cache" / CACHE_DIR_NAME
+
+
+# The packages built by one msvc and windows sdk version can't be used with another one.
+# vcpkg hashes the compiler into the abi of every package as well, but it only sees the wine wrappers,
+# so each toolchain gets a cache of its own. The triplet is part of the abi, so all architectures share it.
+def cache_key(config: operations.utils.LinuxMsvcConfig) -> str:
+    versions = {key: config.get(key) for key in ["msvc_version", "sdk_version"]}
+    if None in versions.values():
+        versions = operations.utils.detect_toolchain_versions(config)
+
+    if None in versions.values():
+        print(f"Could not detect the msvc and windows sdk version in {config.msvc_bin_dir()}.")
+        print("Please make sure msvc is installed, e.g. with 'linux-msvc config reset msvc'.")
+        sys.exit(1)
+
+    return f"msvc-{versions['msvc_version']}_sdk-{versions['sdk_version']}"
+
+
+def cache_dir(config: operations.utils.LinuxMsvcConfig) -> Path:
+    return cache_root(config) / cache_key(config)
+
+
+# the path of a linux file for windows programs, wine maps / to the drive Z:
+def windows_path(path: Path) -> str:
+    return "Z:" + str(Path(path).resolve()).replace("/", "\\")
+
+
+# the environment vcpkg runs in, on top of the msvc environment
+# a VCPKG_BINARY_SOURCES of the user, like a shared nuget feed, is still used after the local cache
+def vcpkg_env(config: operations.utils.LinuxMsvcConfig) -> Dict:
+    components = config.msvc_components()
+    binary_cache = cache_dir(config)
+    binary_cache.mkdir(parents=True, exist_ok=True)
+
+    sources = f"clear;files,{windows_path(binary_cache)},readwrite"
+    if os.environ.get("VCPKG_BINARY_SOURCES"):
+        sources += ";" + os.environ["VCPKG_BINARY_SOURCES"]
+
+    env = dict(os.environ)
+    env["VCPKG_BINARY_SOURCES"] = sources
+    env["VCPKG_DISABLE_METRICS"] = "1"
+    env.setdefault("VCPKG_DEFAULT_TRIPLET", f"{config.architectures()[0]}-windows")
+    env.setdefault(
+        "VCPKG_DEFAULT_HOST_TRIPLET",
+        f"{components.get('host_arch') or operations.utils.DEFAULT_ARCHITECTURE}-windows",
+    )
+
+    return env
+
+
+def run(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    # the install only bootstraps vcpkg if powershell works in the prefix, so it is done on first use otherwise
+    vcpkg_exe = vcpkg_dir(config) / "vcpkg.exe"
+    if not vcpkg_exe.exists():
+        print("setting up vcpkg")
+        operations.install.setup_vcpkg(config, verbose=args["verbose"])
+
+    if not vcpkg_exe.exists():
+        print(f"vcpkg could not be bootstrapped, {vcpkg_exe} doesn't exist.")
+        sys.exit(1)
+
+    operations.utils.set_env(config, args)
+
+    vcpkg_command = ["wine", str(vcpkg_exe)] + args["args"]
+    if args["verbose"]:
+        print(vcpkg_command)
+
+    sys.exit(subprocess.run(vcpkg_command, env=vcpkg_env(config)).returncode)
+
+
+def _directory_size(directory: Path) -> int:
+    return sum(path.stat().st_size for path in operations.bundle.files_below(directory))
+
+
+def ls(config: operations.utils.LinuxMsvcConfig):
+    root = cache_root(config)
+    keys = sorted(entry.name for entry in root.iterdir() if entry.is_dir()) if root.is_dir() else []
+    current = cache_key(config)
+
+    for key in keys:
+        packages = len([path for path in operations.bundle.files_below(root / key) if path.suffix == ".zip"])
+        size = operations.utils.format_size(_directory_size(root / key))
+        print(f"{'*' if key == current else ' '} {key}  {packages} packages  {size}")
+
+    if current not in keys:
+        print(f"nothing is cached for the installed toolchain {current} yet")
+
+
+# Write the binary caches into one archive, with a list of all files and their checksums.
+def export_cache(config: operations.utils.LinuxMsvcConfig, archive: Path, all_keys=False, verbose=False):
+    root = cache_root(config)
+    if all_keys:
+        keys = sorted(entry.name for entry in root.iterdir() if entry.is_dir()) if root.is_dir() else []
+    else:
+        keys = [cache_key(config)] if (root / cache_key(config)).is_dir() else []
+
+    manifest = {"version": EXPORT_VERSION, "files": {}}
+    staging = Path(tempfile.mkdtemp(dir=config.destination(), prefix=".vcpkg-export-"))
+    try:
+        for key in keys:
+            for path in operations.bundle.files_below(root / key):
+                operations.bundle.stage_file(staging, str(path.relative_to(root)), path, manifest["files"],
+                                             verbose=verbose)
+
+        if not manifest["files"]:
+            print("There are no cached vcpkg packages to export.")
+            sys.exit(1)
+
+        operations.bundle.write_archive(config, staging, archive, EXPORT_MANIFEST, manifest, verbose)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    print(f"exported {len(manifest['files'])} files of {', '.join(keys)} into {archive} "
+          f"({operations.utils.format_size(archive.stat().st_size)})")
+
+
+# Unpack an archive into the binary caches.
+# Packages are named by their abi hash, so a package that already exists is the same and is kept.
+def import_cache(config: operations.utils.LinuxMsvcConfig, archive: Path, verbose=False):
+    if not archive.exists():
+        print(f"There is no archive at {archive}.")
+        sys.exit(1)
+
+    root = cache_root(config)
+    staging = Path(tempfile.mkdtemp(dir=config.destination(), prefix=".vcpkg-import-"))
+    try:
+        result = operations.runner.get_runner(config, verbose).run(["tar", "-xf", str(archive), "-C", str(staging)])
+        if result["returncode"] != 0:
+            print(f"Could not unpack {archive}, nothing was imported.")
+            sys.exit(1)
+
+        try:
+            with open(staging / EXPORT_MANIFEST, "r") as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            manifest = {}
+        if manifest.get("version") != EXPORT_VERSION:
+            print(f"{archive} was not written by 'linux-msvc vcpkg export' or by an incompatible version.")
+            sys.exit(1)
+
+        corrupted = [
+            relative for relative in manifest["files"] if Path(relative).is_absolute() or ".." in Path(relative).parts
+        ]
+        corrupted = corrupted or operations.bundle.corrupted_files(staging, manifest["files"])
+        if corrupted:
+            for relative in corrupted:
+                print(f"corrupted {relative}")
+            print(f"{archive} is damaged, nothing was imported.")
+            sys.exit(1)
+
+        imported = 0
+        for relative in manifest["files"]:
+            target = root / relative
+            if target.exists():
+                continue
+
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(staging / relative, target)
+            imported += 1
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    keys = sorted({Path(relative).parts[0] for relative in manifest["files"]})
+    print(f"imported {imported} of {len(manifest['files'])} files from {archive}")
+    if cache_key(config) not in keys:
+        print(f"The archive has no packages for the installed toolchain {cache_key(config)}, only for {', '.join(keys)}.")
+
+
+def vcpkg_command(config: operations.utils.LinuxMsvcConfig, args: Dict):
+    match args["vcpkg_operation"]:
+        case "run":
+            run(config, args)
+        case "ls":
+            ls(config)
+        case "export":
+            export_cache(config, Path(args["archive"]).expanduser(), args["all_keys"], verbose=args["verbose"])
+        case "import":
+            import_cache(config, Path(args["archive"]).expanduser(), verbose=args["verbose"])